@@ -0,0 +1,279 @@
+"""Benchmarks for tvfile, run against the local stand-in api in benchmarks/tvdb_server.py
+
+Run from the project directory with `python -m benchmarks.bench`. Each run is
+appended to a history file, and compared with the previous run so that
+regressions stand out.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from unittest.mock import patch
+
+import tvfile
+from benchmarks.tvdb_server import FakeTvdb, make_episodes
+
+
+# Modules that importing tvfile must leave for later, because --help,
+# config errors and cached runs don't need them
+DEFERRED_MODULES = ('requests', 'urllib3', 'sqlite3', 'csv', 'email.utils')
+SIZES = (100, 1000, 5000, 20000)
+QUICK_SIZES = (100, 1000)
+STYLE = """
+[standard]
+word_delim = ' '
+part_delim = ' - '
+caps = yes
+allow_chars = ,'!&$()
+"""
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description='Benchmark tvfile against a local stand-in for the tvdb api')
+    parser.add_argument('--quick', action='store_true',
+                        help='Only use series of {} episodes'.format(' and '.join(map(str, QUICK_SIZES))))
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every api response')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of api requests that fail with a 500 error')
+    parser.add_argument('--files', type=int, default=100,
+                        help='Number of episode files in the end-to-end sessions')
+    parser.add_argument('--history', default='bench_results.jsonl',
+                        help='File that results are appended to and compared against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Slowdown compared to the previous run that counts as a regression')
+    parser.add_argument('--strict', action='store_true',
+                        help='Exit with status 1 when there is a regression or a startup over budget')
+    parser.add_argument('--startup-budget', type=float, default=30,
+                        help='Milliseconds a new process may spend importing tvfile or printing --help, on top of starting python')
+    return parser
+
+
+def measure(func, repeat=5, number=1):
+    """Return the best time in seconds for one call of func"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = (time.perf_counter() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def make_style():
+    config = tvfile.configparser.ConfigParser()
+    config.read_string(STYLE)
+    return config['standard']
+
+
+@contextlib.contextmanager
+def isolated(server_url):
+    """Point tvfile at the stand-in api, with its own empty config directory"""
+    with tempfile.TemporaryDirectory() as config_dir:
+        with open(os.path.join(config_dir, 'styles.ini'), 'w') as fh:
+            fh.write('[config]\nstyle = standard\nrequests_per_second = 0\n' + STYLE)
+        paths = {'CONFIG_DIR': config_dir,
+                 'TOKEN_PATH': os.path.join(config_dir, 'token.txt'),
+                 'TOKEN_EXPIRY_PATH': os.path.join(config_dir, 'token_expiry.txt'),
+                 'CACHE_PATH': os.path.join(config_dir, 'cache.sqlite3'),
+                 'JOURNAL_PATH': os.path.join(config_dir, 'journal.jsonl')}
+        with patch.multiple(tvfile, API_URL=server_url, SESSION=None, TOKEN='', TOKEN_EXPIRES=None,
+                            RATE_LIMITER=None, JOURNAL=None, **paths):
+            tvfile.get_episode_info.cache_clear()
+            yield config_dir
+
+
+@contextlib.contextmanager
+def quiet():
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def run_main(argv, answers=('1',)):
+    """Run tvfile.main with the given command line, answering prompts from answers"""
+    with patch('sys.argv', ['tvfile'] + argv), \
+            patch('builtins.input', side_effect=list(answers) * 1000), quiet():
+        try:
+            tvfile.main()
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                raise
+
+
+def bench_search(results, sizes):
+    style = make_style()
+    for size in sizes:
+        episodes = make_episodes(1, size)
+        results['title_index[{}]'.format(size)] = measure(lambda: tvfile.TitleIndex(episodes).trigram_index(), repeat=3)
+        title_index = tvfile.TitleIndex(episodes)
+        query = tvfile.normalize_title(episodes[size // 2]['episodeName'])
+        typo = query[:2] + query[3:]
+        with patch('tvfile.select_choice', side_effect=lambda items: items[0]), quiet():
+            results['search_titles[{}]'.format(size)] = measure(
+                lambda: tvfile.search_titles(title_index, query), number=20)
+            results['search_titles_typo[{}]'.format(size)] = measure(
+                lambda: tvfile.search_titles(title_index, typo), number=20)
+        results['keyword_search[{}]'.format(size)] = measure(
+            lambda: tvfile.keyword_search('secret garden party', title_index), number=20)
+
+    titles = [episode['episodeName'] + ' ‘quoted’ – café' for episode in make_episodes(2, 1000)]
+    results['filter_ascii'] = measure(lambda: [tvfile.filter_ascii(title) for title in titles]) / len(titles)
+    results['build_filename'] = measure(
+        lambda: [tvfile.build_filename('Synthetic Show', '3', [title], ['7'], style) for title in titles]) / len(titles)
+    table = tvfile.EpisodeTable({'id': 2, 'seriesName': 'Synthetic Show'}, make_episodes(2, 1000))
+    groups = [[episode] for episode in table]
+    renderer = tvfile.StyleRenderer(style)
+    results['render_many'] = measure(lambda: renderer.render_many(table.name, groups)) / len(groups)
+
+
+def bench_fetch(results, sizes, latency, error_rate):
+    series = {'Synthetic Show {}'.format(size): size for size in sizes}
+    with FakeTvdb(series, latency=latency, error_rate=error_rate) as server, isolated(server.url), quiet():
+        tvfile.get_token()
+        for series_id, size in enumerate(sizes, 1):
+            results['get_all_episodes[{}]'.format(size)] = measure(
+                lambda: tvfile.get_all_episodes(series_id), repeat=3)
+
+
+def bench_sessions(results, size, num_files, latency, error_rate):
+    name = 'Synthetic Show'
+    with FakeTvdb({name: size}, latency=latency, error_rate=error_rate) as server, \
+            isolated(server.url), tempfile.TemporaryDirectory() as library:
+        episodes = make_episodes(1, size)
+        files = list()
+        for episode in episodes[:num_files]:
+            filename = 'synthetic.show.s{:02d}e{:02d}.720p.hdtv.x264-grp.mkv'.format(
+                episode['airedSeason'], episode['airedEpisodeNumber'])
+            path = os.path.join(library, filename)
+            open(path, 'w').close()
+            files.append(path)
+        plan_path = os.path.join(library, 'plan.json')
+
+        start = time.perf_counter()
+        run_main(['-s', name, '-r', '--plan', plan_path] + files)
+        results['session_plan_cold'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        run_main(['-s', name, '-r', '--plan', plan_path] + files)
+        results['session_plan_cached'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        run_main(['--apply', plan_path])
+        results['session_apply'] = time.perf_counter() - start
+
+        renamed = [os.path.join(library, filename) for filename in os.listdir(library) if filename.endswith('.mkv')]
+        start = time.perf_counter()
+        run_main(['-s', name, '-r', '--redo', '--no-cache'] + renamed)
+        results['session_interactive'] = time.perf_counter() - start
+
+        links = os.path.join(library, 'links')
+        os.mkdir(links)
+        start = time.perf_counter()
+        run_main(['-s', name, '-l', links, '--sync'] + renamed)
+        results['session_sync'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        run_main(['-s', name, '-l', links, '--sync'] + renamed)
+        results['session_sync_unchanged'] = time.perf_counter() - start
+
+
+def bench_startup(results, runs=10):
+    """Time new processes importing tvfile, printing --help and failing on a
+    bad style, the paths that scripts calling tvfile pay on every run. Return
+    the deferred modules that importing tvfile loaded anyway."""
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    # Measure with compiled bytecode cached, as an installed copy would have it
+    env = dict(os.environ, PYTHONPATH=project_dir)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    with tempfile.TemporaryDirectory() as home:
+        env['HOME'] = home
+        config_dir = os.path.join(home, '.config', 'tvfile')
+        os.makedirs(config_dir)
+        with open(os.path.join(config_dir, 'styles.ini'), 'w') as fh:
+            fh.write('[config]\nstyle = standard\n' + STYLE)
+        commands = {
+            'startup_python': ['-c', 'pass'],
+            'startup_import': ['-c', 'import tvfile'],
+            'startup_help': ['-m', 'tvfile', '--help'],
+            'startup_config_error': ['-m', 'tvfile', '--style', 'missing', '-s', 'x', home],
+        }
+        for name, argv in commands.items():
+            def run():
+                subprocess.run([sys.executable] + argv, env=env, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL, cwd=home)
+            run()
+            results[name] = measure(run, repeat=runs)
+
+        check = 'import sys, tvfile; print(" ".join(m for m in {!r} if m in sys.modules))'.format(DEFERRED_MODULES)
+        loaded = subprocess.check_output([sys.executable, '-c', check], env=env, cwd=home).decode().split()
+    return loaded
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_results(history_path):
+    try:
+        with open(history_path) as fh:
+            lines = [line for line in fh if line.strip()]
+    except FileNotFoundError:
+        return {}
+    return json.loads(lines[-1])['results'] if lines else {}
+
+
+def report(results, previous, threshold):
+    """Print every result next to the previous run. Return the names that got slower than the threshold allows."""
+    regressions = list()
+    for name, seconds in results.items():
+        line = '{:<32} {:>12.3f} ms'.format(name, seconds * 1000)
+        if name in previous and previous[name]:
+            change = seconds / previous[name] - 1
+            line += '  {:+7.1%}'.format(change)
+            if change > threshold:
+                line += '  REGRESSION'
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def main():
+    args = create_parser().parse_args()
+    sizes = QUICK_SIZES if args.quick else SIZES
+    results = dict()
+    loaded = bench_startup(results)
+    bench_search(results, sizes)
+    bench_fetch(results, sizes, args.latency, args.error_rate)
+    bench_sessions(results, sizes[-1] if args.quick else 1000, args.files, args.latency, args.error_rate)
+
+    regressions = report(results, previous_results(args.history), args.threshold)
+    for name in ('startup_import', 'startup_help'):
+        if (results[name] - results['startup_python']) * 1000 > args.startup_budget:
+            print('{} is over the startup budget of {:.0f} ms after starting python'.format(name, args.startup_budget))
+            regressions.append(name)
+    if loaded:
+        print('Importing tvfile loaded {}, which should wait for first use'.format(', '.join(loaded)))
+        regressions.append('startup_import')
+    with open(args.history, 'a') as fh:
+        fh.write(json.dumps({'time': int(time.time()), 'revision': git_revision(),
+                             'latency': args.latency, 'error_rate': args.error_rate,
+                             'results': results}) + '\n')
+    if regressions and args.strict:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
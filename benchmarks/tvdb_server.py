@@ -0,0 +1,240 @@
+"""A local stand-in for the TheTVDB.com v2 api, for benchmarks and tests.
+
+Serves /login, /refresh_token, /search/series, /series/{id}/episodes,
+/episodes/{id} and /updated/query for synthetic series of any size, with
+configurable latency and error rate.
+"""
+
+import base64
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+WORDS = ('the', 'a', 'of', 'and', 'night', 'house', 'secret', 'return', 'last', 'first',
+         'dinner', 'party', 'letter', 'wedding', 'storm', 'island', 'garden', 'stranger',
+         'promise', 'river', 'winter', 'summer', 'ghost', 'train', 'mirror', 'bridge',
+         'lesson', 'contest', 'parking', 'marine', 'biologist', 'soup', 'pen', 'chinese',
+         'restaurant', 'opera', 'subway', 'pez', 'dispenser', 'pilot', 'finale', 'reunion')
+
+PAGE_SIZE = 100
+
+
+def make_token(lifetime=24 * 60 * 60):
+    """Return an unsigned jwt that expires after lifetime seconds"""
+    def encode(part):
+        return base64.urlsafe_b64encode(json.dumps(part).encode()).rstrip(b'=').decode()
+    claims = {'exp': int(time.time()) + lifetime, 'id': 'tvfile-bench'}
+    return '{}.{}.{}'.format(encode({'alg': 'none', 'typ': 'JWT'}), encode(claims), 'sig')
+
+
+def make_episodes(series_id, count, seed=None, episodes_per_season=24):
+    """Return count synthetic episode records shaped like the tvdb's"""
+    rng = random.Random(series_id if seed is None else seed)
+    episodes = list()
+    for number in range(count):
+        season, episode = divmod(number, episodes_per_season)
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))).title()
+        episodes.append({
+            'id': series_id * 100000 + number,
+            'airedSeason': season + 1,
+            'airedSeasonID': series_id * 100 + season,
+            'airedEpisodeNumber': episode + 1,
+            'episodeName': '{} {}'.format(title, number) if rng.random() < 0.05 else title,
+            'firstAired': '2000-01-01',
+            'guestStars': ['Guest Star {}'.format(i) for i in range(rng.randint(0, 6))],
+            'directors': ['Director'],
+            'writers': ['Writer One', 'Writer Two'],
+            'overview': ' '.join(rng.choice(WORDS) for _ in range(40)),
+            'language': {'episodeName': 'en', 'overview': 'en'},
+            'productionCode': '',
+            'showUrl': '',
+            'lastUpdated': 1500000000 + number,
+            'dvdDiscid': '',
+            'dvdSeason': season + 1,
+            'dvdEpisodeNumber': episode + 1,
+            'dvdChapter': None,
+            'absoluteNumber': number + 1,
+            'filename': 'episodes/{}/{}.jpg'.format(series_id, number),
+            'seriesId': series_id,
+            'lastUpdatedBy': 1,
+            'airsAfterSeason': None,
+            'airsBeforeSeason': None,
+            'airsBeforeEpisode': None,
+            'imdbId': '',
+            'contentRating': 'TV-PG',
+            'thumbAuthor': 1,
+            'thumbAdded': '',
+            'thumbWidth': '640',
+            'thumbHeight': '360',
+            'siteRating': 7.5,
+            'siteRatingCount': 100,
+            'isMovie': 0,
+        })
+    return episodes
+
+
+class FakeTvdb:
+    """Run the stand-in api on a background thread. Use as a context manager,
+    and point tvfile.API_URL at the url attribute.
+
+    series maps series names to episode counts. Each request is delayed by
+    latency seconds, and fails with a 500 error with probability error_rate."""
+
+    def __init__(self, series=None, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens = set()
+        self.requests = list()
+        self.series = dict()
+        self.episodes = dict()
+        for position, (name, count) in enumerate((series or {}).items()):
+            self.add_series(name, count, series_id=position + 1)
+        self.server = None
+        self.thread = None
+
+    def add_series(self, name, count, series_id):
+        self.series[series_id] = {'id': series_id, 'seriesName': name, 'aliases': [],
+                                  'banner': '', 'firstAired': '2000-01-01', 'network': '',
+                                  'overview': '', 'slug': name.lower().replace(' ', '-'),
+                                  'status': 'Ended'}
+        self.episodes[series_id] = make_episodes(series_id, count)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, path_prefix):
+        """Return how many requests were made to paths starting with path_prefix"""
+        with self.lock:
+            return sum(1 for path in self.requests if path.startswith(path_prefix))
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def authorized(self):
+                header = self.headers.get('Authorization', '')
+                return header.startswith('Bearer ') and header[len('Bearer '):] in fake.tokens
+
+            def begin(self):
+                """Record the request, wait out the latency and maybe fail it. Return True to carry on."""
+                length = int(self.headers.get('Content-Length') or 0)
+                self.body = self.rfile.read(length) if length else b''
+                url = urlparse(self.path)
+                self.route = url.path
+                self.query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                with fake.lock:
+                    fake.requests.append(self.route)
+                    fail = fake.rng.random() < fake.error_rate
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fail:
+                    self.send_json(500, {'Error': 'Injected failure'})
+                    return False
+                return True
+
+            def issue_token(self):
+                token = make_token()
+                with fake.lock:
+                    fake.tokens.add(token)
+                self.send_json(200, {'token': token})
+
+            def do_POST(self):
+                if not self.begin():
+                    return
+                if self.route == '/login':
+                    self.issue_token()
+                else:
+                    self.send_json(404, {'Error': 'Not found'})
+
+            def do_GET(self):
+                if not self.begin():
+                    return
+                if not self.authorized():
+                    self.send_json(401, {'Error': 'Not authorized'})
+                    return
+                parts = self.route.strip('/').split('/')
+                if self.route == '/refresh_token':
+                    self.issue_token()
+                elif self.route == '/search/series':
+                    self.search_series()
+                elif len(parts) == 3 and parts[0] == 'series' and parts[2] == 'episodes':
+                    self.episode_page(int(parts[1]), int(self.query.get('page', 1)))
+                elif len(parts) == 2 and parts[0] == 'episodes':
+                    self.episode_info(int(parts[1]))
+                elif self.route == '/updated/query':
+                    self.send_json(200, {'data': None})
+                else:
+                    self.send_json(404, {'Error': 'Not found'})
+
+            def search_series(self):
+                name = self.query.get('name', '').lower()
+                matches = [series for series in fake.series.values()
+                           if name in series['seriesName'].lower()]
+                if matches:
+                    self.send_json(200, {'data': matches})
+                else:
+                    self.send_json(404, {'Error': 'Resource not found'})
+
+            def episode_page(self, series_id, page):
+                episodes = fake.episodes.get(series_id)
+                if episodes is None:
+                    self.send_json(404, {'Error': 'Resource not found'})
+                    return
+                last = max(1, -(-len(episodes) // PAGE_SIZE))
+                if page < 1 or page > last:
+                    self.send_json(404, {'Error': 'No results for your query'})
+                    return
+                links = {'first': 1, 'last': last,
+                         'next': page + 1 if page < last else None,
+                         'prev': page - 1 if page > 1 else None}
+                data = episodes[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+                self.send_json(200, {'links': links, 'data': data})
+
+            def episode_info(self, episode_id):
+                series_id, number = divmod(episode_id, 100000)
+                episodes = fake.episodes.get(series_id, [])
+                if number < len(episodes):
+                    self.send_json(200, {'data': episodes[number]})
+                else:
+                    self.send_json(404, {'Error': 'Resource not found'})
+
+        return Handler
@@ -1,11 +1,19 @@
 import tvfile
+from benchmarks.tvdb_server import FakeTvdb, make_token
 import requests
 import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import threading
+import configparser
 
 from requests.exceptions import RequestException, Timeout
 from requests import Response
 
-from unittest import TestCase
+from unittest import TestCase, skipUnless
 from unittest.mock import Mock, patch
 
 # Run tests from project directory with `python -m unittest tests`
@@ -44,19 +52,974 @@ class TvDataTests(TestCase):
         self.assertEqual(num_episodes, len(all_episodes_json))
         self.assertIn('episodeName', all_episodes_json[0])
 
-    @patch('tvfile.requests')
-    def test_get_episodes_success(self, mock_requests):
+    @patch('tvfile.try_query')
+    def test_get_all_episodes_keeps_page_order(self, mock_try_query):
+        """Pages fetched in parallel are merged in page order, even when later pages arrive first"""
+        def fake_query(query_func, series_id, page):
+            time.sleep((5 - page) * 0.01)
+            response = Mock(name='Mocked response for page {}'.format(page))
+            response.json.return_value = {'links': {'first': 1, 'last': 5},
+                                          'data': [{'id': page * 100 + i} for i in range(3)]}
+            return response
+        mock_try_query.side_effect = fake_query
+        all_episodes_json = tvfile.get_all_episodes('79169')
+        self.assertEqual(mock_try_query.call_count, 5)
+        ids = [episode['id'] for episode in all_episodes_json]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(ids), 15)
+
+    @patch('tvfile.get_session')
+    def test_get_episodes_success(self, mock_get_session):
         """get_episodes returns an unmodified response object"""
         response_mock = Mock(name='Mocked response from the tvdb api')
         response_mock.status_code = 200
+        response_mock.content = json.dumps(send_episodes('1')).encode()
         response_mock.json.return_value = send_episodes('1')
 
-        mock_requests.get.return_value = response_mock
+        mock_get_session.return_value.request.return_value = response_mock
         r = tvfile.get_episodes('79169')
         episodes_json = send_episodes('1')
         self.assertEqual(r.json(), episodes_json)
         self.assertIn('data', episodes_json)
 
+    def test_has_filename_fields(self):
+        """Episodes from the episode list have everything needed for a filename, unless a field is empty"""
+        episode = send_episodes('1')['data'][0]
+        self.assertTrue(tvfile.Episode(episode).has_filename_fields())
+        self.assertFalse(tvfile.Episode(dict(episode, episodeName=None)).has_filename_fields())
+
+
+class TitleIndexTests(TestCase):
+
+    def setUp(self):
+        self.episodes = send_episodes('1')['data'] + send_episodes('2')['data']
+        self.index = tvfile.TitleIndex(self.episodes)
+
+    def titles(self, ep_ids):
+        return [self.index.title(ep_id) for ep_id in ep_ids]
+
+    def test_phrase_search(self):
+        """Phrases match anywhere in a title, including partial first and last words"""
+        self.assertEqual(self.titles(self.index.phrase_search('the robbery')), ['The Robbery'])
+        self.assertIn('The Soup Nazi', self.titles(self.index.phrase_search('soup naz')))
+        self.assertEqual(self.index.phrase_search('no such episode'), [])
+
+    def test_keyword_search(self):
+        """Any whole word matches, each title is returned once and in episode order"""
+        matches = tvfile.keyword_search('robbery chronicles', self.index)
+        self.assertEqual(self.titles(matches), ['The Seinfeld Chronicles', 'The Robbery'])
+
+    def test_rank_tolerates_typos(self):
+        """A misspelled title still ranks the intended episode first"""
+        ranked = self.index.rank('seinfield chronicals')
+        self.assertEqual(self.titles([ranked[0][1]]), ['The Seinfeld Chronicles'])
+        scores = [score for score, ep_id in ranked]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+    @patch('tvfile.select_choice')
+    def test_search_titles_picks_clear_winner(self, mock_select_choice):
+        """An exact title is chosen without asking the user"""
+        chosen = tvfile.search_titles(self.index, 'the soup nazi')
+        self.assertEqual(self.titles([chosen]), ['The Soup Nazi'])
+        mock_select_choice.assert_not_called()
+
+    def test_fuzzy_matcher_distance(self):
+        """Distance counts the edits needed to find the pattern anywhere in the text"""
+        matcher = tvfile.FuzzyMatcher('soup nazi')
+        self.assertEqual(matcher.distance('the soup nazi'), 0)
+        self.assertEqual(matcher.distance('the sop nazi'), 1)
+        self.assertEqual(matcher.distance(''), len('soup nazi'))
+
+    def test_normalized_titles_map_to_ids(self):
+        """Normalized titles lead back to the episode id"""
+        episode = self.episodes[0]
+        self.assertEqual(self.index.ids[tvfile.normalize_title(episode['episodeName'])], episode['id'])
+
+
+class EpisodeTableTests(TestCase):
+
+    def setUp(self):
+        self.episodes = send_episodes('1')['data'] + send_episodes('2')['data']
+        self.table = tvfile.EpisodeTable({'id': 79169, 'seriesName': 'Seinfeld'}, self.episodes)
+
+    def test_lookups(self):
+        """Episodes are found by id, numbers and title"""
+        soup_nazi = self.table.by_title('the soup nazi!')
+        self.assertEqual(self.table[soup_nazi].name, 'The Soup Nazi')
+        self.assertEqual(self.table.by_number(7, 6), soup_nazi)
+        self.assertEqual(self.table.by_absolute(self.table[soup_nazi].absolute), soup_nazi)
+        self.assertIsNone(self.table.by_number(20, 1))
+        self.assertEqual(len(self.table), len(self.episodes))
+
+    def test_records_keep_only_used_fields(self):
+        """Overviews, credits and the rest of the json are not kept"""
+        episode = next(iter(self.table))
+        self.assertFalse(hasattr(episode, '__dict__'))
+        self.assertFalse(hasattr(episode, 'overview'))
+        self.assertTrue(episode.has_filename_fields())
+
+    def test_title_index_shares_the_records(self):
+        """The title index holds the ids and titles of the records, not copies"""
+        episode = next(iter(self.table))
+        title_index = self.table.title_index
+        self.assertIs(title_index.episode_ids[0], episode.id)
+        self.assertIs(title_index.title(episode.id), episode.name)
+
+    def test_search_maps_are_built_on_first_search(self):
+        """Exact lookups don't build the word and trigram maps, and titles added later are still found"""
+        title_index = self.table.title_index
+        self.table.by_title('the soup nazi')
+        self.assertIsNone(title_index.words)
+        self.assertIsNone(title_index.trigrams)
+        self.assertEqual(self.table[title_index.rank('the sop nazi')[0][1]].name, 'The Soup Nazi')
+        self.assertIsNotNone(title_index.trigrams)
+        self.table.extend([dict(self.episodes[0], id=1, episodeName='The Marble Rye')])
+        self.assertEqual(title_index.rank('marble ry')[0][1], 1)
+        self.assertIn(1, title_index.keyword_search('rye'))
+
+
+class StreamingTests(TestCase):
+
+    def setUp(self):
+        self.pages = [send_episodes('1')['data'], send_episodes('2')['data']]
+        self.release = threading.Event()
+
+    def slow_pages(self, error=None):
+        yield self.pages[0]
+        self.release.wait(5)
+        if error is not None:
+            raise error
+        yield self.pages[1]
+
+    def test_lookups_start_before_the_last_page(self):
+        """Episodes on the first page are found while the second is still on its way"""
+        table = tvfile.stream_series({'id': 79169, 'seriesName': 'Seinfeld'}, self.slow_pages())
+        first, last = self.pages[0][0], self.pages[1][-1]
+        self.assertEqual(table.by_title(first['episodeName']), first['id'])
+        self.assertFalse(table.complete)
+        threading.Timer(0.05, self.release.set).start()
+        # A miss waits for the remaining pages
+        self.assertEqual(table.by_number(last['airedSeason'], last['airedEpisodeNumber']), last['id'])
+        self.assertEqual(len(table), len(self.pages[0]) + len(self.pages[1]))
+
+    def test_failed_page_is_raised_by_lookup(self):
+        """A lookup that needed a page that couldn't be downloaded raises the error"""
+        table = tvfile.stream_series({'id': 79169, 'seriesName': 'Seinfeld'},
+                                     self.slow_pages(SystemExit('no episodes')))
+        self.release.set()
+        with self.assertRaises(SystemExit):
+            table.by_number(99, 1)
+
+    def test_pages_are_cached_after_the_last_one(self):
+        """Streamed pages arrive one by one and are cached as a whole"""
+        with tempfile.TemporaryDirectory() as tmpdir, FakeTvdb({'Synthetic Show': 250}) as server:
+            cache = tvfile.Cache(os.path.join(tmpdir, 'cache.sqlite3'))
+            server.tokens.add('test-token')
+            with patch.multiple(tvfile, API_URL=server.url, SESSION=None, TOKEN='test-token'):
+                pages = list(tvfile.load_episode_pages(1, cache))
+            self.assertEqual([len(page) for page in pages], [100, 100, 50])
+            self.assertEqual(len(cache.get_episodes(1)), 250)
+            cache.close()
+
+
+class FilenameTests(TestCase):
+
+    def setUp(self):
+        self.episodes = send_episodes('1')['data'] + send_episodes('2')['data']
+        self.title_index = tvfile.TitleIndex(self.episodes)
+        self.nums_ids = {'{}x{}'.format(ep['airedSeason'], ep['airedEpisodeNumber']): ep['id']
+                         for ep in self.episodes}
+        self.abs_ids = {ep['absoluteNumber']: ep['id'] for ep in self.episodes
+                        if ep['absoluteNumber'] is not None}
+
+    def guess(self, filename):
+        parsed = tvfile.parse_filename(filename, 'Seinfeld')
+        ep_ids, confidence = tvfile.guess_episodes(parsed, self.nums_ids, self.abs_ids, self.title_index)
+        return [self.title_index.title(ep_id) for ep_id in ep_ids], confidence
+
+    def test_parse_common_patterns(self):
+        """Season and episode numbers are found in the usual release formats"""
+        cases = {
+            'Seinfeld.S07E06.The.Soup.Nazi.720p.WEB-DL.x264-GRP.mkv': (7, [6], None, 'the soup nazi'),
+            'Seinfeld - 7x06 - The Soup Nazi.avi': (7, [6], None, 'the soup nazi'),
+            'seinfeld.706.hdtv-lol.mp4': (7, [6], 706, None),
+            'Seinfeld.S01E01E02.mkv': (1, [1, 2], None, None),
+            'Seinfeld 1x01-1x02.mkv': (1, [1, 2], None, None),
+            '[Group] Seinfeld - 05 [1080p].mkv': (None, [], 5, None),
+            'The Soup Nazi.mkv': (None, [], None, 'the soup nazi'),
+        }
+        for filename, expected in cases.items():
+            self.assertEqual(tvfile.parse_filename(filename, 'Seinfeld')[:4], expected, filename)
+
+    def test_numbers_after_the_episode(self):
+        """Audio channels and numeric titles aren't more episodes, repeated full numbers are"""
+        cases = {
+            'Seinfeld S05E02 5 1.mkv': (5, [2], None, '5 1'),
+            'Seinfeld.S03E10.2.0.mkv': (3, [10], None, '2 0'),
+            'Show S01E02 - 24 Hours.mkv': (1, [2], None, '24 hours'),
+            'show.s01e02-s01e03.mkv': (1, [2, 3], None, None),
+            'Show.1x02.1x03.mkv': (1, [2, 3], None, None),
+            'Show.S01E02 E03.mkv': (1, [2, 3], None, None),
+            'Show.S01E02-03.mkv': (1, [2, 3], None, None),
+        }
+        for filename, expected in cases.items():
+            self.assertEqual(tvfile.parse_filename(filename, 'Seinfeld')[:4], expected, filename)
+
+    def test_junk_is_ignored(self):
+        """Text given with --junk is removed before looking for the title"""
+        parsed = tvfile.parse_filename('Seinfeld S07E06 The Soup Nazi SiteName.mkv', junk=['sitename'])
+        self.assertEqual(parsed.title, 'the soup nazi')
+
+    def test_guess_numbers_and_title_agree(self):
+        """Matching numbers and title give full confidence"""
+        titles, confidence = self.guess('Seinfeld.S01E01.The.Seinfeld.Chronicles.mkv')
+        self.assertEqual(titles, ['The Seinfeld Chronicles'])
+        self.assertGreaterEqual(confidence, tvfile.AUTO_CONFIDENCE)
+
+    def test_guess_title_only(self):
+        """A filename with only a title is matched by title"""
+        titles, confidence = self.guess('Seinfeld - The Soup Nazi.mkv')
+        self.assertEqual(titles, ['The Soup Nazi'])
+        self.assertGreaterEqual(confidence, tvfile.AUTO_CONFIDENCE)
+
+    def test_guess_part_number_in_title(self):
+        """A bare number ending a title is read as part of it, not as an absolute episode"""
+        for filename, title in (('Seinfeld - The Boyfriend (2).mkv', 'The Boyfriend (2)'),
+                                ('The Boyfriend 2.mkv', 'The Boyfriend (2)'),
+                                ('The Raincoats (1).mkv', 'The Raincoats (1)')):
+            self.assertEqual(tvfile.parse_filename(filename, 'Seinfeld').title,
+                             tvfile.normalize_title(title).strip(), filename)
+            titles, confidence = self.guess(filename)
+            self.assertEqual(titles, [title], filename)
+        for filename in ('The Soup Nazi 2.mkv', 'The Pilot Part 2.mkv'):
+            titles, confidence = self.guess(filename)
+            self.assertNotEqual(titles, ['The Stake Out'], filename)
+            self.assertLess(confidence, tvfile.AUTO_CONFIDENCE, filename)
+
+    def test_guess_bare_number_alone(self):
+        """A bare number is trusted when nothing but the series name is left"""
+        titles, confidence = self.guess('Seinfeld - 02.mkv')
+        self.assertEqual(titles, ['The Stake Out'])
+        self.assertGreaterEqual(confidence, tvfile.AUTO_CONFIDENCE)
+
+    def test_guess_conflict_is_not_confident(self):
+        """Numbers pointing at a different episode than the title lower the confidence"""
+        titles, confidence = self.guess('Seinfeld.S01E01.The.Soup.Nazi.mkv')
+        self.assertLess(confidence, tvfile.AUTO_CONFIDENCE)
+
+
+def make_style():
+    config = configparser.ConfigParser()
+    config.read_string("""
+[standard]
+word_delim = ' '
+part_delim = ' - '
+caps = yes
+allow_chars = ,'!&$()
+""")
+    return config['standard']
+
+
+class StyleTests(TestCase):
+
+    def setUp(self):
+        self.table = tvfile.EpisodeTable({'id': 79169, 'seriesName': 'Seinfeld', 'firstAired': '1989-07-05'},
+                                         send_episodes('1')['data'] + send_episodes('2')['data'])
+        self.soup_nazi = self.table[self.table.by_number(7, 6)]
+
+    def renderer(self, **options):
+        section = dict(make_style())
+        section.update(options)
+        return tvfile.StyleRenderer(section)
+
+    def test_default_layout(self):
+        """Without a template filenames keep the series - SxxEyy - titles layout"""
+        self.assertEqual(tvfile.build_filename('Seinfeld', '7', ['The Soup Nazi'], ['6'], make_style()),
+                         'Seinfeld - S07E06 - The Soup Nazi')
+        renderer = self.renderer(word_delim='.', caps='no', allow_chars='')
+        self.assertEqual(renderer.render('Seinfeld: \u201cThe Show\u201d', [self.soup_nazi, self.soup_nazi]),
+                         'seinfeld.the.show - s07e06-e06 - the.soup.nazi - the.soup.nazi')
+
+    def test_template_fields(self):
+        """Templates can make folders and use the year and absolute numbers"""
+        renderer = self.renderer(template='{series} ({year})/Season {season}/{absolute:03d}{part}{titles}')
+        self.assertEqual(renderer.render_many(self.table.name, [[self.soup_nazi]], self.table.year),
+                         [os.path.join('Seinfeld (1989)', 'Season 7', '{:03d} - The Soup Nazi'.format(
+                             self.soup_nazi.absolute))])
+        with self.assertRaises(ValueError):
+            self.renderer(template='{series} {rating}')
+
+    def test_plan_creates_template_folders(self):
+        """A plan with targets in new folders creates them, and removes them when it fails"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sources = [os.path.join(tmpdir, name) for name in ('a.mkv', 'b.mkv')]
+            for path in sources:
+                open(path, 'w').close()
+            batch = tvfile.RenameBatch()
+            batch.add('rename', sources[0], os.path.join(tmpdir, 'Season 7', 'x.mkv'))
+            batch.add('rename', sources[1], os.path.join(tmpdir, 'Season 8', 'y.mkv'))
+            self.assertEqual(batch.problems(), [])
+            os.remove(sources[1])
+            with patch('builtins.print'):
+                self.assertFalse(batch.run())
+            self.assertEqual(os.listdir(tmpdir), ['a.mkv'])
+            open(sources[1], 'w').close()
+            self.assertTrue(batch.run())
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, 'Season 8', 'y.mkv')))
+
+
+class SyncTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.downloads = os.path.join(self.tmpdir.name, 'downloads')
+        self.library = os.path.join(self.tmpdir.name, 'library')
+        os.mkdir(self.downloads)
+        os.mkdir(self.library)
+        self.files = list()
+        for name in ('Seinfeld.S07E06.mkv', 'Seinfeld.S01E01.mkv', 'holiday video.mkv'):
+            path = os.path.join(self.downloads, name)
+            open(path, 'w').close()
+            self.files.append(path)
+        episodes = send_episodes('1')['data'] + send_episodes('2')['data']
+        self.series = tvfile.index_series({'id': 79169, 'seriesName': 'Seinfeld'}, episodes)
+        tvfile.args = tvfile.create_parser().parse_args(['-s', 'seinfeld', '-l', self.library, '--sync'] + self.files)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def sync(self, style=None):
+        with patch('builtins.print'):
+            self.assertTrue(tvfile.sync_links(self.series, self.files, style or make_style(), 1, self.library))
+        return tvfile.LinkIndex(self.library)
+
+    def test_sync_only_changes_differences(self):
+        """Links are made once, renamed with the style and removed with their file"""
+        index = self.sync()
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.get(self.files[0]), [os.path.join(self.library, 'Seinfeld - S07E06 - The Soup Nazi.mkv')])
+
+        with patch('tvfile.RenameBatch.run', side_effect=AssertionError('changed')):
+            self.sync()
+
+        style = dict(make_style())
+        style['template'] = 'Season {season}/{sxe}'
+        index = self.sync(style)
+        self.assertEqual(index.get(self.files[0]), [os.path.join(self.library, 'Season 7', 'S07E06.mkv')])
+        self.assertEqual(len(index), 2)
+
+        os.remove(self.files[0])
+        self.files = self.files[1:]
+        index = self.sync(style)
+        self.assertEqual(len(index), 1)
+        self.assertEqual(sorted(os.listdir(self.library)), ['Season 1'])
+
+    def test_sync_keeps_links_it_does_not_own(self):
+        """Links into other folders, or into a folder that is gone, survive a sync"""
+        other = os.path.join(self.tmpdir.name, 'other')
+        os.mkdir(other)
+        foreign = os.path.join(self.library, 'foreign.mkv')
+        unmounted = os.path.join(self.library, 'unmounted.mkv')
+        os.symlink(os.path.join(other, 'deleted.mkv'), foreign)
+        os.symlink(os.path.join(self.tmpdir.name, 'drive', 'episode.mkv'), unmounted)
+        self.sync()
+        self.assertTrue(os.path.islink(foreign))
+        self.assertTrue(os.path.islink(unmounted))
+
+    def test_sync_skips_taken_names(self):
+        """A second download of an episode is left out instead of stopping the sync"""
+        second = os.path.join(self.downloads, 'Seinfeld.S07E06.PROPER.mkv')
+        open(second, 'w').close()
+        self.files.append(second)
+        index = self.sync()
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.get(second), [])
+        self.assertEqual(len(index.get(self.files[0])), 1)
+
+
+class AssignTests(TestCase):
+
+    def setUp(self):
+        episodes = send_episodes('1')['data'] + send_episodes('2')['data']
+        self.series = tvfile.index_series({'id': 79169, 'seriesName': 'Seinfeld'}, episodes)
+        tvfile.args = tvfile.create_parser().parse_args(['-s', 'seinfeld', '-r', '--assign', '1'])
+        self.files = ['/downloads/track {}.mkv'.format(number) for number in (10, 2, 1, 4, 3)]
+
+    def numbers(self, assignments):
+        return [[self.series[ep_id].position('aired') for ep_id in episode_ids]
+                for filepath, episode_ids in assignments]
+
+    def test_parse_episode_range(self):
+        """Seasons, first episodes and ranges are understood, anything else is refused"""
+        self.assertEqual(tvfile.parse_episode_range('3'), ((3, 0), (3, float('inf'))))
+        self.assertEqual(tvfile.parse_episode_range('3x5'), ((3, 5), None))
+        self.assertEqual(tvfile.parse_episode_range('3x1-3x24'), ((3, 1), (3, 24)))
+        self.assertEqual(tvfile.parse_episode_range('S03E01-E24'), ((3, 1), (3, 24)))
+        self.assertEqual(tvfile.parse_episode_range('25-48', 'absolute'), ((25,), (48,)))
+        for text, order in (('3x', 'aired'), ('3x1-', 'dvd'), ('3x1', 'absolute')):
+            with self.assertRaises(ValueError):
+                tvfile.parse_episode_range(text, order)
+
+    def test_files_follow_dvd_order(self):
+        """Naturally sorted files get the episodes of a season in dvd order"""
+        assignments, problems = tvfile.assign_episodes(self.series, self.files, '1', 'dvd')
+        self.assertEqual(problems, [])
+        self.assertEqual([os.path.basename(path) for path, _ in assignments],
+                         ['track 1.mkv', 'track 2.mkv', 'track 3.mkv', 'track 4.mkv', 'track 10.mkv'])
+        self.assertEqual(self.numbers(assignments), [[(1, 1)], [(1, 4)], [(1, 2)], [(1, 3)], [(1, 5)]])
+        assignments, problems = tvfile.assign_episodes(self.series, self.files[:2], '3x8', 'aired', per_file=2)
+        self.assertEqual(self.numbers(assignments), [[(3, 8), (3, 9)], [(3, 10), (3, 11)]])
+
+    @patch('builtins.print')
+    def test_mismatch_exits_without_resume_hint(self, mock_print):
+        """A plan that can't be assigned exits before touching anything, without offering to resume"""
+        with patch('tvfile.JOURNAL', Mock()), self.assertRaises(SystemExit) as exit:
+            tvfile.assign_plan(self.series, self.files[:4], make_style(), 1, '1')
+        self.assertEqual(exit.exception.code, 1)
+        printed = ' '.join(str(call) for call in mock_print.call_args_list)
+        self.assertNotIn('resume', printed)
+
+    def test_mismatches_are_reported(self):
+        """Too few files for the range and files holding two episodes are problems"""
+        files = self.files[:4] + ['/downloads/Seinfeld.S01E05E06.mkv']
+        assignments, problems = tvfile.assign_episodes(self.series, files[1:], '1')
+        self.assertEqual(len(problems), 2)
+        _, problems = tvfile.assign_episodes(self.series, self.files, '1-5', 'absolute')
+        self.assertEqual(problems, [])
+
+
+class PlanTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.files = list()
+        for name in ('Seinfeld.S07E06.mkv', 'holiday video.mkv'):
+            path = os.path.join(self.tmpdir.name, name)
+            open(path, 'w').close()
+            self.files.append(path)
+        episodes = send_episodes('1')['data'] + send_episodes('2')['data']
+        self.series = tvfile.index_series({'id': 79169, 'seriesName': 'Seinfeld'}, episodes)
+        tvfile.args = tvfile.create_parser().parse_args(['-s', 'seinfeld', '-r'] + self.files)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_plan_and_apply(self):
+        """Detected files get a target, others don't, and applying renames only the detected ones"""
+        plan = tvfile.make_plan(self.series, self.files, make_style(), 1)
+        self.assertEqual(plan[0]['target'], os.path.join(self.tmpdir.name, 'Seinfeld - S07E06 - The Soup Nazi.mkv'))
+        self.assertIsNone(plan[1]['target'])
+
+        for plan_name in ('plan.json', 'plan.csv'):
+            plan_path = os.path.join(self.tmpdir.name, plan_name)
+            tvfile.write_plan(plan_path, plan)
+            self.assertEqual(tvfile.read_plan(plan_path)[0]['target'], plan[0]['target'])
+
+        tvfile.apply_plan(tvfile.read_plan(plan_path))
+        self.assertTrue(os.path.exists(plan[0]['target']))
+        self.assertFalse(os.path.exists(self.files[0]))
+        self.assertTrue(os.path.exists(self.files[1]))
+
+    @patch('builtins.print')
+    def test_done_files_are_reported(self, mock_print):
+        """Applying a plan again says which files were already done instead of skipping them silently"""
+        journal = tvfile.Journal(os.path.join(self.tmpdir.name, 'journal.jsonl'))
+        library = os.path.join(self.tmpdir.name, 'library')
+        os.mkdir(library)
+        tvfile.args = tvfile.create_parser().parse_args(['-s', 'seinfeld', '-l', library] + self.files)
+        for action in ('symlink', 'rename'):
+            plan = tvfile.make_plan(self.series, self.files[:1], make_style(), 1)
+            self.assertEqual(plan[0]['action'], action)
+            tvfile.apply_plan(plan, journal)
+            mock_print.reset_mock()
+            tvfile.apply_plan(plan, journal)
+            printed = ' '.join(str(call) for call in mock_print.call_args_list)
+            self.assertIn('Skipping ' + self.files[0], printed)
+            if action == 'symlink':
+                self.assertIn('--redo', printed)
+            tvfile.args = tvfile.create_parser().parse_args(['-s', 'seinfeld', '-r'] + self.files)
+
+    @patch('tvfile.prompt_user', side_effect=AssertionError('prompted'))
+    def test_rename_interactively_without_prompts(self, mock_prompt_user):
+        """Detected files are renamed in the background and journaled, without asking"""
+        journal_path = os.path.join(self.tmpdir.name, 'journal.jsonl')
+        with patch('tvfile.JOURNAL', tvfile.Journal(journal_path)):
+            tvfile.rename_interactively(self.series, self.files[:1], make_style(), 1)
+        target = os.path.join(self.tmpdir.name, 'Seinfeld - S07E06 - The Soup Nazi.mkv')
+        self.assertTrue(os.path.exists(target))
+        self.assertTrue(tvfile.Journal(journal_path).is_done(target))
+
+    def test_failed_move_stops_before_next_prompt(self):
+        """Once a queued move fails, the user isn't asked about the next file"""
+        moved = threading.Event()
+        prepare_file = tvfile.prepare_file
+
+        def failing_move(*args):
+            moved.set()
+            return False
+
+        def prepare_after_move(series, filepath, *args):
+            # Prepare the file that needs a prompt only after the first move failed
+            if filepath == self.files[1]:
+                moved.wait(5)
+                time.sleep(0.1)
+            return prepare_file(series, filepath, *args)
+
+        with patch('tvfile.journaled_move', side_effect=failing_move), \
+                patch('tvfile.prepare_file', side_effect=prepare_after_move), \
+                patch('tvfile.prompt_user', side_effect=AssertionError('prompted')), \
+                patch('tvfile.JOURNAL', None), patch('builtins.print'), \
+                self.assertRaises(SystemExit):
+            tvfile.rename_interactively(self.series, self.files, make_style(), 1)
+        self.assertTrue(os.path.exists(self.files[1]))
+
+
+class RenameBatchTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.sources = list()
+        for name in ('a.mkv', 'b.mkv', 'c.mkv'):
+            path = self.path(name)
+            open(path, 'w').close()
+            self.sources.append(path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def test_collisions_are_found_before_anything_runs(self):
+        """Targets that exist or are shared by several files are reported"""
+        batch = tvfile.RenameBatch()
+        batch.add('rename', self.sources[0], self.path('x.mkv'))
+        batch.add('rename', self.sources[1], self.path('x.mkv'))
+        open(self.path('d.mkv'), 'w').close()
+        batch.add('rename', self.sources[2], self.path('d.mkv'))
+        batch.add('rename', self.path('missing.mkv'), self.path('y.mkv'))
+        self.assertEqual(len(batch.problems()), 4)
+
+    def test_swap_and_chain(self):
+        """Files can take the names of files that are renamed in the same batch"""
+        for name in ('a.mkv', 'b.mkv', 'c.mkv'):
+            with open(self.path(name), 'w') as fh:
+                fh.write(name)
+        journal = tvfile.Journal(self.path('journal.jsonl'))
+        batch = tvfile.RenameBatch(journal)
+        # Swap a and b, and move c along to d
+        batch.add('rename', self.sources[0], self.sources[1])
+        batch.add('rename', self.sources[1], self.sources[0])
+        batch.add('rename', self.sources[2], self.path('d.mkv'))
+        self.assertEqual(batch.problems(), [])
+        self.assertTrue(batch.run())
+        contents = dict()
+        for name in ('a.mkv', 'b.mkv', 'd.mkv'):
+            with open(self.path(name)) as fh:
+                contents[name] = fh.read()
+        self.assertEqual(contents, {'a.mkv': 'b.mkv', 'b.mkv': 'a.mkv', 'd.mkv': 'c.mkv'})
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)),
+                         ['a.mkv', 'b.mkv', 'd.mkv', 'journal.jsonl'])
+        self.assertTrue(journal.is_done(self.sources[0], 'rename'))
+
+    def test_failed_swap_is_rolled_back(self):
+        """Files moved to temporary names get their own names back when a batch fails"""
+        batch = tvfile.RenameBatch()
+        batch.add('rename', self.sources[0], self.sources[1])
+        batch.add('rename', self.sources[1], self.sources[0])
+        batch.add('rename', self.sources[2], self.path('z.mkv'))
+        self.assertEqual(batch.problems(), [])
+        os.remove(self.sources[2])
+        with patch('builtins.print'):
+            self.assertFalse(batch.run())
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), ['a.mkv', 'b.mkv'])
+
+    def test_unlinks_run_first(self):
+        """A link can take the name of one removed in the same batch, in whatever order they were added"""
+        link = self.path('link.mkv')
+        os.symlink(self.sources[0], link)
+        batch = tvfile.RenameBatch()
+        batch.add('symlink', self.sources[1], link)
+        batch.add('unlink', self.sources[0], link)
+        self.assertEqual(batch.problems(), [])
+        self.assertTrue(batch.run())
+        self.assertEqual(os.readlink(link), self.sources[1])
+
+    def test_failed_batch_is_rolled_back(self):
+        """When one operation fails, the ones before it are undone"""
+        batch = tvfile.RenameBatch()
+        batch.add('rename', self.sources[0], self.path('x.mkv'))
+        batch.add('symlink', self.sources[1], self.path('link.mkv'))
+        batch.add('rename', self.sources[2], self.path('z.mkv'))
+        self.assertEqual(batch.problems(), [])
+        os.remove(self.sources[2])
+        with patch('builtins.print'):
+            self.assertFalse(batch.run())
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), ['a.mkv', 'b.mkv'])
+
+    def test_finished_batch_is_journaled(self):
+        """Every operation of a finished batch is recorded in the journal at once"""
+        journal = tvfile.Journal(self.path('journal.jsonl'))
+        batch = tvfile.RenameBatch(journal)
+        batch.add('rename', self.sources[0], self.path('x.mkv'))
+        batch.add('symlink', self.sources[1], self.path('link.mkv'))
+        self.assertTrue(batch.run())
+        self.assertTrue(os.path.islink(self.path('link.mkv')))
+        reloaded = tvfile.Journal(self.path('journal.jsonl'))
+        self.assertTrue(reloaded.is_done(self.path('x.mkv')))
+        self.assertTrue(reloaded.is_done(self.sources[1]))
+
+    def test_move_file_does_not_overwrite(self):
+        """Renaming onto an existing file fails and leaves both files alone"""
+        with patch('builtins.print'):
+            self.assertFalse(tvfile.move_file('rename', self.sources[0], self.sources[1]))
+        self.assertTrue(os.path.exists(self.sources[0]))
+
+
+class JournalTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.journal_path = os.path.join(self.tmpdir.name, 'journal.jsonl')
+        self.source = os.path.join(self.tmpdir.name, 'episode.mkv')
+        self.target = os.path.join(self.tmpdir.name, 'Show - S01E01 - Pilot.mkv')
+        with open(self.source, 'w') as fh:
+            fh.write('video')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_renamed_file_is_done_after_reload(self):
+        """A renamed file is recognised as done under its new name, also by the next run"""
+        journal = tvfile.Journal(self.journal_path)
+        self.assertFalse(journal.is_done(self.source))
+        self.assertTrue(tvfile.journaled_move(journal, 'rename', self.source, self.target))
+        self.assertTrue(journal.is_done(self.target))
+        journal.flush()
+        self.assertTrue(tvfile.Journal(self.journal_path).is_done(self.target))
+
+    @patch('tvfile.prompt_user', side_effect=AssertionError('prompted'))
+    def test_other_destinations_are_not_done(self, mock_prompt_user):
+        """Linking into one library doesn't stop linking into another, or renaming"""
+        source = os.path.join(self.tmpdir.name, 'Seinfeld.S07E06.mkv')
+        os.rename(self.source, source)
+        episodes = send_episodes('1')['data'] + send_episodes('2')['data']
+        series = tvfile.index_series({'id': 79169, 'seriesName': 'Seinfeld'}, episodes)
+        new_name = 'Seinfeld - S07E06 - The Soup Nazi.mkv'
+        with patch('tvfile.JOURNAL', tvfile.Journal(self.journal_path)), patch('builtins.print'):
+            for library in ('libA', 'libB'):
+                os.mkdir(os.path.join(self.tmpdir.name, library))
+                tvfile.args = tvfile.create_parser().parse_args(['-s', 'seinfeld', '-l', library, source])
+                tvfile.rename_interactively(series, [source], make_style(), 1,
+                                            os.path.join(self.tmpdir.name, library), False)
+                self.assertTrue(os.path.islink(os.path.join(self.tmpdir.name, library, new_name)))
+            tvfile.rename_interactively(series, [source], make_style(), 1, None, True)
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpdir.name, new_name)))
+
+    def test_torn_lines_are_ignored(self):
+        """A line left half written by a crash doesn't stop the journal from loading"""
+        journal = tvfile.Journal(self.journal_path)
+        tvfile.journaled_move(journal, 'symlink', self.source, self.target)
+        journal.flush()
+        with open(self.journal_path, 'a') as fh:
+            fh.write('{"key": [1, 2')
+        self.assertTrue(tvfile.Journal(self.journal_path).is_done(self.source))
+
+
+class SessionTests(TestCase):
+
+    def setUp(self):
+        self.saved = tvfile.SESSION, tvfile.TOKEN
+        tvfile.SESSION = None
+
+    def tearDown(self):
+        tvfile.SESSION, tvfile.TOKEN = self.saved
+
+    def test_session_is_shared(self):
+        """Every call gets the same session, with the current token installed"""
+        tvfile.TOKEN = 'first'
+        session = tvfile.get_session()
+        self.assertIs(tvfile.get_session(), session)
+        self.assertEqual(session.headers['Authorization'], 'Bearer first')
+
+    def test_load_token_swaps_header(self):
+        """Loading a new token updates the header of the existing session in place"""
+        session = tvfile.get_session()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            token_path = os.path.join(tmpdir, 'token.txt')
+            with open(token_path, 'w') as fh:
+                fh.write('second')
+            with patch('tvfile.TOKEN_PATH', token_path):
+                tvfile.load_token()
+        self.assertEqual(session.headers['Authorization'], 'Bearer second')
+
+    def test_rate_limiter_spaces_requests(self):
+        """Requests beyond the rate have to wait their turn"""
+        limiter = tvfile.RateLimiter(50)
+        start = time.monotonic()
+        for i in range(6):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+
+class TokenTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.patcher = patch.multiple(
+            tvfile, TOKEN='', TOKEN_EXPIRES=None, SESSION=None,
+            TOKEN_PATH=os.path.join(self.tmpdir.name, 'token.txt'),
+            TOKEN_EXPIRY_PATH=os.path.join(self.tmpdir.name, 'token_expiry.txt'))
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.tmpdir.cleanup()
+
+    def test_expiry_is_saved_with_token(self):
+        """The expiry decoded from a saved token is loaded with it"""
+        token = make_token(3600)
+        response = Mock()
+        response.json.return_value = {'token': token}
+        tvfile.save_token(response)
+        tvfile.load_token()
+        self.assertEqual(tvfile.TOKEN, token)
+        self.assertEqual(tvfile.TOKEN_EXPIRES, tvfile.decode_token_expiry(token))
+        self.assertAlmostEqual(tvfile.TOKEN_EXPIRES, time.time() + 3600, delta=5)
+        self.assertIsNone(tvfile.decode_token_expiry('not a jwt'))
+
+    @patch('tvfile.get_token')
+    def test_expired_token_is_replaced_before_sending(self, mock_get_token):
+        """An expired token is renewed up front instead of after a 401"""
+        with patch.multiple(tvfile, TOKEN=make_token(-60), TOKEN_EXPIRES=int(time.time()) - 60):
+            tvfile.ensure_token()
+        mock_get_token.assert_called_once()
+
+    def test_token_is_refreshed_in_background(self):
+        """A token that expires soon is swapped for a fresh one without asking for it"""
+        with FakeTvdb() as server:
+            old_token = make_token(3600)
+            server.tokens.add(old_token)
+            with patch.multiple(tvfile, API_URL=server.url, TOKEN=old_token,
+                                TOKEN_EXPIRES=tvfile.decode_token_expiry(old_token)):
+                tvfile.start_token_refresh().join()
+                self.assertNotEqual(tvfile.TOKEN, old_token)
+                self.assertGreater(tvfile.TOKEN_EXPIRES, time.time() + 12 * 60 * 60)
+                self.assertIsNone(tvfile.start_token_refresh())
+            self.assertEqual(server.count('/login'), 0)
+
+
+class BatchTests(TestCase):
+
+    def setUp(self):
+        self.series_list = [{'id': 79169, 'seriesName': 'Seinfeld'},
+                            {'id': 1, 'seriesName': 'Seinfeld: The Making Of'}]
+
+    def test_pick_series(self):
+        """The exact name or the given id is picked, otherwise the user has to choose"""
+        self.assertEqual(tvfile.pick_series(self.series_list, 'seinfeld')['id'], 79169)
+        self.assertEqual(tvfile.pick_series(self.series_list, 'seinfeld', series_id=1)['id'], 1)
+        self.assertIsNone(tvfile.pick_series(self.series_list, 'sein'))
+
+    def test_read_manifest(self):
+        """Each section becomes a job with its files expanded"""
+        tvfile.args = tvfile.create_parser().parse_args(['--manifest', 'unused', '-r'])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ('a.mkv', 'b.mkv', 'c.avi'):
+                open(os.path.join(tmpdir, name), 'w').close()
+            manifest_path = os.path.join(tmpdir, 'manifest.ini')
+            with open(manifest_path, 'w') as fh:
+                fh.write('[seinfeld]\nfiles = {0}/*.mkv\n    {0}/*.avi\nseries_id = 79169\n'
+                         '[frasier]\nfiles = {0}/*.avi\nsymlinks = {0}\n'.format(tmpdir))
+            jobs = tvfile.read_manifest(manifest_path)
+        self.assertEqual([job['search'] for job in jobs], ['seinfeld', 'frasier'])
+        self.assertEqual([os.path.basename(path) for path in jobs[0]['files']], ['a.mkv', 'b.mkv', 'c.avi'])
+        self.assertEqual(jobs[0]['series_id'], 79169)
+        self.assertTrue(jobs[0]['rename'])
+        self.assertFalse(jobs[1]['rename'])
+        self.assertEqual(jobs[1]['symlinks'], tmpdir)
+
+
+class WatchTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        tvfile.args = tvfile.create_parser().parse_args(['-s', 'seinfeld', '-r', '--watch', self.tmpdir.name])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def write(self, name, content='x'):
+        with open(self.path(name), 'w') as fh:
+            fh.write(content)
+        return self.path(name)
+
+    def test_debouncer_waits_for_writes_to_stop(self):
+        """A file is ready once it stays unchanged for the settle time, and at once when moved into place"""
+        path = self.write('a.mkv')
+        debouncer = tvfile.Debouncer(settle=2)
+        debouncer.touch(path, now=100)
+        self.assertEqual(debouncer.settled(now=101), [])
+        self.write('a.mkv', 'still downloading')
+        self.assertEqual(debouncer.settled(now=102), [])
+        self.assertEqual(debouncer.timeout(now=102), 2)
+        self.assertEqual(debouncer.settled(now=104), [path])
+        debouncer.touch(path, finished=True, now=105)
+        self.assertEqual(debouncer.settled(now=105), [path])
+
+    def test_polling_watcher_reports_changes(self):
+        """Files already there and new files are reported once"""
+        old = self.write('old.mkv')
+        watcher = tvfile.PollingWatcher([self.tmpdir.name], interval=0)
+        self.assertEqual(watcher.read(), [(old, False)])
+        new = self.write('new.mkv')
+        self.assertEqual(watcher.read(), [(new, False)])
+        self.assertEqual(watcher.read(), [])
+
+    @skipUnless(sys.platform.startswith('linux'), 'inotify is only on linux')
+    def test_inotify_watches_new_directories(self):
+        """Files moved into a new subdirectory are reported as finished"""
+        old = self.write('old.mkv')
+        watcher = tvfile.Inotify([self.tmpdir.name])
+        try:
+            self.assertEqual(watcher.read(0), [(old, False)])
+            os.mkdir(self.path('season 7'))
+            self.assertEqual(watcher.read(1), [])
+            with tempfile.TemporaryDirectory(dir=self.tmpdir.name) as incomplete:
+                partial = os.path.join(incomplete, 'e06.mkv')
+                open(partial, 'w').close()
+                watcher.read(1)
+                os.rename(partial, self.path(os.path.join('season 7', 'e06.mkv')))
+            changes = watcher.read(1)
+        finally:
+            watcher.close()
+        self.assertIn((self.path(os.path.join('season 7', 'e06.mkv')), True), changes)
+
+    @patch('tvfile.WATCH_SETTLE', 0.05)
+    def test_watch_renames_settled_files(self):
+        """Detected files are renamed once they settle, the rest are left alone"""
+        episodes = send_episodes('1')['data'] + send_episodes('2')['data']
+        job = {'search': 'seinfeld', 'watch': [self.tmpdir.name], 'symlinks': None, 'rename': True}
+        jobs = [tvfile.watch_job(job, {'id': 79169, 'seriesName': 'Seinfeld'}, episodes)]
+        self.write('holiday video.mkv')
+        stop = threading.Event()
+        watcher = tvfile.PollingWatcher([self.tmpdir.name], interval=0.02)
+        with patch('tvfile.JOURNAL', tvfile.Journal(self.path('journal.jsonl'))), patch('builtins.print'):
+            thread = threading.Thread(target=tvfile.watch, args=(jobs, make_style(), 1, watcher, stop))
+            thread.start()
+            self.write('Seinfeld.S07E06.mkv.part')
+            os.rename(self.path('Seinfeld.S07E06.mkv.part'), self.path('Seinfeld.S07E06.mkv'))
+            target = self.path('Seinfeld - S07E06 - The Soup Nazi.mkv')
+            deadline = time.monotonic() + 5
+            while not os.path.exists(target) and time.monotonic() < deadline:
+                time.sleep(0.02)
+            stop.set()
+            thread.join()
+        self.assertTrue(os.path.exists(target))
+        self.assertTrue(os.path.exists(self.path('holiday video.mkv')))
+
+
+class FakeTvdbTests(TestCase):
+
+    def test_get_all_episodes_over_http(self):
+        """All pages of a series come back from the stand-in api in order"""
+        with FakeTvdb({'Synthetic Show': 250}) as server:
+            server.tokens.add('test-token')
+            with patch.multiple(tvfile, API_URL=server.url, SESSION=None, TOKEN='test-token'):
+                episodes = tvfile.get_all_episodes(1)
+            self.assertEqual(server.count('/series/1/episodes'), 3)
+        self.assertEqual(len(episodes), 250)
+        self.assertEqual([ep['absoluteNumber'] for ep in episodes], list(range(1, 251)))
+
+
+class StartupTests(TestCase):
+
+    def test_import_defers_heavy_modules(self):
+        """Importing tvfile doesn't load requests, sqlite3 or the thread pools"""
+        code = ("import sys, tvfile; "
+                "print(' '.join(m for m in ('requests', 'sqlite3', 'csv', 'concurrent.futures') "
+                "if m in sys.modules))")
+        loaded = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE,
+                                universal_newlines=True, check=True).stdout.split()
+        self.assertEqual(loaded, [])
+
+
+class StatsTests(TestCase):
+
+    def test_requests_are_traced(self):
+        """Each request is counted under its endpoint and written to the trace"""
+        stats = tvfile.Stats()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            trace_path = os.path.join(tmpdir, 'trace.jsonl')
+            stats.open_trace(trace_path)
+            with FakeTvdb({'Synthetic Show': 250}) as server:
+                server.tokens.add('test-token')
+                with patch.multiple(tvfile, API_URL=server.url, SESSION=None, TOKEN='test-token',
+                                    STATS=stats):
+                    tvfile.get_all_episodes(1)
+            stats.close()
+            with open(trace_path) as fh:
+                events = [json.loads(line) for line in fh]
+        self.assertEqual(stats.requests['GET /series/{id}/episodes'][0], 3)
+        self.assertEqual(len(events), 3)
+        self.assertEqual({event['status'] for event in events}, {200})
+        self.assertTrue(all(event['bytes'] > 0 for event in events))
+
+    def test_retries_are_counted(self):
+        """A retried query counts one retry"""
+        stats = tvfile.Stats()
+        query = Mock(side_effect=[make_response(500), make_response(200)])
+        with patch('tvfile.STATS', stats), patch('tvfile.time.sleep'), patch('tvfile.TOKEN', 'test-token'):
+            tvfile.try_query(query)
+        self.assertEqual(stats.count('retry'), 1)
+        self.assertTrue(stats.summary()[1].endswith('1 retries, 0 token refreshes'))
+
+
+class OfflineTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = tvfile.OfflineStore(os.path.join(self.tmpdir.name, 'offline.sqlite3'))
+        with patch('builtins.print'):
+            tvfile.import_dumps('tests/data', self.store)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmpdir.cleanup()
+
+    def test_find_series_by_any_word(self):
+        """Imported series are found from the start of any word in their name"""
+        self.assertEqual([series['id'] for series in self.store.find_series('Seinfeld')], [79169])
+        self.assertEqual(len(self.store.find_series('sein')), 1)
+        self.assertEqual(self.store.find_series('friends'), [])
+
+    def test_lookups_match_the_pages(self):
+        """The episodes of an imported series come back complete, and each one by id"""
+        episodes = send_episodes('1')['data'] + send_episodes('2')['data']
+        self.assertEqual(self.store.get_episodes(79169), tvfile.read_dumps('tests/data')[0][1])
+        self.assertEqual(self.store.get_episode(episodes[5]['id']), episodes[5])
+        self.assertIsNone(self.store.get_episodes(1))
+
+    def test_export_then_import(self):
+        """An exported dump reads back as the same series and episodes"""
+        series_data, episode_list = tvfile.read_dumps('tests/data')[0]
+        dump_dir = os.path.join(self.tmpdir.name, 'dump')
+        self.assertEqual(tvfile.export_dump(dump_dir, series_data, episode_list), 2)
+        self.assertTrue(os.path.exists(os.path.join(dump_dir, 'seinfeld-episodes-page-2.json')))
+        self.assertEqual(tvfile.read_dumps(dump_dir), [(series_data, episode_list)])
+
+    @patch('tvfile.try_query')
+    def test_offline_never_queries(self, mock_try_query):
+        """Searches and episode lists come from the store when offline"""
+        with patch('tvfile.OFFLINE', self.store):
+            series_list = tvfile.search_series('seinfeld')
+            episodes = tvfile.load_episodes(series_list[0]['id'])
+            self.assertEqual(tvfile.get_episode_info(episodes[0]['id']), episodes[0])
+        mock_try_query.assert_not_called()
+
 
 class TryQueryTests(TestCase):
 
@@ -88,14 +1051,142 @@ class TryQueryTests(TestCase):
             r = tvfile.try_query(query_func, response_mock)
         tvfile.get_token.assert_called()
 
-    def test_try_query_fail_then_success(self):
+    @patch('tvfile.time.sleep')
+    def test_try_query_fail_then_success(self, mock_sleep):
         """Query succeeds on second attempt and try_query returns a matching response"""
-        response_1 = make_response(requests.codes.not_found)
+        response_1 = make_response(requests.codes.service_unavailable)
         response_2 = make_response(requests.codes.ok)
         query_func = Mock(side_effect=[response_1, response_2])
         r = tvfile.try_query(query_func)
         self.assertEqual(query_func.call_count, 2)
         self.assertEqual(r.status_code, response_2.status_code)
+        mock_sleep.assert_called_once()
+
+    def test_try_query_not_found_is_not_retried(self):
+        """Errors that won't go away are raised on the first try"""
+        query_func = Mock(return_value=make_response(requests.codes.not_found))
+        with self.assertRaises(requests.HTTPError):
+            tvfile.try_query(query_func)
+        self.assertEqual(query_func.call_count, 1)
+
+    @patch('tvfile.time.sleep')
+    def test_try_query_honors_retry_after(self, mock_sleep):
+        """A 429 response waits as long as its Retry-After header asks"""
+        response_1 = make_response(requests.codes.too_many_requests)
+        response_1.headers['Retry-After'] = '2'
+        query_func = Mock(side_effect=[response_1, make_response(requests.codes.ok)])
+        with patch('tvfile.RATE_LIMITER', None):
+            tvfile.try_query(query_func)
+        mock_sleep.assert_called_once_with(2.0)
+
+    def test_backoff_grows_with_jitter(self):
+        """Delays stay under a cap that doubles with every try"""
+        policy = tvfile.RetryPolicy(backoff=0.5, max_delay=3)
+        for tries, cap in enumerate([0.5, 1, 2, 3, 3]):
+            delays = [policy.delay(tries) for i in range(50)]
+            self.assertTrue(all(0 <= delay <= cap for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+    def test_circuit_breaker_opens(self):
+        """Queries fail fast once the tvdb has failed too often in a row"""
+        breaker = tvfile.CircuitBreaker(threshold=2, cooldown=60)
+        query_func = Mock(side_effect=requests.ConnectionError)
+        with patch('tvfile.BREAKER', breaker), patch('tvfile.time.sleep'):
+            with self.assertRaises(tvfile.ApiUnavailable):
+                tvfile.try_query(query_func)
+        self.assertEqual(query_func.call_count, 2)
+
+    @patch('tvfile.get_token')
+    def test_token_is_renewed_once(self, mock_get_token):
+        """Threads refused with an old token don't log in again once it was replaced"""
+        with patch('tvfile.TOKEN', 'new'):
+            tvfile.renew_token('old')
+            mock_get_token.assert_not_called()
+            tvfile.renew_token('new')
+            mock_get_token.assert_called_once()
+
+
+class CacheTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.tmpdir.name, 'cache.sqlite3')
+        self.cache = tvfile.Cache(self.cache_path)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def test_episodes_round_trip(self):
+        """Episodes put into the cache come back out in the same order"""
+        episodes = send_episodes('1')['data'] + send_episodes('2')['data']
+        self.cache.put_episodes('79169', episodes)
+        self.assertEqual(self.cache.get_episodes(79169), episodes)
+        # Not the order of their ids
+        episodes.reverse()
+        self.assertEqual(self.cache.put_episodes('79169', episodes), 0)
+        self.assertEqual(self.cache.get_episodes(79169), episodes)
+
+    def test_search_terms_are_normalized(self):
+        """Search results are found again regardless of case and spacing"""
+        series_list = [{'id': 79169, 'seriesName': 'Seinfeld'}]
+        self.cache.put_search('Seinfeld', series_list)
+        self.assertEqual(self.cache.get_search('  seinFELD '), series_list)
+        self.assertIsNone(self.cache.get_search('frasier'))
+
+    def test_stale_entries_are_ignored(self):
+        """Entries older than the ttl are treated as missing"""
+        self.cache.put_episodes(79169, send_episodes('1')['data'])
+        self.cache.ttl = 0
+        self.assertIsNone(self.cache.get_episodes(79169))
+
+    def test_least_recently_used_series_is_evicted(self):
+        """Going over max_series drops the series that was used longest ago"""
+        self.cache.max_series = 2
+        episodes = send_episodes('1')['data']
+        self.cache.put_episodes(1, episodes)
+        self.cache.put_episodes(2, episodes)
+        self.cache.conn.execute('UPDATE series SET accessed = 0 WHERE id = 2')
+        self.cache.put_episodes(3, episodes)
+        self.assertIsNotNone(self.cache.get_episodes(1))
+        self.assertIsNone(self.cache.get_episodes(2))
+        self.assertIsNotNone(self.cache.get_episodes(3))
+
+    @patch('tvfile.updated_series_since', return_value=None)
+    @patch('tvfile.get_all_episodes')
+    def test_load_episodes_uses_cache(self, mock_get_all_episodes, mock_updated_series_since):
+        """A second load of the same series makes no queries, unless refresh is passed"""
+        mock_get_all_episodes.return_value = send_episodes('1')['data']
+        first = tvfile.load_episodes(79169, self.cache)
+        second = tvfile.load_episodes(79169, self.cache)
+        self.assertEqual(first, second)
+        self.assertEqual(mock_get_all_episodes.call_count, 1)
+        tvfile.load_episodes(79169, self.cache, refresh=True)
+        self.assertEqual(mock_get_all_episodes.call_count, 2)
+
+    def test_only_changed_episodes_are_written(self):
+        """Storing the episodes again only writes the ones with a new lastUpdated value"""
+        episodes = send_episodes('1')['data']
+        self.assertEqual(self.cache.put_episodes(79169, episodes), len(episodes))
+        self.assertEqual(self.cache.put_episodes(79169, episodes), 0)
+        episodes[5] = dict(episodes[5], lastUpdated=episodes[5]['lastUpdated'] + 1)
+        self.assertEqual(self.cache.put_episodes(79169, episodes[:-1]), 1)
+        self.assertEqual(len(self.cache.get_episodes(79169)), len(episodes) - 1)
+
+    @patch('tvfile.updated_series_since')
+    @patch('tvfile.get_all_episodes')
+    def test_refresh_skips_unchanged_series(self, mock_get_all_episodes, mock_updated_series_since):
+        """A stale series that the tvdb lists as unchanged is not downloaded again"""
+        episodes = send_episodes('1')['data']
+        self.cache.put_episodes(79169, episodes)
+        mock_updated_series_since.return_value = {12345: int(time.time())}
+        self.assertEqual(tvfile.load_episodes(79169, self.cache, refresh=True), episodes)
+        mock_get_all_episodes.assert_not_called()
+
+        mock_updated_series_since.return_value = {79169: int(time.time())}
+        mock_get_all_episodes.return_value = episodes
+        tvfile.load_episodes(79169, self.cache, refresh=True)
+        mock_get_all_episodes.assert_called_once()
 
 
 if __name__ == "__main__":
@@ -7,33 +7,128 @@
 
 import sys
 import os
-import requests
 import argparse
 import json
 import string
-import textwrap
 import re
 import time
-#import jwt
+import base64
+import random
+import select
+import struct
 import configparser
+import threading
 
-from glob import glob
-from requests.exceptions import HTTPError
+from glob import glob, escape as glob_escape
+from itertools import repeat
+from collections import Counter, namedtuple, defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+import heapq
+# requests, sqlite3, csv, email.utils and concurrent.futures are imported where
+# they are first needed, so --help, config errors and runs that never touch the
+# network don't wait for them
 
 
-# TOKEN is modified by load_token()
+# Modified by load_requests() on first network use
+requests = None
+HTTPError = None
+
+API_URL = 'https://api.thetvdb.com'
+# TOKEN and TOKEN_EXPIRES are modified by load_token()
 TOKEN = ''
+TOKEN_EXPIRES = None
+# Held while getting a new token, so threads that get 401 log in only once
+TOKEN_LOCK = threading.Lock()
+# SESSION is created by get_session()
+SESSION = None
+SESSION_LOCK = threading.Lock()
+# Shared by every request; Modified by main()
+RATE_LIMITER = None
+# Seconds to wait for a connection and for a response; Modified by main()
+TIMEOUT = (10, 30)
 CONFIG_DIR = os.path.join(os.path.expanduser('~'), '.config', 'tvfile')
 TOKEN_PATH = os.path.join(CONFIG_DIR, 'token.txt')
-
-# Keeps track of what file you're on; Modified by main()
-BOOKMARK = None
+TOKEN_EXPIRY_PATH = os.path.join(CONFIG_DIR, 'token_expiry.txt')
+# A token is renewed when it has less than TOKEN_MARGIN seconds left, and
+# refreshed in the background when it has less than TOKEN_REFRESH_AHEAD
+TOKEN_MARGIN = 5 * 60
+TOKEN_REFRESH_AHEAD = 12 * 60 * 60
+CACHE_PATH = os.path.join(CONFIG_DIR, 'cache.sqlite3')
+JOURNAL_PATH = os.path.join(CONFIG_DIR, 'journal.jsonl')
+OFFLINE_PATH = os.path.join(CONFIG_DIR, 'offline.sqlite3')
+# The tvdb only lists updates from the past week; Older caches are refetched
+UPDATES_MAX_AGE = 7 * 24 * 60 * 60 - 60
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+# Common unicode punctuation as ascii, without control characters; Everything
+# else outside of ascii is dropped by filter_ascii() after translating
+ASCII_TABLE = str.maketrans('\u2018\u2019\u2013\u2014\u201c\u201d', "''--\"\"",
+                            ''.join(map(chr, range(32))) + '\x7f')
+# Filename layout used by styles without a template = option
+DEFAULT_TEMPLATE = '{series}{part}{sxe}{part}{titles}'
+# Styles compiled by compile_style(), by their options
+STYLE_RENDERERS = dict()
+# Title search results below MIN_SCORE are hidden, and the top result is
+# chosen without asking when it scores at least AUTO_SELECT_SCORE and beats
+# the next one by AUTO_SELECT_MARGIN
+MAX_CHOICES = 10
+MIN_SCORE = 0.5
+AUTO_SELECT_SCORE = 0.9
+AUTO_SELECT_MARGIN = 0.1
+# Files are renamed without asking when the detected episode has at least
+# this confidence; Modified by main()
+AUTO_CONFIDENCE = 0.8
+# Patterns for finding episode numbers in filenames
+SEASON_EPISODE_PATTERN = re.compile(
+    r'(?<![a-z0-9])s0*(?P<season>\d{1,2}) ?e(?P<episodes>\d{1,3}'
+    r'(?:(?:-e?| ?- ?e| ?e|[ -]?s0*(?P=season) ?e)\d{1,3}(?![0-9p]))*)(?![0-9])',
+    re.IGNORECASE)
+CROSS_PATTERN = re.compile(
+    r'(?<![a-z0-9])0*(?P<season>\d{1,2})x(?P<episodes>\d{1,3}'
+    r'(?:(?: ?- ?(?:\d{1,2}x)?|x| 0*(?P=season)x)\d{2,3})*)(?![0-9])',
+    re.IGNORECASE)
+ABSOLUTE_PATTERN = re.compile(
+    r'(?<![a-z0-9])(?P<prefix>ep(?:isode)? ?|e|# ?)?(?P<number>(?!(?:19|20)\d\d(?![0-9]))\d{1,4})(?![0-9]|p\b|i\b|bit\b)',
+    re.IGNORECASE)
+# Tokens added by release groups that are never part of an episode title
+JUNK_PATTERN = re.compile(
+    r'(?<![a-z0-9])(?:\d{3,4}[pi]|4k|uhd|[xh] ?26[45]|hevc|avc|xvid|divx|aac(?:2 ?0)?|ac3|e?ac-?3|dts|ddp?(?:5 1|2 0)?|'
+    r'web(?:[ -]?(?:dl|rip))?|hdtv|pdtv|sdtv|blu ?ray|bd(?:rip)?|br(?:rip)?|dvd(?:rip)?|hdrip|remux|'
+    r'proper|repack|internal|limited|amzn|nf|hulu|dsnp|hmax|atvp|10 ?bit|8 ?bit|hdr(?:10)?|dv|'
+    r'multi|dual(?: audio)?|subbed|dubbed|complete)(?![a-z0-9])',
+    re.IGNORECASE)
+# Episodes given to --assign, e.g. 3, 3x1, 3x1-3x24 or 3x1-24, and in absolute order 25 or 25-48
+EPISODE_RANGE_PATTERN = re.compile(r'^s?(\d+)(?:[xe](\d+)(?:-(?:s?(\d+)[xe]|e)?(\d+))?)?$')
+ABSOLUTE_RANGE_PATTERN = re.compile(r'^(\d+)(?:-(\d+))?$')
+# Columns of a rename plan saved as csv
+PLAN_FIELDS = ('source', 'target', 'guess', 'action', 'series_id', 'episode_ids', 'confidence')
+# Number of upcoming files prepared in the background while the user is typing
+PREFETCH_FILES = 3
+# Number of episode pages downloaded at the same time; Modified by main()
+FETCH_WORKERS = 4
+# Number of series downloaded at the same time in a batch; Modified by main()
+SERIES_WORKERS = 4
+# Seconds a watched file must stay unchanged before it is renamed; Modified by main()
+WATCH_SETTLE = 2.0
+# Seconds between listings of watched directories without inotify; Modified by main()
+WATCH_INTERVAL = 5.0
+# Seconds before a watched series is downloaded again for an unknown episode
+WATCH_REFRESH = 60 * 60
+# Endings of files that are still being downloaded
+PARTIAL_SUFFIXES = ('.part', '.partial', '.crdownload', '.download', '.tmp', '.!qb', '.!ut')
+
+# Record of finished files; Modified by main()
+JOURNAL = None
+# Imported series used instead of the tvdb by --offline; Modified by main()
+OFFLINE = None
+# Parsed command line options; Modified by main()
+args = None
 
 
 def create_parser():
     parser = argparse.ArgumentParser(
         description='Rename files with correct season and episode numbers according to the TheTVDB.com')
-    parser.add_argument('-s', '--search', required=True, metavar='SERIES_NAME',
+    parser.add_argument('-s', '--search', metavar='SERIES_NAME',
                         help='Search term to find the name of the tv series')
     group = parser.add_mutually_exclusive_group()
     group.add_argument(
@@ -42,13 +137,50 @@ def create_parser():
                        help='Rename original files in place')
     parser.add_argument('-m', '--multiple-episodes', action='store_const',
                         const=2, help='Use this flag when there are two episodes per file')
-    parser.add_argument('files', nargs='+', metavar='EPISODE_FILES',
+    parser.add_argument('files', nargs='*', metavar='EPISODE_FILES',
                         help='The tv episode files to rename, intended to be used with shell expansion, e.g. *.mkv')
     parser.add_argument('-n', '--episode-numbers', action='store_true',
-                        help='Search for episodes by number instead of name. Useful when files are ordered correctly but the syntax is wrong.')
+                        help='Search for episodes by number instead of name. Useful when files are ordered correctly but the syntax is wrong. See --assign to number them all without asking.')
+    parser.add_argument('--assign', metavar='EPISODES',
+                        help='Number the files in order instead of asking, from a first episode or over a range, e.g. 3x1, 3x1-3x24 or 3 for all of season 3. Files are sorted naturally, and nothing is changed when the files and episodes do not line up.')
+    parser.add_argument('--order', choices=('aired', 'dvd', 'absolute'), default='aired',
+                        help='Episode order used by --assign. Give absolute numbers like 25-48 with absolute. Default: aired')
     parser.add_argument('--style', help='Override style=name option from config')
-    parser.add_argument('--start-at', type=int, help='Start at the nth file in the list. Useful if script exits early and you need to run the same command again, resuming from where it previously left off.')
-    #parser.add_argument('-j', '--junk', help='(NOT IMPLEMENTED) Help auto-detection of episode titles by providing parts of the filename which can be ignored')
+    parser.add_argument('--verify', action='store_true',
+                        help='Look up each chosen episode on the tvdb again before renaming, instead of trusting the downloaded episode list')
+    parser.add_argument('--redo', action='store_true',
+                        help='Process files again even if they were already renamed or symlinked by an earlier run')
+    parser.add_argument('--manifest', metavar='MANIFEST_FILE',
+                        help='Rename the files of many series in one run, as listed in an ini file with one section per series. SERIES_NAME and EPISODE_FILES are not needed.')
+    plan_group = parser.add_mutually_exclusive_group()
+    plan_group.add_argument('--plan', metavar='PLAN_FILE',
+                            help='Detect the episode in every file without asking and write the renames to a json or csv file, instead of renaming anything')
+    plan_group.add_argument('--apply', metavar='PLAN_FILE',
+                            help='Rename or symlink the files listed in a plan written by --plan, without asking. SERIES_NAME and EPISODE_FILES are not needed.')
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument('--refresh', action='store_true',
+                             help='Ignore the ttl of cached series and episode data. Searches are sent again, and episodes are downloaded again unless the tvdb reports the series unchanged since it was cached')
+    cache_group.add_argument('--no-cache', action='store_true',
+                             help='Do not read or write the local cache of series and episode data')
+    parser.add_argument('-j', '--junk', action='append', metavar='TEXT',
+                        help='Help auto-detection of episode titles by providing parts of the filename which can be ignored. Can be given more than once.')
+    parser.add_argument('--no-guess', action='store_true',
+                        help='Always ask for the episode instead of detecting it from the filename')
+    parser.add_argument('--offline', action='store_true',
+                        help='Look up series and episodes in the dumps imported with --import-dump, without connecting to the tvdb')
+    dump_group = parser.add_mutually_exclusive_group()
+    dump_group.add_argument('--export-dump', metavar='DUMP_DIR',
+                            help='Save the series chosen with -s and all its episodes to a directory, for importing on another machine. EPISODE_FILES are not needed.')
+    dump_group.add_argument('--import-dump', metavar='DUMP_DIR',
+                            help='Import every series dump in a directory for use with --offline. SERIES_NAME and EPISODE_FILES are not needed.')
+    parser.add_argument('--sync', action='store_true',
+                        help='Make the -l directory mirror EPISODE_FILES without asking: create missing links, rename links whose name changed and remove links to files that are gone. Nothing is changed when the links are already right.')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and rename or symlink files as soon as they finish downloading into the directories given as EPISODE_FILES, or under watch = in a manifest. Files whose episode cannot be detected are left alone.')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print where the time went when the script exits: requests to the tvdb, the cache, waiting for input and renaming files')
+    parser.add_argument('--trace', metavar='TRACE_FILE',
+                        help='Write every request, cache lookup, prompt and file operation to a file as lines of json')
     return parser
 
 
@@ -59,6 +191,19 @@ def create_config():
     template = """
 [config]
 style = standard
+cache_ttl = 24
+cache_max_series = 50
+cache_max_episodes = 100000
+fetch_workers = 4
+series_workers = 4
+requests_per_second = 10
+connect_timeout = 10
+read_timeout = 30
+retry_backoff = 0.5
+max_retry_delay = 30
+auto_confidence = 0.8
+watch_settle = 2
+watch_interval = 5
 [standard] 
 word_delim = ' '
 part_delim = ' - '
@@ -81,30 +226,267 @@ def exit_on_query_fail(thing):
     sys.exit("Quitting because script could not retrieve {} from the tvdb".format(thing))
 
 
-def quit(status=0, bookmark=None):
+def quit(status=0):
     print('\n')
-    if bookmark is not None:
-        print("Script exited on file number {bookmark}. To resume, run the same command with --start-at={bookmark}".format(bookmark=bookmark))
+    if JOURNAL is not None:
+        JOURNAL.flush()
+        if status:
+            print("Finished files are remembered. To resume, run the same command again.")
     sys.exit(status)
 
 
+class Stats:
+    """Count and time the requests to the tvdb, cache lookups, prompts and file
+    operations of a run. Every event is also written to the trace file as a
+    line of json when one is open."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        # The try_query retry each thread is on, for the requests it sends
+        self.local = threading.local()
+        # (kind, name) -> [count, seconds]
+        self.totals = defaultdict(lambda: [0, 0.0])
+        # endpoint -> [requests, errors, bytes, seconds]
+        self.requests = defaultdict(lambda: [0, 0, 0, 0.0])
+        self.trace = None
+
+    def open_trace(self, path):
+        try:
+            self.trace = open(path, 'a', buffering=1)
+        except IOError as e:
+            print("Could not open the trace file, continuing without it:", e)
+
+    def close(self):
+        with self.lock:
+            if self.trace is not None:
+                self.trace.close()
+                self.trace = None
+
+    def record(self, kind, name=None, seconds=0.0, **fields):
+        """Add one event to the totals and the trace"""
+        with self.lock:
+            total = self.totals[(kind, name)]
+            total[0] += 1
+            total[1] += seconds
+            if self.trace is not None:
+                event = {'time': round(time.time(), 3), 'event': kind, 'name': name,
+                         'seconds': round(seconds, 6)}
+                event.update(fields)
+                self.trace.write(json.dumps(event) + '\n')
+
+    def record_request(self, method, endpoint, status, size, seconds):
+        retry = getattr(self.local, 'retry', 0)
+        with self.lock:
+            totals = self.requests['{} {}'.format(method, endpoint)]
+            totals[0] += 1
+            totals[1] += status is None or status >= 400
+            totals[2] += size
+            totals[3] += seconds
+        self.record('http', endpoint, seconds, method=method, status=status, bytes=size, retry=retry)
+
+    @contextmanager
+    def timer(self, kind, name=None, **fields):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(kind, name, time.monotonic() - start, **fields)
+
+    def count(self, kind, name=None):
+        return self.totals[(kind, name)][0] if (kind, name) in self.totals else 0
+
+    def seconds(self, kind, name=None):
+        return self.totals[(kind, name)][1] if (kind, name) in self.totals else 0.0
+
+    def summary(self):
+        """Return the totals as lines of text"""
+        elapsed = time.monotonic() - self.started
+        waiting = self.seconds('input')
+        lines = ["Finished in {:.2f}s: {:.2f}s waiting for input, {:.2f}s working".format(
+            elapsed, waiting, elapsed - waiting)]
+        num_requests = sum(totals[0] for totals in self.requests.values())
+        lines.append("Requests to the tvdb: {} in {:.2f}s, {:.1f} KB, {} retries, {} token refreshes".format(
+            num_requests, sum(totals[3] for totals in self.requests.values()),
+            sum(totals[2] for totals in self.requests.values()) / 1024,
+            self.count('retry'), self.count('token_refresh')))
+        for endpoint, (count, errors, size, seconds) in sorted(self.requests.items()):
+            lines.append("  {:<28} {:>5} requests {:>8.2f}s {:>7.0f} ms avg {:>9.1f} KB {:>3} errors".format(
+                endpoint, count, seconds, seconds / count * 1000, size / 1024, errors))
+        lines.append("Cache: {} hits, {} misses, {} checked unchanged".format(
+            self.count('cache', 'hit'), self.count('cache', 'miss'), self.count('cache', 'unchanged')))
+        for action in ('rename', 'symlink'):
+            if self.count(action):
+                lines.append("{}: {} files in {:.3f}s".format(
+                    action.capitalize(), self.count(action), self.seconds(action)))
+        if self.count('watch'):
+            lines.append("Watched files: {} settled, {:.1f} ms avg to handle".format(
+                self.count('watch'), self.seconds('watch') / self.count('watch') * 1000))
+        return lines
+
+
+# Collects timings for --stats and --trace
+STATS = Stats()
+
+
+def load_requests():
+    """Import requests, which takes longer than the rest of the script
+    together, the first time the network is needed"""
+    global requests, HTTPError
+    if requests is None:
+        import requests as requests_module
+        HTTPError = requests_module.exceptions.HTTPError
+        requests = requests_module
+    return requests
+
+
+class ApiUnavailable(Exception):
+    """Raised instead of sending a request while the circuit breaker is open"""
+
+
+class RetryPolicy:
+    """Decide which failed requests are worth trying again, and how long to
+    wait first: as long as the tvdb asks for with a Retry-After header, or
+    else an exponential backoff with full jitter, so that threads failing at
+    the same moment don't all retry together"""
+
+    # Errors that may go away by themselves, besides 401 which needs a new token
+    RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+
+    def __init__(self, backoff=0.5, max_delay=30):
+        self.backoff = backoff
+        self.max_delay = max_delay
+
+    def should_retry(self, status):
+        return status == requests.codes.unauthorized or status in self.RETRY_STATUSES
+
+    def is_failure(self, status):
+        """Return True if the status means the tvdb itself is in trouble"""
+        return status in self.RETRY_STATUSES
+
+    def delay(self, tries, response=None):
+        """Return the seconds to wait before try number tries + 1"""
+        retry_after = parse_retry_after(response) if response is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.backoff * 2 ** tries))
+
+
+def parse_retry_after(response):
+    """Return the seconds given by a Retry-After header, as a number or a date, or None"""
+    from email.utils import parsedate_to_datetime
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+class CircuitBreaker:
+    """Stop sending requests for cooldown seconds once the tvdb has failed
+    threshold times in a row, across all threads, so a batch fails fast
+    instead of retrying every request against an api that is down. After the
+    cooldown one more failure opens it again, and a success closes it."""
+
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.open_until = 0.0
+
+    def allow(self):
+        with self.lock:
+            return time.monotonic() >= self.open_until
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.open_until = time.monotonic() + self.cooldown
+
+
+# Shared by every query; Modified by main()
+RETRY_POLICY = RetryPolicy()
+BREAKER = CircuitBreaker()
+
+
 def try_query(query_func, *query_args, limit=3):
-    """Retry on HTTPError until hitting the tries limit, then raise the HTTPError.
-    Don't retry on other errors, just raise the exception."""
+    """Retry on errors that may go away (timeouts, lost connections, rate
+    limiting, server errors and expired tokens) until hitting the tries limit,
+    then raise the error. Wait between tries as RETRY_POLICY says, and raise
+    ApiUnavailable without trying while BREAKER is open. Don't retry on other
+    errors, just raise the exception."""
+    load_requests()
     tries = 0
-    while tries <= limit:
-        response = query_func(*query_args)
+    while True:
+        if not BREAKER.allow():
+            raise ApiUnavailable("The tvdb failed too many times in a row, waiting before trying again")
+        ensure_token()
+        sent_token = TOKEN
+        STATS.local.retry = tries
         try:
-            response.raise_for_status()
-        except HTTPError:
+            response = query_func(*query_args)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            BREAKER.failure()
             if tries == limit:
-                print("Tried query {} times with no good response".format(tries))
-                response.raise_for_status()
-            elif response.status_code == requests.codes.unauthorized:
-                get_token()
-            tries += 1
+                raise
+            response = None
+        finally:
+            STATS.local.retry = 0
+
+        status = None
+        if response is None:
+            delay = RETRY_POLICY.delay(tries)
         else:
-            return response
+            try:
+                response.raise_for_status()
+            except HTTPError:
+                status = response.status_code
+                if RETRY_POLICY.is_failure(status):
+                    BREAKER.failure()
+                else:
+                    BREAKER.success()
+                if not RETRY_POLICY.should_retry(status):
+                    raise
+                if tries == limit:
+                    print("Tried query {} times with no good response".format(tries))
+                    raise
+                if status == requests.codes.unauthorized:
+                    with STATS.timer('token_refresh'):
+                        renew_token(sent_token)
+                    delay = 0
+                else:
+                    delay = RETRY_POLICY.delay(tries, response)
+            else:
+                BREAKER.success()
+                return response
+
+        STATS.record('retry', status=status, delay=round(delay, 3))
+        if status == requests.codes.too_many_requests and RATE_LIMITER is not None:
+            # Hold back every thread, this one waits in the rate limiter
+            RATE_LIMITER.pause(delay)
+        elif delay:
+            time.sleep(delay)
+        tries += 1
+
+
+def renew_token(stale_token):
+    """Get a new token, unless another thread already replaced the one that
+    was refused while we were waiting for the lock"""
+    with TOKEN_LOCK:
+        if TOKEN == stale_token:
+            get_token()
 
 
 def get_token():
@@ -128,93 +510,739 @@ def get_token():
 
 def request_access_token(apikey='FBOBJZQ4H8OEG8Q1'):
     print("Getting new access token...")
-    url = 'https://api.thetvdb.com/login'
+    url = API_URL + '/login'
     payload = {'apikey': apikey}
-    response = requests.post(url, json=payload)
+    # Don't send along an expired token when logging in
+    headers = {'Authorization': None}
+    response = send_request('POST', url, json=payload, headers=headers)
     return response
 
 
-def request_refresh_token():
+def request_refresh_token(quiet=False):
     """Try to get a refresh token, then return a response no matter what"""
     # Refresh tokens last one full week
-    print("Getting new refresh token...")
-    url = 'https://api.thetvdb.com/refresh_token'
-    headers = {'Authorization': 'Bearer {}'.format(TOKEN)}
-    response = requests.get(url, headers=headers)
+    if not quiet:
+        print("Getting new refresh token...")
+    url = API_URL + '/refresh_token'
+    response = send_request('GET', url)
     return response
 
 
 def save_token(response):
-    with open(TOKEN_PATH, 'w') as outfile:
-        outfile.write(response.json()['token'])
+    """Write the token and its expiry time next to each other. Each file is
+    replaced in one step, so a background refresh cut short at exit can't
+    leave half a token behind."""
+    token = response.json()['token']
+    expires = decode_token_expiry(token)
+    for path, content in ((TOKEN_PATH, token),
+                          (TOKEN_EXPIRY_PATH, '' if expires is None else str(expires))):
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as outfile:
+            outfile.write(content)
+        os.replace(temp_path, path)
 
 
 def load_token():
-    global TOKEN
+    global TOKEN, TOKEN_EXPIRES
     try:
         with open(TOKEN_PATH, 'r') as infile:
             TOKEN = infile.read()
     except FileNotFoundError:
         # Create the empty file
         open(TOKEN_PATH, 'w').close()
+    try:
+        with open(TOKEN_EXPIRY_PATH, 'r') as infile:
+            TOKEN_EXPIRES = int(infile.read())
+    except (IOError, ValueError):
+        # Tokens saved by older versions have no expiry file
+        TOKEN_EXPIRES = decode_token_expiry(TOKEN)
+    if SESSION is not None:
+        install_token(SESSION)
+
+
+def decode_token_expiry(token):
+    """Return the exp claim of a jwt as a unix timestamp, or None if it can't
+    be read. The signature isn't checked, the tvdb does that."""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, ValueError, KeyError, TypeError):
+        return None
+
+
+def token_is_good(margin=TOKEN_MARGIN):
+    """Return True if there is a token that won't expire within margin seconds.
+    A token with an unknown expiry is trusted until the tvdb refuses it."""
+    return bool(TOKEN) and (TOKEN_EXPIRES is None or TOKEN_EXPIRES - time.time() > margin)
+
+
+def ensure_token():
+    """Log in before sending a request when there is no token or it has
+    expired, instead of waiting for the tvdb to refuse it"""
+    if token_is_good():
+        return
+    with TOKEN_LOCK:
+        if not token_is_good():
+            with STATS.timer('token_refresh'):
+                get_token()
+
+
+def refresh_token_early():
+    """Quietly swap a token that is still good, but expires within
+    TOKEN_REFRESH_AHEAD seconds, for a new one"""
+    with TOKEN_LOCK:
+        if not token_is_good() or token_is_good(TOKEN_REFRESH_AHEAD):
+            return
+        try:
+            with STATS.timer('token_refresh'):
+                response = request_refresh_token(quiet=True)
+        except requests.exceptions.RequestException:
+            return
+        if response.status_code == requests.codes.ok:
+            save_token(response)
+            load_token()
+
+
+def start_token_refresh():
+    """Refresh a token that expires soon on a background thread, so it happens
+    while the user is choosing a series. Return the thread, or None when the
+    token doesn't need it."""
+    if not token_is_good() or token_is_good(TOKEN_REFRESH_AHEAD):
+        return None
+    thread = threading.Thread(target=refresh_token_early, daemon=True)
+    thread.start()
+    return thread
+
+
+def get_session():
+    """Return the session shared by every request to the tvdb, creating it on
+    first use. Connections are kept alive and reused between requests."""
+    global SESSION
+    load_requests()
+    with SESSION_LOCK:
+        if SESSION is None:
+            session = requests.Session()
+            # Enough pooled connections for every page fetching thread
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=max(10, FETCH_WORKERS * SERIES_WORKERS))
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            install_token(session)
+            SESSION = session
+    return SESSION
+
+
+def send_request(method, url, **kwargs):
+    """Send a request through the shared session, once the rate limiter allows it"""
+    load_requests()
+    if RATE_LIMITER is not None:
+        RATE_LIMITER.wait()
+    endpoint = request_endpoint(url)
+    start = time.monotonic()
+    try:
+        response = get_session().request(method, url, timeout=TIMEOUT, **kwargs)
+    except requests.exceptions.RequestException:
+        STATS.record_request(method, endpoint, None, 0, time.monotonic() - start)
+        raise
+    STATS.record_request(method, endpoint, response.status_code,
+                         len(response.content), time.monotonic() - start)
+    return response
+
+
+def request_endpoint(url):
+    """Return the path of a tvdb url with ids replaced, e.g. /series/{id}/episodes"""
+    if url.startswith(API_URL):
+        url = url[len(API_URL):]
+    return re.sub(r'/\d+(?=/|$)', '/{id}', url)
+
+
+class RateLimiter:
+    """Space out requests so that no more than rate of them start each second,
+    across all threads. A rate of 0 means no limit."""
+
+    def __init__(self, rate=0):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next_start = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    def pause(self, seconds):
+        """Hold back every request for the given seconds, e.g. after a 429 response"""
+        with self.lock:
+            self.next_start = max(self.next_start, time.monotonic() + seconds)
+
+
+def install_token(session):
+    """Send the current TOKEN with every request made through the session"""
+    session.headers['Authorization'] = 'Bearer {}'.format(TOKEN)
 
 
 def find_series(search):
-    url = 'https://api.thetvdb.com/search/series'
+    url = API_URL + '/search/series'
     payload = {'name': search}
-    headers = {'Authorization': 'Bearer {}'.format(TOKEN)}
-    response = requests.get(url, params=payload, headers=headers)
+    response = send_request('GET', url, params=payload)
     return response
 
 
 def get_episodes(series_id, page=1):
     """Take integer or string values for the series id and the page of results, then return the response"""
     # There is a max of 100 results per page
-    url = 'https://api.thetvdb.com/series/{}/episodes'.format(series_id)
+    url = API_URL + '/series/{}/episodes'.format(series_id)
     payload = {'page': '{}'.format(page)}
-    headers = {'Authorization': 'Bearer {}'.format(TOKEN)}
-    response = requests.get(url, params=payload, headers=headers)
+    response = send_request('GET', url, params=payload)
     return response
 
 
 def get_all_episodes(series_id):
     """Return all episodes in a list of json objects"""
-    # When on page 2
-    # {'first': 1, 'last': 4, 'next': 3, 'prev': 1}
-    page = 1
     all_episodes = list()
-    while True:
-        try:
-            episodes = try_query(get_episodes, series_id, page).json()
-        except:
-            exit_on_query_fail('episodes')
-        if episodes['links']['next'] is not None:
-            all_episodes = all_episodes + episodes['data']
-            page = episodes['links']['next']
-        else:
-            all_episodes = all_episodes + episodes['data']
-            return all_episodes
+    for episodes in iter_episode_pages(series_id):
+        all_episodes.extend(episodes)
+    return all_episodes
+
+
+def iter_episode_pages(series_id):
+    """Yield the episodes of a series one page at a time, as lists of json
+    objects, in page order and as soon as each page has arrived"""
+    # The first page tells us how many pages there are, e.g.
+    # {'first': 1, 'last': 4, 'next': 2, 'prev': None}
+    # so the rest are fetched in parallel
+    first_page = get_episode_page(series_id, 1)
+    yield first_page['data']
+    last_page = first_page['links']['last'] or 1
+    if last_page > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        workers = min(FETCH_WORKERS, last_page - 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pages = executor.map(get_episode_page, repeat(series_id), range(2, last_page + 1))
+            for episodes in pages:
+                yield episodes['data']
+
+
+def get_episode_page(series_id, page):
+    """Return one page of episodes as json, or exit if it can't be retrieved"""
+    try:
+        return try_query(get_episodes, series_id, page).json()
+    except:
+        exit_on_query_fail('episodes')
+
+
+def get_updated_series(from_time):
+    """Get the series updated since a unix timestamp, which must be less than a week ago"""
+    url = API_URL + '/updated/query'
+    payload = {'fromTime': '{}'.format(from_time)}
+    response = send_request('GET', url, params=payload)
+    return response
 
 
 def episode_info(episode_id):
-    url = 'https://api.thetvdb.com/episodes/{}'.format(episode_id)
-    headers = {'Authorization': 'Bearer {}'.format(TOKEN)}
-    response = requests.get(url, headers=headers)
+    url = API_URL + '/episodes/{}'.format(episode_id)
+    response = send_request('GET', url)
     return response
 
 
+class Cache:
+    """Store series search results and episode lists in a sqlite database, so
+    repeat runs for the same series don't have to ask the tvdb again."""
+
+    # Bump when the tables change, older databases are dropped and rebuilt
+    SCHEMA_VERSION = 3
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS searches (
+        term TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        fetched REAL NOT NULL,
+        accessed REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS series (
+        id INTEGER PRIMARY KEY,
+        fetched REAL NOT NULL,
+        accessed REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS episodes (
+        series_id INTEGER NOT NULL,
+        id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        last_updated INTEGER,
+        data TEXT NOT NULL,
+        PRIMARY KEY (series_id, id)
+    );
+    """
+
+    def __init__(self, path, ttl=24, max_series=50, max_episodes=100000):
+        """Take the ttl in hours. The least recently used series are evicted
+        once there are more than max_series of them or more than max_episodes
+        episodes in total."""
+        self.path = path
+        self.ttl = ttl * 60 * 60
+        self.max_series = max_series
+        self.max_episodes = max_episodes
+        # Shared by the threads fetching series in a batch
+        self.lock = threading.RLock()
+        import sqlite3
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            self.conn.executescript("""
+            DROP TABLE IF EXISTS searches;
+            DROP TABLE IF EXISTS series;
+            DROP TABLE IF EXISTS episodes;
+            PRAGMA user_version = {};
+            """.format(self.SCHEMA_VERSION))
+        self.conn.executescript(self.SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def is_fresh(self, fetched):
+        return time.time() - fetched < self.ttl
+
+    def get_search(self, search):
+        """Return the cached list of series for a search term, or None if it's missing or stale"""
+        with self.lock:
+            term = normalize_search(search)
+            row = self.conn.execute(
+                'SELECT data, fetched FROM searches WHERE term = ?', (term,)).fetchone()
+            if row is None or not self.is_fresh(row[1]):
+                return None
+            with self.conn:
+                self.conn.execute('UPDATE searches SET accessed = ? WHERE term = ?',
+                                  (time.time(), term))
+            return json.loads(row[0])
+
+    def put_search(self, search, series_list):
+        with self.lock:
+            now = time.time()
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?)',
+                                  (normalize_search(search), json.dumps(series_list), now, now))
+            self.evict()
+
+    def get_episodes(self, series_id, stale_ok=False):
+        """Return the cached list of episodes for a series, in the order the
+        tvdb listed them, or None if it's missing or stale. Pass stale_ok=True
+        to ignore the ttl."""
+        with self.lock:
+            series_id = int(series_id)
+            row = self.conn.execute(
+                'SELECT fetched FROM series WHERE id = ?', (series_id,)).fetchone()
+            if row is None or not (stale_ok or self.is_fresh(row[0])):
+                return None
+            with self.conn:
+                self.conn.execute('UPDATE series SET accessed = ? WHERE id = ?',
+                                  (time.time(), series_id))
+            rows = self.conn.execute(
+                'SELECT data FROM episodes WHERE series_id = ? ORDER BY position', (series_id,))
+            return [json.loads(data) for (data,) in rows]
+
+    def series_checked(self, series_id):
+        """Return when a series was last checked against the tvdb and the
+        newest lastUpdated value among its episodes, or None if it isn't cached"""
+        with self.lock:
+            series_id = int(series_id)
+            row = self.conn.execute(
+                'SELECT fetched FROM series WHERE id = ?', (series_id,)).fetchone()
+            if row is None:
+                return None
+            (last_updated,) = self.conn.execute(
+                'SELECT MAX(last_updated) FROM episodes WHERE series_id = ?', (series_id,)).fetchone()
+            return row[0], last_updated or 0
+
+    def touch_series(self, series_id, checked=None):
+        """Mark a series as up to date without changing its episodes"""
+        with self.lock:
+            now = time.time()
+            with self.conn:
+                self.conn.execute('UPDATE series SET fetched = ?, accessed = ? WHERE id = ?',
+                                  (checked or now, now, int(series_id)))
+
+    def put_episodes(self, series_id, episodes):
+        """Store the full list of episodes for a series, keeping their order.
+        Only episodes that are new or have a different lastUpdated value are
+        written, unchanged ones that moved only get their new position, and
+        episodes that are no longer listed are removed. Return the number of
+        episodes written."""
+        with self.lock:
+            series_id = int(series_id)
+            now = time.time()
+            cached = {ep_id: (position, last_updated) for ep_id, position, last_updated in self.conn.execute(
+                'SELECT id, position, last_updated FROM episodes WHERE series_id = ?', (series_id,))}
+            changed = list()
+            moved = list()
+            for position, episode in enumerate(episodes):
+                last_updated = episode.get('lastUpdated')
+                if (episode['id'] not in cached or last_updated is None
+                        or cached[episode['id']][1] != last_updated):
+                    changed.append((series_id, episode['id'], position, last_updated, json.dumps(episode)))
+                elif cached[episode['id']][0] != position:
+                    moved.append((position, series_id, episode['id']))
+            removed = cached.keys() - {episode['id'] for episode in episodes}
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO episodes VALUES (?, ?, ?, ?, ?)', changed)
+                self.conn.executemany('UPDATE episodes SET position = ? WHERE series_id = ? AND id = ?',
+                                      moved)
+                self.conn.executemany('DELETE FROM episodes WHERE series_id = ? AND id = ?',
+                                      [(series_id, ep_id) for ep_id in removed])
+                self.conn.execute('INSERT OR REPLACE INTO series VALUES (?, ?, ?)',
+                                  (series_id, now, now))
+            self.evict()
+            return len(changed)
+
+    def evict(self):
+        """Drop the least recently used series and searches until the cache is within its limits"""
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    'DELETE FROM searches WHERE term NOT IN '
+                    '(SELECT term FROM searches ORDER BY accessed DESC LIMIT ?)', (self.max_series,))
+                series_sizes = self.conn.execute(
+                    'SELECT series.id, COUNT(episodes.id) FROM series '
+                    'LEFT JOIN episodes ON episodes.series_id = series.id '
+                    'GROUP BY series.id ORDER BY series.accessed DESC').fetchall()
+                kept_series = 0
+                kept_episodes = 0
+                for series_id, size in series_sizes:
+                    if kept_series < self.max_series and kept_episodes + size <= self.max_episodes:
+                        kept_series += 1
+                        kept_episodes += size
+                    else:
+                        self.conn.execute('DELETE FROM episodes WHERE series_id = ?', (series_id,))
+                        self.conn.execute('DELETE FROM series WHERE id = ?', (series_id,))
+
+
+def open_cache(config):
+    """Open the cache using the limits from the [config] section, or return None if it can't be opened"""
+    import sqlite3
+    try:
+        return Cache(CACHE_PATH,
+                     ttl=config.getfloat('config', 'cache_ttl', fallback=24),
+                     max_series=config.getint('config', 'cache_max_series', fallback=50),
+                     max_episodes=config.getint('config', 'cache_max_episodes', fallback=100000))
+    except (sqlite3.Error, ValueError) as e:
+        print("Could not open the cache, continuing without it:", e)
+        return None
+
+
+def normalize_search(search):
+    return ' '.join(search.lower().split())
+
+
+def search_series(search, cache=None, refresh=False):
+    """Return the list of series matching a search term, from the cache when
+    possible. Pass refresh=True to skip reading the cache."""
+    if OFFLINE is not None:
+        series_list = OFFLINE.find_series(search)
+        if not series_list:
+            sys.exit("No imported series matches {}, import it with --import-dump first".format(search))
+        return series_list
+
+    if cache is not None and not refresh:
+        series_list = cache.get_search(search)
+        if series_list is not None:
+            STATS.record('cache', 'hit', table='searches', key=search)
+            return series_list
+        STATS.record('cache', 'miss', table='searches', key=search)
+
+    try:
+        response = try_query(find_series, search)
+    except:
+        exit_on_query_fail('the tv series')
+
+    try:
+        series_list = response.json()['data']
+    except KeyError as e:
+        print("Did not receive a valid search result")
+        print(e)
+        sys.exit()
+
+    if cache is not None:
+        cache.put_search(search, series_list)
+    return series_list
+
+
+def load_episodes(series_id, cache=None, refresh=False):
+    """Return all episodes of a series, from the cache when possible. Pass
+    refresh=True to skip reading fresh cache entries and check the tvdb for
+    changes."""
+    if OFFLINE is not None:
+        episodes = OFFLINE.get_episodes(series_id)
+        if episodes is None:
+            sys.exit("Series {} was not imported, import it with --import-dump first".format(series_id))
+        return episodes
+
+    if cache is None:
+        return get_all_episodes(series_id)
+
+    if not refresh:
+        episodes = cached_episodes(series_id, cache)
+        if episodes is not None:
+            return episodes
+
+    return refresh_episodes(series_id, cache)
+
+
+def load_episode_pages(series_id, cache=None, refresh=False):
+    """Like load_episodes, but yield the episodes a page at a time as they
+    arrive from the tvdb. Episodes from the cache or the offline store come
+    as a single page, and downloaded episodes are cached after the last page."""
+    if OFFLINE is not None:
+        yield load_episodes(series_id)
+        return
+
+    if cache is not None:
+        episodes = None if refresh else cached_episodes(series_id, cache)
+        if episodes is None:
+            episodes = unchanged_episodes(series_id, cache)
+        if episodes is not None:
+            yield episodes
+            return
+
+    all_episodes = list()
+    for episodes in iter_episode_pages(series_id):
+        all_episodes.extend(episodes)
+        yield episodes
+    if cache is not None:
+        cache.put_episodes(series_id, all_episodes)
+
+
+def cached_episodes(series_id, cache):
+    """Return the fresh cached episodes of a series, or None"""
+    episodes = cache.get_episodes(series_id)
+    STATS.record('cache', 'miss' if episodes is None else 'hit', table='episodes', key=series_id)
+    return episodes
+
+
+def refresh_episodes(series_id, cache):
+    """Bring the cached episodes of a series up to date and return them"""
+    episodes = unchanged_episodes(series_id, cache)
+    if episodes is None:
+        episodes = get_all_episodes(series_id)
+        cache.put_episodes(series_id, episodes)
+    return episodes
+
+
+def unchanged_episodes(series_id, cache):
+    """When the series was cached recently enough, ask the tvdb which series
+    were updated since then. Return the cached episodes if this one wasn't,
+    or None if they have to be downloaded again."""
+    checked = cache.series_checked(series_id)
+    if checked is not None:
+        fetched, last_updated = checked
+        now = time.time()
+        if now - fetched < UPDATES_MAX_AGE:
+            updates = updated_series_since(fetched)
+            if updates is not None and updates.get(int(series_id), 0) <= last_updated:
+                cache.touch_series(series_id, now)
+                STATS.record('cache', 'unchanged', table='episodes', key=series_id)
+                return cache.get_episodes(series_id, stale_ok=True)
+    return None
+
+
+def updated_series_since(from_time):
+    """Return a dict of series ids to lastUpdated values for every series
+    updated since from_time, or None if the tvdb couldn't tell us"""
+    try:
+        response = try_query(get_updated_series, int(from_time))
+        updates = response.json()['data'] or list()
+    except Exception:
+        return None
+    return {series['id']: series['lastUpdated'] for series in updates}
+
+
+class OfflineStore:
+    """Series and episodes imported from dumps, kept in a sqlite database for
+    --offline runs. Nothing is ever evicted. Series are found through an
+    index of their names and aliases, with one entry for each word a name
+    can be searched from, and episodes through indexes by series and by id."""
+
+    SCHEMA_VERSION = 2
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS series (
+        id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS names (
+        name TEXT NOT NULL,
+        series_id INTEGER NOT NULL,
+        PRIMARY KEY (name, series_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS episodes (
+        series_id INTEGER NOT NULL,
+        id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (series_id, id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS episodes_by_id ON episodes (id);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Shared by the threads fetching series in a batch
+        self.lock = threading.RLock()
+        import sqlite3
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            self.conn.executescript("""
+            DROP TABLE IF EXISTS series;
+            DROP TABLE IF EXISTS names;
+            DROP TABLE IF EXISTS episodes;
+            PRAGMA user_version = {};
+            """.format(self.SCHEMA_VERSION))
+        self.conn.executescript(self.SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def search_names(series_data):
+        """Return every normalized suffix of the series name and aliases that starts on a word"""
+        names = set()
+        for name in [series_data.get('seriesName') or ''] + list(series_data.get('aliases') or ()):
+            words = normalize_search(normalize_title(name)).split()
+            names.update(' '.join(words[start:]) for start in range(len(words)))
+        return names
+
+    def put_series(self, series_data, episodes):
+        """Store a series and all its episodes, replacing any earlier import of it"""
+        with self.lock:
+            series_id = int(series_data['id'])
+            with self.conn:
+                self.conn.execute('DELETE FROM names WHERE series_id = ?', (series_id,))
+                self.conn.execute('DELETE FROM episodes WHERE series_id = ?', (series_id,))
+                self.conn.execute('INSERT OR REPLACE INTO series VALUES (?, ?)',
+                                  (series_id, json.dumps(series_data)))
+                self.conn.executemany('INSERT INTO names VALUES (?, ?)',
+                                      [(name, series_id) for name in self.search_names(series_data)])
+                self.conn.executemany('INSERT OR REPLACE INTO episodes VALUES (?, ?, ?, ?)',
+                                      [(series_id, episode['id'], position, json.dumps(episode))
+                                       for position, episode in enumerate(episodes)])
+
+    def find_series(self, search):
+        """Return the imported series with a name or alias containing words
+        that start with the search term, exact matches first"""
+        term = normalize_search(normalize_title(search))
+        if not term:
+            return list()
+        with self.lock:
+            # Every name starting with term sorts between term and term + U+10FFFF
+            rows = self.conn.execute(
+                'SELECT series.id, series.data FROM names JOIN series ON series.id = names.series_id '
+                'WHERE names.name >= ? AND names.name < ? ORDER BY names.name != ?, length(names.name)',
+                (term, term + '\U0010ffff', term)).fetchall()
+        series_list = list()
+        seen = set()
+        for series_id, data in rows:
+            if series_id not in seen:
+                seen.add(series_id)
+                series_list.append(json.loads(data))
+        return series_list
+
+    def get_episodes(self, series_id):
+        """Return the episodes of an imported series in the order they were
+        dumped, or None if it wasn't imported"""
+        with self.lock:
+            series_id = int(series_id)
+            if self.conn.execute('SELECT 1 FROM series WHERE id = ?', (series_id,)).fetchone() is None:
+                return None
+            rows = self.conn.execute(
+                'SELECT data FROM episodes WHERE series_id = ? ORDER BY position', (series_id,))
+            return [json.loads(data) for (data,) in rows]
+
+    def get_episode(self, episode_id):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT data FROM episodes WHERE id = ?', (int(episode_id),)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+
+def dump_prefix(series_data):
+    """Return the start of the dump filenames for a series, e.g. seinfeld"""
+    slug = re.sub(r'[^a-z0-9]+', '-', (series_data.get('seriesName') or '').lower()).strip('-')
+    return slug or str(series_data['id'])
+
+
+def export_dump(directory, series_data, episode_list):
+    """Write a series and its episodes to a directory as NAME-series.json, in
+    the format of a series search, and NAME-episodes-page-N.json, in the
+    format of the episode pages from the tvdb"""
+    os.makedirs(directory, exist_ok=True)
+    prefix = os.path.join(directory, dump_prefix(series_data))
+    with open(prefix + '-series.json', 'w') as outfile:
+        json.dump({'data': [series_data]}, outfile)
+    # The tvdb sends 100 episodes per page
+    last_page = max(1, (len(episode_list) + 99) // 100)
+    for page in range(1, last_page + 1):
+        links = {'first': 1, 'last': last_page,
+                 'next': page + 1 if page < last_page else None,
+                 'prev': page - 1 if page > 1 else None}
+        with open('{}-episodes-page-{}.json'.format(prefix, page), 'w') as outfile:
+            json.dump({'links': links, 'data': episode_list[(page - 1) * 100:page * 100]}, outfile)
+    return last_page
+
+
+def read_dumps(directory):
+    """Return a list of (series data, episode list) for every dump in a directory"""
+    dumps = list()
+    for series_path in sorted(glob(os.path.join(glob_escape(directory), '*-series.json'))):
+        prefix = series_path[:-len('-series.json')]
+        page_paths = glob(glob_escape(prefix) + '-episodes-page-*.json')
+        page_paths.sort(key=lambda path: int(re.search(r'(\d+)\.json$', path).group(1)))
+        try:
+            with open(series_path) as infile:
+                series_data = json.load(infile)['data']
+            if isinstance(series_data, list):
+                series_data = series_data[0]
+            episode_list = list()
+            for page_path in page_paths:
+                with open(page_path) as infile:
+                    episode_list.extend(json.load(infile)['data'])
+        except (IOError, ValueError, KeyError, IndexError) as e:
+            sys.exit("Could not read the dump {}: {}".format(series_path, e))
+        dumps.append((series_data, episode_list))
+    return dumps
+
+
+def import_dumps(directory, store):
+    """Import every dump in a directory into the offline store"""
+    dumps = read_dumps(directory)
+    if not dumps:
+        sys.exit("No dumps found in {}, expected files named NAME-series.json".format(directory))
+    for series_data, episode_list in dumps:
+        store.put_series(series_data, episode_list)
+        print(filter_ascii('Imported "{}" with {} episodes'.format(
+            series_data.get('seriesName'), len(episode_list))))
+
+
+@lru_cache(maxsize=None)
+def get_episode_info(episode_id):
+    """Return the full data for one episode as json, or exit if it can't be retrieved"""
+    if OFFLINE is not None:
+        episode = OFFLINE.get_episode(episode_id)
+        if episode is None:
+            sys.exit("Episode {} was not imported".format(episode_id))
+        return episode
+    try:
+        response = try_query(episode_info, episode_id)
+    except:
+        exit_on_query_fail('episode info')
+    return response.json()['data']
+
+
 def filter_ascii(content):
     """Translate common unicode punctation into reasonable ascii representations, then remove all other non-ascii characters."""
     # This is used for filtering content from the tvdb before printing it to
     # the screen, and for filtering strings before they become filenames. 
-    unicode = '\u2018' + '\u2019' + '\u2013' + '\u2014' + '\u201c' + '\u201d'
-    to_ascii = "'" + "'" + '-' + '-' + '"' + '"'
-    unicode_to_ascii = str.maketrans(unicode, to_ascii)
-    trans_content = content.translate(unicode_to_ascii)
-    allowed_chars = set(string.ascii_letters + string.digits + string.punctuation + ' ')
-    func = lambda x : x in allowed_chars
-    ascii_content = ''.join(filter(func, trans_content))
-    return(ascii_content)
+    return content.translate(ASCII_TABLE).encode('ascii', 'ignore').decode('ascii')
 
 
 def list_choices(results_list):
@@ -244,50 +1272,421 @@ def select_choice(items):
 
 def prompt_user(prompt):
     while True:
-        text = input(prompt).lower()
+        with STATS.timer('input'):
+            text = input(prompt).lower()
         if not text:
             continue
         else:
             return text
 
 
-def remove_chars(words, characters):
-    """Return a given string with given characters removed. Expects both arguments to be strings."""
-    table = str.maketrans('', '', characters)
-    return words.translate(table)
+def normalize_title(title):
+    """Return a title without punctuation and in lowercase, the form used for all title searches"""
+    return title.translate(PUNCTUATION_TABLE).lower()
+
+
+def trigrams(text):
+    """Return the set of three character sequences in a text, padded so that the start and end of the text count too"""
+    padded = '  ' + text + ' '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)} if text else set()
+
+
+class FuzzyMatcher:
+    """Measure how closely a search string appears inside other strings,
+    allowing for typos. Uses Myers' bit-parallel edit distance, so each
+    comparison costs one pass over the other string."""
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.length = len(pattern)
+        self.full = (1 << self.length) - 1
+        self.last = 1 << (self.length - 1) if pattern else 0
+        self.peq = dict()
+        for position, char in enumerate(pattern):
+            self.peq[char] = self.peq.get(char, 0) | (1 << position)
+
+    def distance(self, text):
+        """Return the fewest edits needed to turn the pattern into any substring of the text"""
+        full = self.full
+        last = self.last
+        peq = self.peq
+        pv = full
+        mv = 0
+        score = best = self.length
+        for char in text:
+            eq = peq.get(char, 0)
+            xv = eq | mv
+            xh = ((((eq & pv) + pv) & full) ^ pv) | eq
+            ph = (mv | ~(xh | pv)) & full
+            mh = pv & xh
+            if ph & last:
+                score += 1
+            elif mh & last:
+                score -= 1
+                if score < best:
+                    best = score
+            ph = (ph << 1) & full
+            mh = (mh << 1) & full
+            pv = (mh | ~(xv | ph)) & full
+            mv = ph & xv
+        return best
+
+    def partial_ratio(self, text):
+        """Return 1 when the pattern appears exactly in the text, down to 0 when nothing lines up"""
+        if not self.length:
+            return 0.0
+        return 1 - self.distance(text) / self.length
+
+
+class TitleIndex:
+    """The episode titles of one series, normalized once, with a map from each
+    word to the episodes whose title contains it. Episodes are indexed by
+    their position in the episode list, and the ids and titles are the
+    objects handed to add(), so an EpisodeTable doesn't keep a second copy.
+    The maps of words and trigrams take most of the memory, so they are only
+    built by the first search that needs them."""
+
+    def __init__(self, episode_list=()):
+        # Episode ids and titles as given by the tvdb, by position
+        self.episode_ids = list()
+        self.names = list()
+        # Normalized titles, by position
+        self.normalized = list()
+        # Episode id -> position
+        self.order = dict()
+        # Normalized title -> episode id
+        self.ids = dict()
+        # Word -> postings of the episodes with it, see add_posting(), or
+        # None until word_index() is first called
+        self.words = None
+        # Trigram -> postings of the episodes with it, or None until
+        # trigram_index() is first called
+        self.trigrams = None
+        for episode in episode_list:
+            self.add(episode['id'], episode['episodeName'])
+
+    def add(self, ep_id, title):
+        if not title:
+            return
+        position = len(self.episode_ids)
+        normalized = normalize_title(title)
+        self.episode_ids.append(ep_id)
+        self.names.append(title)
+        self.normalized.append(normalized)
+        self.order[ep_id] = position
+        self.ids[normalized] = ep_id
+        if self.words is not None:
+            self.index_words(self.words, position)
+        if self.trigrams is not None:
+            self.index_trigrams(self.trigrams, position)
+
+    def index_words(self, index, position):
+        for word in set(self.normalized[position].split()):
+            add_posting(index, word, position)
+
+    def index_trigrams(self, index, position):
+        for gram in trigrams(' '.join(self.normalized[position].split())):
+            add_posting(index, gram, position)
+
+    def word_index(self):
+        """Return the map of words, building it if this is the first search"""
+        if self.words is None:
+            # Filled before it's shared, so another thread never sees half of it
+            words = dict()
+            for position in range(len(self.normalized)):
+                self.index_words(words, position)
+            self.words = words
+        return self.words
+
+    def trigram_index(self):
+        """Return the map of trigrams, building it if this is the first fuzzy search"""
+        if self.trigrams is None:
+            grams = dict()
+            for position in range(len(self.normalized)):
+                self.index_trigrams(grams, position)
+            self.trigrams = grams
+        return self.trigrams
+
+    def title(self, ep_id):
+        """Return the title of an episode as given by the tvdb"""
+        return self.names[self.order[ep_id]]
+
+    def in_order(self, positions):
+        """Return a list of episode ids in the order of the episode list"""
+        return [self.episode_ids[position] for position in sorted(positions)]
+
+    def phrase_search(self, phrase):
+        """Return the ids of episodes whose normalized title contains the phrase"""
+        # Words inside the phrase must appear whole in the title, only the
+        # first and last words can be partial, so they narrow the candidates
+        inner_words = phrase.split()[1:-1]
+        if inner_words:
+            words = self.word_index()
+            candidates = set.intersection(*[set(postings(words, word)) for word in inner_words])
+        else:
+            candidates = range(len(self.normalized))
+        return self.in_order(position for position in candidates
+                             if phrase in self.normalized[position])
+
+    def keyword_search(self, text):
+        """Return the ids of episodes whose title shares at least one whole word with the text"""
+        words = self.word_index()
+        matches = set()
+        for word in text.split():
+            matches.update(postings(words, word))
+        return self.in_order(matches)
+
+    def rank(self, text, limit=10):
+        """Return up to limit (score, episode id) pairs for the titles most
+        similar to a normalized search string, best first. Scores run from 0
+        to 1, where 1 is an exact match."""
+        query = ' '.join(text.split())
+        query_grams = trigrams(query)
+        if not query_grams:
+            return list()
+        grams = self.trigram_index()
+        found = [postings(grams, gram) for gram in query_grams]
+        found = [positions for positions in found if positions]
+        # Trigrams found in lots of titles, like "the", cost the most to count
+        # and say the least, so they're left out when there are rarer ones
+        cutoff = max(len(self.normalized) // 20, 50)
+        rare = [positions for positions in found if len(positions) <= cutoff]
+        if len(rare) >= 2:
+            found = rare
+        shared = Counter()
+        for positions in found:
+            shared.update(positions)
+        # Only the titles sharing the most trigrams are worth an edit distance
+        candidates = heapq.nlargest(max(limit * 2, 20), shared, key=shared.__getitem__)
+        matcher = FuzzyMatcher(query)
+        scored = list()
+        for position in candidates:
+            title = self.normalized[position]
+            title_grams = trigrams(' '.join(title.split()))
+            dice = 2 * len(query_grams & title_grams) / (len(query_grams) + len(title_grams))
+            score = 0.7 * matcher.partial_ratio(title) + 0.3 * dice
+            scored.append((round(score, 3), position))
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        return [(score, self.episode_ids[position]) for score, position in scored[:limit]]
+
+
+def add_posting(index, key, position):
+    """Add a position to the postings of a key in a TitleIndex. Most words and
+    trigrams are in one title only, and a bare position costs far less than a
+    list holding it, so a list is only made for the second one."""
+    found = index.setdefault(key, position)
+    if type(found) is list:
+        found.append(position)
+    elif found != position:
+        index[key] = [found, position]
+
+
+def postings(index, key):
+    """Return the positions stored for a key by add_posting()"""
+    found = index.get(key, ())
+    return (found,) if isinstance(found, int) else found
+
+
+def search_titles(title_index, search_string):
+    """Rank the episodes against a normalized search string, and pick the best one
+    if it clearly wins, otherwise let the user choose. Return the chosen episode id."""
+    ranked = title_index.rank(search_string, limit=MAX_CHOICES)
+    ranked = [(score, ep_id) for score, ep_id in ranked if score >= MIN_SCORE]
+    if not ranked:
+        return None
+
+    clear_winner = clear_match(ranked)
+    if clear_winner is not None:
+        print(filter_ascii('>>> Matched "{}"'.format(title_index.title(clear_winner))))
+        return clear_winner
+
+    ep_ids = [ep_id for score, ep_id in ranked]
+    list_choices([title_index.title(ep_id) for ep_id in ep_ids])
+    chosen_episode = select_choice(ep_ids)
+    return chosen_episode
+
+
+def clear_match(ranked):
+    """Return the episode id of the top result if it scores well and far enough ahead of the next one, otherwise None"""
+    top_score, top_id = ranked[0]
+    runner_up = ranked[1][0] if len(ranked) > 1 else 0
+    if top_score >= AUTO_SELECT_SCORE and top_score - runner_up >= AUTO_SELECT_MARGIN:
+        return top_id
+    return None
+
+
+def keyword_search(title, title_index):
+    """Perform a broad search by checking each word in the search string against each word in the title. Take as arguments the episode title to search for and the TitleIndex of the series. Return a list of episode ids."""
+    # This is helpful when the search string contains an error, e.g.
+    # spelling mistake. Each title is only matched once, no matter how many
+    # words from the search string it contains.
+    return title_index.keyword_search(title)
+
+
+# bare is True for an absolute number without a prefix like ep or #
+ParsedName = namedtuple('ParsedName', ['season', 'episodes', 'absolute', 'title', 'bare'])
+
+
+def parse_filename(filename, series_name='', junk=()):
+    """Pull the season, episode numbers, absolute number and title fragment out
+    of an episode filename. Any of them can be None (or an empty list for
+    episodes) when the filename doesn't contain it. A bare number at the end
+    of a title, as in The Boyfriend (2), is kept in the title as well."""
+    name = os.path.splitext(filename)[0]
+    # Release groups and checksums are usually in brackets
+    name = re.sub(r'\[[^\]]*\]|\{[^}]*\}', ' ', name)
+    for part in junk:
+        name = re.sub(re.escape(part), ' ', name, flags=re.IGNORECASE)
+    if JUNK_PATTERN.search(name):
+        # Release group after the encoding details, e.g. x264-GROUP
+        name = re.sub(r'-[a-z0-9]+$', '', name, flags=re.IGNORECASE)
+    name = re.sub(r'[._]+', ' ', name)
+
+    season = None
+    episodes = list()
+    absolute = None
+    bare = False
+
+    match = SEASON_EPISODE_PATTERN.search(name) or CROSS_PATTERN.search(name)
+    if match:
+        season = int(match.group('season'))
+        # Drop repeated seasons, as in 1x01-1x02 and s01e01-s01e02
+        numbers = re.sub(r'(?<=[- ])\d{1,2}x|s\d{1,2} ?e', ' ', match.group('episodes'), flags=re.IGNORECASE)
+        episodes = [int(num) for num in re.findall(r'\d+', numbers)]
+        if len(episodes) == 2 and '-' in match.group('episodes') and episodes[1] > episodes[0] + 1:
+            # A range like S01E01-E03
+            episodes = list(range(episodes[0], episodes[1] + 1))
+    else:
+        match = ABSOLUTE_PATTERN.search(name)
+        if match:
+            absolute = int(match.group('number'))
+            bare = not match.group('prefix')
+            if len(match.group('number')) in (3, 4) and not match.group('prefix'):
+                # Could also be 102 for season 1 episode 2
+                season, episode = divmod(absolute, 100)
+                episodes = [episode]
+    if match:
+        # Whatever comes before the numbers is usually the series name
+        title = clean_title(name[match.end():], series_name)
+        if not title and absolute is not None and clean_title(name[:match.start()], series_name):
+            # Nothing follows the number, so what comes before it is the
+            # title, which a bare number may be part of
+            title = clean_title(name[:match.end() if bare else match.start()], series_name)
+    else:
+        title = clean_title(name, series_name)
+    return ParsedName(season, episodes, absolute, title or None, bare)
+
+
+def clean_title(text, series_name=''):
+    """Return a normalized title fragment with junk tokens and the series name removed"""
+    text = JUNK_PATTERN.sub(' ', text)
+    text = re.sub(r'\(\s*(?:19|20)\d\d\s*\)|\b(?:19|20)\d\d\b', ' ', text)
+    text = ' '.join(normalize_title(text).split())
+    series = ' '.join(normalize_title(series_name).split())
+    if series and text.startswith(series):
+        text = text[len(series):].strip()
+    return text
+
+
+def guess_episodes(parsed, episode_nums_ids, episode_abs_ids, title_index):
+    """Resolve a parsed filename against the episodes of a series. Return a
+    list of episode ids and a confidence from 0 to 1."""
+    title_match = None
+    title_score = 0
+    if parsed.title:
+        ranked = title_index.rank(parsed.title, limit=2)
+        if ranked:
+            title_score, title_match = ranked[0]
+            if clear_match(ranked) is None:
+                title_score *= 0.8
+
+    candidates = list()
+    if parsed.season is not None and parsed.episodes:
+        ep_ids = [episode_nums_ids.get('{}x{}'.format(parsed.season, num)) for num in parsed.episodes]
+        if None not in ep_ids:
+            candidates.append(ep_ids)
+    if parsed.absolute is not None and parsed.absolute in episode_abs_ids:
+        ep_ids = [episode_abs_ids[parsed.absolute]]
+        if ep_ids not in candidates:
+            candidates.append(ep_ids)
+
+    # A bare number next to a title may be part of it, as in The Boyfriend (2)
+    untrusted = parsed.bare and parsed.title is not None
+    if parsed.absolute is None:
+        # Explicit numbers like S01E02 or 1x02
+        number_confidence = 0.9
+    elif untrusted:
+        number_confidence = AUTO_CONFIDENCE - 0.2
+    elif len(candidates) == 1:
+        number_confidence = 0.8
+    else:
+        # A bare 102 could be season 1 episode 2 or episode 102
+        number_confidence = 0.6
+
+    for ep_ids in candidates:
+        if title_match in ep_ids:
+            # The numbers and the title agree
+            return ep_ids, min(1.0, number_confidence + 0.1)
+    if candidates:
+        if title_match is None:
+            return candidates[0], number_confidence
+        if untrusted and title_score >= MIN_SCORE:
+            # The title overrules a number that may be part of it
+            return [title_match], title_score
+        if title_score < AUTO_SELECT_SCORE:
+            # The title fragment may just be junk we don't know about
+            return candidates[0], number_confidence - 0.1
+        # The numbers and the title disagree
+        return [title_match], 0.5
+    if title_match is not None:
+        return [title_match], title_score
+    return list(), 0.0
+
+
+def ask_episode_numbers(episode_nums_ids, num_searches):
+    """Prompt for episode numbers in the format SEASONxEPISODE until num_searches of them are found. Return their episode ids."""
+    given_episode_numbers = list()
+    entry_count = 0
+    while True:
+        episode_number = prompt_user('Enter episode number: ')
+        if re.compile("^\d{1,2}x\d{1,2}$").match(episode_number):
+            # Remove any leading zeroes
+            season_and_episode = [num.lstrip(
+                '0') for num in re.split('x', episode_number)]
+            episode_number = 'x'.join(season_and_episode)
+            try:
+                episode_nums_ids[episode_number]
+            except KeyError:
+                print("Episode does not exist")
+                continue
+            given_episode_numbers.append(episode_number)
+            entry_count += 1
+        else:
+            print("Invalid entry, try again")
+            continue
 
+        if entry_count >= num_searches:
+            break
 
-def search_titles(episode_titles, search_string):
-    phrase_matches = [ep_title for ep_title in episode_titles if search_string in remove_chars(
-        ep_title, string.punctuation).lower()]
+    return [episode_nums_ids[ep_num] for ep_num in given_episode_numbers]
 
-    if phrase_matches:
-        list_choices(phrase_matches)
-        chosen_episode = select_choice(phrase_matches)
-        return chosen_episode
-    else:
-        broad_matches = keyword_search(
-            search_string, episode_titles)
-        if broad_matches:
-            list_choices(broad_matches)
-            chosen_episode = select_choice(broad_matches)
-            return chosen_episode
 
+def ask_episode_titles(title_index, num_searches):
+    """Prompt for episode titles until num_searches episodes are chosen. Return their episode ids."""
+    episode_ids = list()
+    search_count = 0
 
-def keyword_search(title, episodes):
-    """Perform a broad search by checking each word in the search string against each word in the title. Take as arguments the episode title to search for and an iterable containing all episode titles."""
-    # This is helpful when the search string contains an error, e.g.
-    # spelling mistake. If you don't use a set(), this matches the same
-    # title multiple times, and returns duplicate titles equal to the
-    # number of words matched from the search string.
-    words_in_title = title.split()
-    broad_matches = set()
-    for word in words_in_title:
-        for episode_title in episodes:
-            if word in remove_chars(episode_title, string.punctuation).lower().split():
-                broad_matches.add(episode_title)
-    broad_matches_list = list(broad_matches)
-    return broad_matches_list
+    while (search_count < num_searches):
+        text = prompt_user('Enter an episode title: ')
+        title_search = normalize_title(text)
+        chosen_episode = search_titles(title_index, title_search)
+
+        if chosen_episode is not None:
+            episode_ids.append(chosen_episode)
+            search_count += 1
+        else:
+            print("No search results found, or invalid choice. Try again")
+    return episode_ids
 
 
 def expand_paths(files):
@@ -305,54 +1704,1669 @@ def expand_paths(files):
 
 def build_filename(series_name, season_number, episode_names, episode_numbers, style):
     """Accept names with words separated by spaces, and numbers as strings not integers. Return a filename without a file extension."""
-    word_delim = style['word_delim'].strip("'\"")
-    part_delim = style['part_delim'].strip("'\"")
-    
-    if len(season_number) < 2:
-        season_number = '0' + season_number
+    style = compile_style(style)
+    return style.format(style.clean(series_name), as_number(season_number),
+                        [as_number(number) for number in episode_numbers],
+                        [style.clean(name) for name in episode_names])
+
+
+def as_number(text):
+    return int(text) if str(text).isdigit() else text
+
+
+class StyleRenderer:
+    """A style from styles.ini compiled into what building filenames needs, so
+    the delimiters, character tables, case and template are worked out once
+    instead of for every file. The template = option lays out the filename,
+    where / starts a folder:
+
+        template = {series}/Season {season}/{sxe}{part}{titles}
+
+    Its fields are series, year, season, episode, absolute, sxe (S07E06-E07),
+    titles and part (the part_delim). Numbers take format specs, e.g.
+    {absolute:03d}, and absolute is 0 when the tvdb has none."""
+
+    SAMPLE = {'series': 'Series', 'year': '2000', 'season': 1, 'episode': 2, 'absolute': 3,
+              'sxe': 'S01E02', 'titles': 'Title', 'part': ' - '}
+
+    def __init__(self, style):
+        self.word_delim = style['word_delim'].strip("'\"")
+        self.part_delim = style['part_delim'].strip("'\"")
+        illegal_chars = set(string.punctuation) - set(style['allow_chars'])
+        # One table does filter_ascii's translation and removes illegal characters
+        self.filename_table = dict.fromkeys(map(ord, illegal_chars))
+        for char, ascii_char in ASCII_TABLE.items():
+            if ascii_char is None or chr(ascii_char) in illegal_chars:
+                self.filename_table[char] = None
+            else:
+                self.filename_table[char] = ascii_char
+
+        caps = configparser.ConfigParser.BOOLEAN_STATES.get(style.get('caps', 'no').lower())
+        if caps is None:
+            print("'caps' is not a true or false value in the config")
+            print("[ NOW ENTERING ALL CAPS MODE ]")
+            self.change_case = str.upper
+        else:
+            self.change_case = None if caps else str.lower
 
-    for index, ep_number in enumerate(episode_numbers):
-        if len(ep_number) < 2:
-            ep_number = '0' + ep_number
-            episode_numbers[index] = ep_number
+        template = style.get('template', DEFAULT_TEMPLATE).strip("'\"")
+        self.template = template.replace('/', os.sep)
+        try:
+            template.format_map(self.SAMPLE)
+        except (KeyError, ValueError, IndexError, AttributeError, TypeError) as e:
+            raise ValueError('The template "{}" is not valid: {!r}'.format(template, e))
+
+    def clean(self, name):
+        """Turn a series or episode name into words of a filename"""
+        name = name.translate(self.filename_table).encode('ascii', 'ignore').decode('ascii')
+        return self.word_delim.join(name.split())
+
+    def format(self, series, season, numbers, titles, absolute=None, year=''):
+        """Return a filename from names already cleaned"""
+        sxe = 'S' + str(season).rjust(2, '0') + 'E' + '-E'.join(str(number).rjust(2, '0') for number in numbers)
+        filename = self.template.format_map({
+            'series': series, 'year': year, 'season': season, 'episode': numbers[0],
+            'absolute': absolute or 0, 'sxe': sxe, 'titles': self.part_delim.join(titles),
+            'part': self.part_delim})
+        if self.change_case is None:
+            return filename
+        return self.change_case(filename)
+
+    def render(self, series_name, episodes, year=''):
+        """Return the filename, without a file extension, for a file containing
+        the given Episode records"""
+        return self.render_many(series_name, [episodes], year)[0]
+
+    def render_many(self, series_name, episode_groups, year=''):
+        """Return a filename for each list of Episode records, cleaning the
+        series name only once"""
+        series = self.clean(series_name)
+        filenames = list()
+        for episodes in episode_groups:
+            # The season of a file is that of its last episode
+            filenames.append(self.format(
+                series, episodes[-1].season, [episode.number for episode in episodes],
+                [self.clean(episode.name) for episode in episodes], episodes[0].absolute, year))
+        return filenames
+
+
+def compile_style(style):
+    """Return a StyleRenderer for a style section, or the style itself if it
+    already is one. Each version of a section is compiled only once."""
+    if isinstance(style, StyleRenderer):
+        return style
+    if isinstance(style, configparser.SectionProxy):
+        key = (style.name, tuple(style.parser.items(style.name, raw=True)))
+    else:
+        key = tuple(style.items())
+    renderer = STYLE_RENDERERS.get(key)
+    if renderer is None:
+        renderer = STYLE_RENDERERS[key] = StyleRenderer(style)
+    return renderer
+
+
+class Episode:
+    """One episode with only the fields tvfile uses, taken from the json of
+    an episode page or of a single episode"""
+
+    __slots__ = ('id', 'season', 'number', 'absolute', 'name', 'dvd_season', 'dvd_number')
+
+    def __init__(self, episode_data):
+        self.id = episode_data['id']
+        self.season = episode_data.get('airedSeason')
+        self.number = episode_data.get('airedEpisodeNumber')
+        self.absolute = episode_data.get('absoluteNumber')
+        self.name = episode_data.get('episodeName')
+        self.dvd_season = whole_number(episode_data.get('dvdSeason'))
+        # Episodes split in two on dvd are numbered like 2.1 and 2.2
+        self.dvd_number = whole_number(episode_data.get('dvdEpisodeNumber'))
+
+    def has_filename_fields(self):
+        """Return True if the episode has everything build_filename needs"""
+        return self.season is not None and self.number is not None and self.name is not None
+
+    def position(self, order):
+        """Return where the episode comes in 'aired', 'dvd' or 'absolute' order, or None if the tvdb doesn't say"""
+        if order == 'dvd':
+            position = (self.dvd_season, self.dvd_number)
+        elif order == 'absolute':
+            position = (self.absolute,)
+        else:
+            position = (self.season, self.number)
+        return None if None in position else position
+
+
+def whole_number(number):
+    """Return a float like 3.0 as an int, and anything else as it is"""
+    if isinstance(number, float) and number.is_integer():
+        return int(number)
+    return number
+
+
+class EpisodeTable:
+    """The episodes of one series as Episode records, with lookups by id, by
+    season and episode number, by absolute number and by title. The json
+    from the tvdb is mostly overviews, credits, ratings and image details
+    that are never read, so only the records are kept.
+
+    Pages can be streamed in on a background thread with stream(). Lookups
+    use whatever has arrived so far, and one that misses waits for the
+    remaining pages before giving up."""
+
+    def __init__(self, series_data, episode_list=()):
+        self.id = series_data['id']
+        self.name = series_data['seriesName']
+        self.year = (series_data.get('firstAired') or '')[:4]
+        # Episode id -> Episode, in the order they were added
+        self.episodes = dict()
+        # 'SEASONxEPISODE' -> episode id
+        self.number_ids = dict()
+        # Absolute number -> episode id
+        self.absolute_ids = dict()
+        self.title_index = TitleIndex(())
+        # Held while adding a page, notified after each one
+        self.loaded = threading.Condition(threading.RLock())
+        self.complete = True
+        self.error = None
+        self.extend(episode_list)
+        # Views for guess_episodes and the prompts, which wait on a miss
+        self.numbers = WaitingLookup(self, self.number_ids)
+        self.absolute = WaitingLookup(self, self.absolute_ids)
+        self.titles = WaitingTitleIndex(self)
+
+    def add(self, episode_data):
+        episode = Episode(episode_data)
+        self.episodes[episode.id] = episode
+        self.number_ids['{}x{}'.format(episode.season, episode.number)] = episode.id
+        if episode.absolute is not None:
+            self.absolute_ids[episode.absolute] = episode.id
+        self.title_index.add(episode.id, episode.name)
+
+    def extend(self, episode_list):
+        """Add a page or a whole list of episode json"""
+        with self.loaded:
+            for episode_data in episode_list:
+                self.add(episode_data)
+            self.loaded.notify_all()
+
+    def stream(self, pages):
+        """Add the pages of episodes from an iterable on a background thread, e.g. load_episode_pages()"""
+        self.complete = False
+        thread = threading.Thread(target=self.load_pages, args=(pages,), daemon=True)
+        thread.start()
+        return thread
+
+    def load_pages(self, pages):
+        try:
+            for episode_list in pages:
+                self.extend(episode_list)
+        except BaseException as e:
+            # Including the SystemExit from exit_on_query_fail, which is
+            # raised again by the lookup that needed the missing pages
+            self.error = e
+        finally:
+            with self.loaded:
+                self.complete = True
+                self.loaded.notify_all()
+
+    def wait(self):
+        """Wait until every page has been added"""
+        with self.loaded:
+            while not self.complete:
+                self.loaded.wait()
+        if self.error is not None:
+            raise self.error
+
+    def lookup(self, find):
+        """Return the result of find(), waiting for more pages while it's None"""
+        with self.loaded:
+            while True:
+                result = find()
+                if result is not None:
+                    return result
+                if self.complete:
+                    break
+                self.loaded.wait()
+        if self.error is not None:
+            raise self.error
+        return None
+
+    def __len__(self):
+        self.wait()
+        return len(self.episodes)
 
-    season_episode_abbrev = 'S' + season_number + \
-        'E' + '-E'.join(episode_numbers)
-        
-    punct = string.punctuation
-    illegal_chars = punct.translate(str.maketrans('', '', style['allow_chars']))
-
-    # Strip punctuation, collapse spaces, replace spaces with delimeter
-    series_name = remove_chars(series_name, illegal_chars)
-    series_name = ' '.join(series_name.split())
-    series_name = series_name.replace(' ', word_delim)
-
-    for index, ep_name in enumerate(episode_names):
-        ep_name = remove_chars(ep_name, illegal_chars)
-        ep_name = ' '.join(ep_name.split())
-        new_name = ep_name.replace(' ', word_delim)
-        episode_names[index] = new_name
-
-    filename_parts = [series_name,
-                      season_episode_abbrev, part_delim.join(episode_names)]
-    
-    new_filename = part_delim.join(filename_parts)
-    
+    def __iter__(self):
+        self.wait()
+        return iter(self.episodes.values())
+
+    def in_order(self, order):
+        """Return a sorted list of (position, Episode) in 'aired', 'dvd' or
+        'absolute' order, leaving out episodes without a position"""
+        positioned = [(episode.position(order), episode) for episode in self]
+        return sorted(((position, episode) for position, episode in positioned if position is not None),
+                      key=lambda item: item[0])
+
+    def __getitem__(self, episode_id):
+        episode = self.lookup(lambda: self.episodes.get(episode_id))
+        if episode is None:
+            raise KeyError(episode_id)
+        return episode
+
+    def by_number(self, season, number):
+        """Return the id of an episode by its aired season and episode number, or None"""
+        return self.numbers.get('{}x{}'.format(season, number))
+
+    def by_absolute(self, number):
+        return self.absolute.get(number)
+
+    def by_title(self, title):
+        """Return the id of the episode with exactly this title, ignoring case and punctuation, or None"""
+        normalized = normalize_title(title)
+        return self.lookup(lambda: self.title_index.ids.get(normalized))
+
+
+class WaitingLookup:
+    """A read only view of a dict of an EpisodeTable, which waits for the
+    remaining pages when a key is missing"""
+
+    def __init__(self, table, mapping):
+        self.table = table
+        self.mapping = mapping
+
+    def get(self, key, default=None):
+        result = self.table.lookup(lambda: self.mapping.get(key))
+        return default if result is None else result
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        result = self.get(key)
+        if result is None:
+            raise KeyError(key)
+        return result
+
+
+class WaitingTitleIndex:
+    """The TitleIndex of an EpisodeTable, ranked against whatever pages have
+    arrived. Only an exact title that clearly wins is trusted before all of
+    them are in, since a better match could still be on its way."""
+
+    def __init__(self, table):
+        self.table = table
+        self.title = table.title_index.title
+
+    def rank(self, text, limit=10):
+        with self.table.loaded:
+            ranked = self.table.title_index.rank(text, limit)
+            if self.table.complete or (ranked and ranked[0][0] >= 1.0 and clear_match(ranked) is not None):
+                return ranked
+        self.table.wait()
+        return self.table.title_index.rank(text, limit)
+
+    def keyword_search(self, text):
+        self.table.wait()
+        return self.table.title_index.keyword_search(text)
+
+    def phrase_search(self, phrase):
+        self.table.wait()
+        return self.table.title_index.phrase_search(phrase)
+
+
+def index_series(series_data, episode_list):
+    """Collect everything needed to find and name the episodes of a series in an EpisodeTable"""
+    return EpisodeTable(series_data, episode_list)
+
+
+def stream_series(series_data, episode_pages):
+    """Return an EpisodeTable that fills up from an iterable of pages in the
+    background, so files can be matched before the last page arrives"""
+    series = EpisodeTable(series_data)
+    series.stream(episode_pages)
+    return series
+
+
+def detect_episodes(series, filename, junk=None):
+    """Guess the episodes in a file from its name. Return a list of episode ids and a confidence from 0 to 1."""
+    if junk is None:
+        junk = args.junk or ()
+    parsed = parse_filename(filename, series.name, junk)
+    return guess_episodes(parsed, series.numbers, series.absolute, series.titles)
+
+
+def describe_episodes(series, episode_ids):
+    return ' & '.join(series[ep_id].name or '?' for ep_id in episode_ids)
+
+
+def episode_filename(series, episode_ids, style, verify=None):
+    """Return the new filename, without a file extension, for a file containing the given episodes"""
+    return episode_filenames(series, [episode_ids], style, verify)[0]
+
+
+def episode_filenames(series, episode_id_groups, style, verify=None):
+    """Return the new filenames of many files at once, one for each list of episode ids"""
+    if verify is None:
+        verify = args.verify
+    episode_groups = list()
+    for episode_ids in episode_id_groups:
+        episodes = list()
+        for ep_id in episode_ids:
+            episode = series[ep_id]
+            if verify or not episode.has_filename_fields():
+                episode = Episode(get_episode_info(ep_id))
+            episodes.append(episode)
+        episode_groups.append(episodes)
+    return compile_style(style).render_many(series.name, episode_groups, series.year)
+
+
+def file_action(symlinks, rename):
+    """Return 'symlink' or 'rename' depending on the options given, or None when files should be left alone"""
+    if symlinks and os.path.isdir(symlinks):
+        return 'symlink'
+    elif rename:
+        return 'rename'
+    return None
+
+
+def target_path(action, filepath, new_name, symlinks=None):
+    """Return where a file ends up, as a symlink in the symlinks directory or renamed next to the original"""
+    if action == 'symlink':
+        return os.path.join(os.path.abspath(symlinks), new_name)
+    return os.path.join(os.path.dirname(filepath), new_name)
+
+
+def move_file(action, source, target):
+    """Rename or symlink source to target, unless target already exists. Print
+    what went wrong and return False if it fails."""
+    if target_taken(action, source, target):
+        print('ERROR: "{}" already exists'.format(target))
+        return False
     try:
-        if style.getboolean('caps') is True:
-            return new_filename
+        with STATS.timer(action, source=source, target=target):
+            # Folders of a style's template are created as needed
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if action == 'symlink':
+                os.symlink(source, target)
+            else:
+                os.rename(source, target)
+    except (NotImplementedError, OSError) as e:
+        print_move_error(e)
+        return False
+    return True
+
+
+def target_taken(action, source, target):
+    """Return True if something other than the source itself is at the target.
+    On a case insensitive filesystem the target of a rename that only changes
+    case is the source."""
+    if not os.path.lexists(target):
+        return False
+    if action == 'rename':
+        try:
+            return not os.path.samefile(source, target)
+        except OSError:
+            return True
+    return True
+
+
+def existing_parent(path):
+    """Return the nearest folder above path that exists, or whatever is in its way"""
+    parent = os.path.dirname(path)
+    while not os.path.lexists(parent) and os.path.dirname(parent) != parent:
+        parent = os.path.dirname(parent)
+    return parent
+
+
+def print_move_error(e):
+    if isinstance(e, NotImplementedError):
+        print("ERROR: The -l option was used, but your OS can't create symbolic links. Try renaming files with -r instead.")
+    elif getattr(e, 'winerror', None) == 123:
+        print("ERROR: Filename contains characters usupported by your OS. Identify problem character and remove from 'allow_chars' in 'styles.ini'.")
+    else:
+        print(e)
+
+
+class Journal:
+    """Append-only record of every file renamed or symlinked, kept at
+    JOURNAL_PATH. Files are identified by their device, inode and size, which
+    survive a rename, so a file is recognised as done under its old and its
+    new name. A file can have a record for each place it was linked to.
+    Records are written out durably by flush()."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # (device, inode, size) -> list of records
+        self.done = defaultdict(list)
+        self.pending = list()
+        try:
+            with open(path) as infile:
+                for line in infile:
+                    try:
+                        record = json.loads(line)
+                        self.add(tuple(record['key']), record)
+                    except (ValueError, KeyError, TypeError):
+                        # A line cut short by a crash
+                        continue
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def file_key(path):
+        stat = os.stat(path)
+        return (stat.st_dev, stat.st_ino, stat.st_size)
+
+    def add(self, key, record):
+        # A newer record of the same move replaces the older one
+        records = self.done[key]
+        records[:] = [old for old in records
+                      if (old['action'], old['target']) != (record['action'], record['target'])]
+        records.append(record)
+
+    def targets(self, action):
+        """Return the set of targets recorded for an action"""
+        with self.lock:
+            return {record['target'] for records in self.done.values()
+                    for record in records if record['action'] == action}
+
+    def is_done(self, path, action=None, dest_dir=None):
+        """Return True if the file was already renamed or symlinked, under this
+        name or the one it was given, and the result is still there. Only
+        records of the given action, and with their target below dest_dir,
+        count when those are given."""
+        try:
+            records = self.done.get(self.file_key(path), ())
+        except OSError:
+            return False
+        path = os.path.abspath(path)
+        for record in records:
+            if path not in (record['source'], record['target']):
+                continue
+            if action is not None and record['action'] != action:
+                continue
+            if dest_dir is not None and not is_below(record['target'], dest_dir):
+                continue
+            if os.path.lexists(record['target']):
+                return True
+        return False
+
+    def record(self, action, source, target, key):
+        """Remember a finished rename or symlink. Take the key of the source from before it was renamed."""
+        record = {'key': list(key), 'action': action, 'source': source,
+                  'target': target, 'time': int(time.time())}
+        with self.lock:
+            self.add(tuple(key), record)
+            self.pending.append(record)
+
+    def flush(self):
+        """Append the pending records to the journal file and sync it to disk"""
+        with self.lock:
+            if not self.pending:
+                return
+            with open(self.path, 'a') as outfile:
+                for record in self.pending:
+                    outfile.write(json.dumps(record) + '\n')
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            self.pending = list()
+
+
+def is_done(filepath, journal=None, action=None, dest_dir=None):
+    """Return True if the journal says the file was already renamed, or
+    linked into dest_dir, by the given action, unless --redo was given"""
+    if journal is None:
+        journal = JOURNAL
+    if journal is None or (args is not None and args.redo):
+        return False
+    return journal.is_done(filepath, action, dest_dir)
+
+
+def link_dir(action, symlinks):
+    """Return the directory a symlink action puts files in, or None for renames"""
+    return symlinks if action == 'symlink' else None
+
+
+def is_below(path, directory):
+    """Return True if path is inside directory"""
+    directory = os.path.abspath(directory)
+    return os.path.commonpath([os.path.abspath(path), directory]) == directory
+
+
+def journaled_move(journal, action, source, target):
+    """Rename or symlink a file with move_file, and record it in the journal if it worked"""
+    key = Journal.file_key(source) if journal is not None else None
+    if not move_file(action, source, target):
+        return False
+    if journal is not None:
+        journal.record(action, source, target, key)
+    return True
+
+
+class RenameBatch:
+    """Rename or symlink many files as one transaction. Every operation is
+    checked before any of them runs: sources must exist, targets must not
+    exist or collide with each other, and renames must stay on one device.
+    Missing folders of a target are created, and removed again on undo. An
+    unlink removes the symlink at target, which points to source, and runs
+    before every other kind of operation, so its name is free for them. A target
+    may be the source of another rename in the batch, as in a swap or a
+    chain of renumbered episodes; those sources are first moved out of the
+    way to temporary names.
+    Operations run relative to an open descriptor of each directory involved,
+    and each directory that changed is synced to disk once at the end. If an
+    operation fails, the ones already done are undone in reverse order, and
+    only a batch that finished is recorded in the journal."""
+
+    # Platforms without dir_fd support get plain path operations and no directory sync
+    DIR_FD = {os.rename, os.symlink, os.unlink} <= os.supports_dir_fd
+
+    def __init__(self, journal=None):
+        self.journal = journal
+        # (action, source, target), the unlinks first
+        self.operations = list()
+        self.unlinks = 0
+
+    def __len__(self):
+        return len(self.operations)
+
+    def add(self, action, source, target):
+        source, target = os.path.abspath(source), os.path.abspath(target)
+        if action == 'rename' and source == target:
+            # Already has the right name
+            return
+        if action == 'unlink':
+            self.operations.insert(self.unlinks, (action, source, target))
+            self.unlinks += 1
         else:
-            return new_filename.lower()
-    except ValueError:
-        print("'caps' is not a true or false value in the config")
-        print("[ NOW ENTERING ALL CAPS MODE ]")
-        return new_filename.upper()
+            self.operations.append((action, source, target))
+
+    def problems(self):
+        """Return a list of reasons the batch can't run, empty when it can"""
+        problems = list()
+        targets = Counter(os.path.normcase(target) for action, source, target in self.operations
+                          if action != 'unlink')
+        # Names that are free once the unlinks, which run first, and the
+        # renames are done
+        freed = {os.path.normcase(target) for action, source, target in self.operations
+                 if action == 'unlink'}
+        freed.update(os.path.normcase(source) for action, source, target in self.operations
+                     if action == 'rename')
+        devices = dict()
+
+        def device(path):
+            if path not in devices:
+                devices[path] = os.stat(path).st_dev
+            return devices[path]
+
+        for action, source, target in self.operations:
+            target_dir = existing_parent(target)
+            if action not in ('rename', 'symlink', 'unlink'):
+                problems.append('Unknown action "{}" for {}'.format(action, source))
+            elif action == 'unlink':
+                if not os.path.islink(target):
+                    problems.append('"{}" is not a symlink'.format(target))
+            elif not os.path.lexists(source):
+                problems.append('"{}" does not exist'.format(source))
+            elif not os.path.isdir(target_dir):
+                problems.append('"{}" is not a directory'.format(target_dir))
+            elif targets[os.path.normcase(target)] > 1:
+                problems.append('"{}" is the target of {} files'.format(target, targets[os.path.normcase(target)]))
+            elif os.path.normcase(target) not in freed and target_taken(action, source, target):
+                problems.append('"{}" already exists'.format(target))
+            elif action == 'rename' and device(os.path.dirname(source)) != device(target_dir):
+                problems.append('"{}" is on a different device than "{}" and can only be symlinked'.format(
+                    source, target_dir))
+        return problems
+
+    def run(self):
+        """Run every operation, or none of them. Return True if they all worked."""
+        directories = dict()
+        # Every operation that ran, including moves to temporary names, for undo
+        done = list()
+        # (action, source, target, key) of the finished operations, for the journal
+        finished = list()
+        # Folders made for targets, in the order they were made
+        created = list()
+        try:
+            # Keys of the original files, taken before any of them moves
+            keys = [Journal.file_key(source)
+                    if self.journal is not None and action != 'unlink' else None
+                    for action, source, target in self.operations]
+            staged = dict()
+            for source, temporary in self.temporary_names().items():
+                self.apply(directories, 'rename', source, temporary)
+                done.append(('rename', source, temporary))
+                staged[source] = temporary
+            for (action, source, target), key in zip(self.operations, keys):
+                current = staged.get(source, source) if action == 'rename' else source
+                with STATS.timer(action, source=source, target=target):
+                    self.make_dirs(directories, os.path.dirname(target), created)
+                    self.apply(directories, action, current, target)
+                done.append((action, current, target))
+                finished.append((action, source, target, key))
+        except BaseException as e:
+            if isinstance(e, (NotImplementedError, OSError)):
+                print_move_error(e)
+            self.undo(directories, done, created)
+            self.sync(directories)
+            if not isinstance(e, (NotImplementedError, OSError)):
+                raise
+            return False
+        self.sync(directories)
+        if self.journal is not None:
+            for action, source, target, key in finished:
+                if action != 'unlink':
+                    self.journal.record(action, source, target, key)
+            self.journal.flush()
+        return True
+
+    def temporary_names(self):
+        """Return a temporary name next to each renamed source that is also the
+        target of an operation, so the renames can't run into each other"""
+        targets = {os.path.normcase(target) for action, source, target in self.operations
+                   if action != 'unlink'}
+        temporary = dict()
+        for action, source, target in self.operations:
+            if action == 'rename' and os.path.normcase(source) in targets:
+                directory, name = os.path.split(source)
+                temporary[source] = os.path.join(
+                    directory, '.tvfile-{}-{}-{}'.format(os.getpid(), len(temporary), name))
+        return temporary
+
+    def open_dir(self, directories, path):
+        """Return an open descriptor for a directory, or None without dir_fd support"""
+        if not self.DIR_FD:
+            return None
+        if path not in directories:
+            directories[path] = os.open(path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+        return directories[path]
+
+    def make_dirs(self, directories, path, created):
+        missing = list()
+        while not os.path.isdir(path):
+            missing.append(path)
+            path = os.path.dirname(path)
+        for path in reversed(missing):
+            os.mkdir(path)
+            created.append(path)
+            # The folder that holds a new one has changed too
+            self.open_dir(directories, os.path.dirname(path))
+
+    def apply(self, directories, action, source, target):
+        source_dir, source_name = os.path.split(source)
+        target_dir, target_name = os.path.split(target)
+        target_fd = self.open_dir(directories, target_dir)
+        if action == 'unlink':
+            if target_fd is None:
+                os.unlink(target)
+            else:
+                os.unlink(target_name, dir_fd=target_fd)
+        elif action == 'symlink':
+            if target_fd is None:
+                os.symlink(source, target)
+            else:
+                os.symlink(source, target_name, dir_fd=target_fd)
+        else:
+            source_fd = self.open_dir(directories, source_dir)
+            if source_fd is None:
+                os.rename(source, target)
+            else:
+                os.rename(source_name, target_name, src_dir_fd=source_fd, dst_dir_fd=target_fd)
+
+    def undo(self, directories, done, created=()):
+        """Reverse finished operations, newest first, then remove the folders made for them"""
+        for action, source, target in reversed(done):
+            try:
+                if action == 'symlink':
+                    os.unlink(target)
+                elif action == 'unlink':
+                    os.symlink(source, target)
+                else:
+                    os.rename(target, source)
+            except OSError as e:
+                print('ERROR: Could not undo {} of "{}": {}'.format(action, source, e))
+        for path in reversed(created):
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+        if done:
+            print("Undid {} finished files".format(len(done)))
+
+    def sync(self, directories):
+        """Sync every changed directory to disk once, then close them"""
+        for fd in directories.values():
+            try:
+                os.fsync(fd)
+            except OSError:
+                # Some filesystems can't sync a directory
+                pass
+            os.close(fd)
+        directories.clear()
+
+
+def make_plan(series, episode_files, style, num_searches):
+    """Detect the episodes in every file without asking, and return a list of plan entries.
+    Entries below the auto_confidence threshold get no target, only a guess to review."""
+    action = 'symlink' if args.symlinks else 'rename'
+    plan = list()
+    # (entry, confidence) of the files with a guess
+    detected = list()
+    for filepath in episode_files:
+        filepath = os.path.abspath(filepath)
+        filename = os.path.basename(filepath)
+        if is_done(filepath, action=action, dest_dir=link_dir(action, args.symlinks)):
+            continue
+        entry = {'source': filepath, 'target': None, 'guess': None, 'action': action,
+                 'series_id': series.id, 'episode_ids': [], 'confidence': 0.0}
+        episode_ids, confidence = detect_episodes(series, filename)
+        if episode_ids:
+            entry['episode_ids'] = episode_ids
+            entry['confidence'] = round(confidence, 3)
+            detected.append((entry, confidence))
+        plan.append(entry)
+
+    # The filenames of the whole plan are rendered in one go
+    new_names = episode_filenames(series, [entry['episode_ids'] for entry, _ in detected], style)
+    for (entry, confidence), new_name in zip(detected, new_names):
+        new_name += os.path.splitext(entry['source'])[1]
+        target = target_path(action, entry['source'], new_name, args.symlinks)
+        if confidence >= AUTO_CONFIDENCE and len(entry['episode_ids']) >= num_searches:
+            entry['target'] = target
+        else:
+            entry['guess'] = target
+
+    resolved = sum(1 for entry in plan if entry['target'])
+    print("Resolved {} of {} files".format(resolved, len(plan)))
+    if resolved < len(plan):
+        print("Review the entries without a target before applying the plan")
+    return plan
+
+
+def parse_episode_range(text, order='aired'):
+    """Parse the episodes given to --assign: a season like 3, a first episode
+    like 3x1, or a range like 3x1-3x24 or 3x1-24. In absolute order they
+    are a first number like 25 or a range like 25-48. Return the first and
+    last position, the last being None when the files decide where it ends.
+    Raise ValueError for anything else."""
+    text = text.strip().lower()
+    if order == 'absolute':
+        match = ABSOLUTE_RANGE_PATTERN.match(text)
+        if not match:
+            raise ValueError('"{}" is not an absolute number or a range like 25-48'.format(text))
+        first, last = match.groups()
+        return (int(first),), (int(last),) if last else None
+    match = EPISODE_RANGE_PATTERN.match(text)
+    if not match:
+        raise ValueError('"{}" is not a season, an episode like 3x1 or a range like 3x1-3x24'.format(text))
+    season, episode, last_season, last_episode = match.groups()
+    season = int(season)
+    if episode is None:
+        # All of a season
+        return (season, 0), (season, float('inf'))
+    if last_episode is None:
+        return (season, int(episode)), None
+    return (season, int(episode)), (int(last_season or season), int(last_episode))
+
+
+def natural_key(path):
+    """Sort key for filenames that puts episode 2 before episode 10"""
+    return [int(part) if part.isdigit() else part.lower()
+            for part in re.split(r'(\d+)', os.path.basename(path))]
+
+
+def assign_episodes(series, episode_files, episode_range, order='aired', per_file=1):
+    """Give the files, sorted naturally, the episodes of a range in order,
+    per_file episodes each. Return a list of (filepath, episode ids) and a
+    list of problems, which is empty when every file got its episodes."""
+    first, last = parse_episode_range(episode_range, order)
+    episode_files = sorted(episode_files, key=natural_key)
+    episodes = [episode for position, episode in series.in_order(order)
+                if position >= first and (last is None or position <= last)]
+    needed = len(episode_files) * per_file
+    if last is None:
+        episodes = episodes[:needed]
+
+    problems = list()
+    if len(episodes) != needed:
+        problems.append('{} files need {} episodes, but {} has {} in {} order'.format(
+            len(episode_files), needed, episode_range, len(episodes), order))
+    junk = (args.junk or ()) if args is not None else ()
+    for filepath in episode_files:
+        found = len(parse_filename(os.path.basename(filepath), series.name, junk).episodes)
+        if found > per_file:
+            problems.append('"{}" looks like it holds {} episodes, use -m for two episodes per file'.format(
+                os.path.basename(filepath), found))
+    assignments = [(filepath, [episode.id for episode in episodes[index * per_file:(index + 1) * per_file]])
+                   for index, filepath in enumerate(episode_files)]
+    return assignments, problems
+
+
+def assign_plan(series, episode_files, style, num_searches, episode_range, order='aired'):
+    """Return plan entries numbering the files in order with --assign, without
+    asking. Print the problems and quit before anything is touched when
+    the files and episodes don't line up."""
+    assignments, problems = assign_episodes(series, episode_files, episode_range, order, num_searches)
+    if problems:
+        for problem in problems:
+            print("ERROR: " + problem)
+        print("Nothing was changed")
+        sys.exit(1)
+
+    action = 'symlink' if args.symlinks else 'rename'
+    new_names = episode_filenames(series, [episode_ids for _, episode_ids in assignments], style)
+    plan = list()
+    for (filepath, episode_ids), new_name in zip(assignments, new_names):
+        source = os.path.abspath(filepath)
+        new_name += os.path.splitext(source)[1]
+        print(filter_ascii('{} -> {}'.format(os.path.basename(source), new_name)))
+        plan.append({'source': source, 'target': target_path(action, source, new_name, args.symlinks),
+                     'guess': None, 'action': action, 'series_id': series.id,
+                     'episode_ids': episode_ids, 'confidence': 1.0})
+    return plan
+
+
+def write_plan(path, plan):
+    """Save a plan as json, or as csv when the path ends in .csv"""
+    if path.lower().endswith('.csv'):
+        import csv
+        with open(path, 'w', newline='') as outfile:
+            writer = csv.DictWriter(outfile, fieldnames=PLAN_FIELDS)
+            writer.writeheader()
+            for entry in plan:
+                row = dict(entry, episode_ids=' '.join(str(ep_id) for ep_id in entry['episode_ids']))
+                writer.writerow({key: '' if value is None else value for key, value in row.items()})
+    else:
+        with open(path, 'w') as outfile:
+            json.dump(plan, outfile, indent=2)
+    print("Plan written to", path)
+
+
+def read_plan(path):
+    """Load a plan written by write_plan, possibly edited by hand"""
+    try:
+        with open(path, newline='') as infile:
+            if path.lower().endswith('.csv'):
+                import csv
+                plan = list()
+                for row in csv.DictReader(infile):
+                    entry = {key: value or None for key, value in row.items()}
+                    entry['episode_ids'] = [int(ep_id) for ep_id in (row['episode_ids'] or '').split()]
+                    plan.append(entry)
+                return plan
+            return json.load(infile)
+    except (IOError, ValueError, KeyError) as e:
+        sys.exit("Could not read the plan {}: {}".format(path, e))
+
+
+def apply_plan(plan, journal=None):
+    """Rename or symlink every file in a plan that has a target, without asking,
+    as one RenameBatch. Nothing is changed unless every file can be."""
+    batch = RenameBatch(journal)
+    for entry in plan:
+        source = entry['source']
+        target = entry.get('target')
+        if not target:
+            print("Skipping {}, it has no target".format(source))
+            continue
+        action = entry.get('action')
+        # Already applied by an earlier run
+        if is_done(source, journal, action, link_dir(action, os.path.dirname(target))):
+            print("Skipping {}, it was already done, use --redo to do it again".format(source))
+            continue
+        if action == 'rename' and not os.path.exists(source) and os.path.exists(target):
+            print("Skipping {}, it was already renamed to {}".format(source, target))
+            continue
+        batch.add(action, source, target)
+
+    problems = batch.problems()
+    if problems:
+        for problem in problems:
+            print("ERROR: " + problem)
+        print("Nothing was changed, fix the plan and apply it again")
+        sys.exit(1)
+    if not batch.run():
+        print("Stopped, the files done before the error were put back")
+        quit(1)
+    print("Applied {} of {} files".format(len(batch), len(plan)))
+
+
+class LinkIndex:
+    """The symlinks below a directory, found with one scan, by the absolute
+    path they point to. Whether a file is linked, and under which names,
+    is then a dict lookup."""
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        # Path a link points to -> paths of the links
+        self.links = defaultdict(list)
+        pending = [self.directory]
+        while pending:
+            path = pending.pop()
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_symlink():
+                    source = os.path.normpath(os.path.join(path, os.readlink(entry.path)))
+                    self.links[source].append(entry.path)
+                elif entry.is_dir():
+                    pending.append(entry.path)
+
+    def __len__(self):
+        return sum(len(links) for links in self.links.values())
+
+    def get(self, source):
+        return self.links.get(source, [])
+
+    def dangling(self, known=()):
+        """Yield (source, link) for every link to a file that no longer
+        exists. Sources in known are taken to exist without looking."""
+        for source, links in self.links.items():
+            if source not in known and not os.path.lexists(source):
+                for link in links:
+                    yield source, link
+
+
+def prunable_links(index, sources, journal=None):
+    """Return (source, link) for the dangling links that tvfile can safely
+    remove: those pointing into the folders of the given sources, and those
+    it made itself according to the journal. A link whose folder is gone
+    too is kept, since the drive holding it may just not be mounted."""
+    roots = {os.path.dirname(source) for source in sources}
+    made = journal.targets('symlink') if journal is not None else set()
+    prunable = list()
+    for source, link in index.dangling(set(sources)):
+        if not os.path.isdir(os.path.dirname(source)):
+            continue
+        if link in made or any(is_below(source, root) for root in roots):
+            prunable.append((source, link))
+    return prunable
+
+
+def remove_empty_dirs(paths, top):
+    """Remove the folders that held paths, and the folders above them up to top, if they are now empty"""
+    top = os.path.abspath(top)
+    for path in paths:
+        directory = os.path.dirname(path)
+        while directory != top and directory.startswith(top + os.sep):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+
+def sync_links(series, episode_files, style, num_searches, dest_dir):
+    """Make dest_dir mirror the episode files with one symlink each, without
+    asking. Only the differences are changed, as one RenameBatch: links are
+    made for new files, renamed when the name a file should have changed,
+    and removed when the file they point to is gone, see prunable_links().
+    A linked file whose episode can't be detected keeps its link, and a file
+    whose name is already taken, as by a second download of an episode, is
+    reported and left out. Return True if it worked."""
+    if not os.path.isdir(dest_dir):
+        print('ERROR: The --symlinks directory "{}" does not exist'.format(dest_dir))
+        return False
+    index = LinkIndex(dest_dir)
+    sources = [os.path.abspath(filepath) for filepath in episode_files]
+    # (source, episode ids) of the files detected well enough to link
+    detected = list()
+    unsure = list()
+    kept = 0
+    for source in sources:
+        episode_ids, confidence = detect_episodes(series, os.path.basename(source))
+        if confidence >= AUTO_CONFIDENCE and len(episode_ids) >= num_searches:
+            detected.append((source, episode_ids))
+        elif index.get(source):
+            kept += 1
+        else:
+            unsure.append(source)
+
+    batch = RenameBatch(JOURNAL)
+    removed = prunable_links(index, sources, JOURNAL)
+    for source, link in removed:
+        batch.add('unlink', source, link)
+    new_names = episode_filenames(series, [episode_ids for _, episode_ids in detected], style)
+    wanted = [(source, target_path('symlink', source, new_name + os.path.splitext(source)[1], dest_dir))
+              for (source, _), new_name in zip(detected, new_names)]
+    # Names that are taken by a link being kept, or will be by a new one
+    claimed = {os.path.normcase(target) for source, target in wanted if target in index.get(source)}
+    # Names that are free once the unlinks have run
+    released = {os.path.normcase(link) for source, link in removed}
+    new_links = list()
+    renamed = 0
+    taken = list()
+    for source, target in wanted:
+        links = index.get(source)
+        if target in links:
+            kept += 1
+        elif os.path.normcase(target) in claimed or (
+                os.path.lexists(target) and os.path.normcase(target) not in released):
+            # Another download of the same episode, or a file tvfile didn't make
+            taken.append((source, target))
+            continue
+        else:
+            claimed.add(os.path.normcase(target))
+            renamed += bool(links)
+            new_links.append((source, target))
+        # Extra links to the same file are removed too
+        for link in links:
+            if link != target:
+                batch.add('unlink', source, link)
+                released.add(os.path.normcase(link))
+    for source, target in new_links:
+        batch.add('symlink', source, target)
+
+    for source in unsure:
+        print(filter_ascii('Not linking "{}", its episode could not be detected'.format(os.path.basename(source))))
+    for source, target in taken:
+        print(filter_ascii('Not linking "{}", "{}" is already taken'.format(
+            os.path.basename(source), os.path.relpath(target, dest_dir))))
+    if len(batch):
+        problems = batch.problems()
+        if problems:
+            for problem in problems:
+                print("ERROR: " + problem)
+            print("Nothing was changed in {}".format(dest_dir))
+            return False
+        if not batch.run():
+            print("Stopped, the links done before the error were put back")
+            return False
+        remove_empty_dirs([target for action, source, target in batch.operations if action == 'unlink'],
+                          dest_dir)
+    print("Links in {}: {} created, {} renamed, {} removed, {} unchanged, {} not detected, {} taken".format(
+        dest_dir, len(new_links) - renamed, renamed, len(removed), kept, len(unsure), len(taken)))
+    return True
+
+
+def prepare_file(series, filepath, style, action=None, symlinks=None):
+    """Work out everything about a file that doesn't need the user: whether it
+    was already done by action, the detected episodes and the filename they give."""
+    filepath = os.path.abspath(filepath)
+    prepared = {'filepath': filepath, 'filename': os.path.basename(filepath),
+                'done': is_done(filepath, action=action, dest_dir=link_dir(action, symlinks)), 'episode_ids': [], 'confidence': 0.0,
+                'new_filename': None}
+    if not prepared['done'] and not args.no_guess:
+        episode_ids, confidence = detect_episodes(series, prepared['filename'])
+        prepared['episode_ids'] = episode_ids
+        prepared['confidence'] = confidence
+        if episode_ids:
+            prepared['new_filename'] = episode_filename(series, episode_ids, style)
+    return prepared
+
+
+class FileQueue:
+    """Rename or symlink files on a background thread, in the order they were
+    queued, so the next prompt doesn't wait for the filesystem. Each finished
+    file is recorded in the journal."""
+
+    def __init__(self, journal):
+        from concurrent.futures import ThreadPoolExecutor
+        self.journal = journal
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = list()
+        self.ok = True
+
+    def submit(self, action, source, target):
+        self.futures.append(self.executor.submit(self.move, action, source, target))
+
+    def move(self, action, source, target):
+        moved = journaled_move(self.journal, action, source, target)
+        if self.journal is not None:
+            self.journal.flush()
+        return moved
+
+    def failed(self):
+        """Return True if any finished move failed"""
+        finished = [future for future in self.futures if future.done()]
+        self.futures = [future for future in self.futures if not future.done()]
+        for future in finished:
+            if not future.result():
+                self.ok = False
+        return not self.ok
+
+    def close(self, cancel=False):
+        """Wait for the queued moves, or drop the ones that haven't started. Return True if they all worked."""
+        self.executor.shutdown(wait=True, cancel_futures=cancel)
+        return not self.failed()
+
+
+def rename_interactively(series, episode_files, style, num_searches, symlinks=None, rename=None):
+    """Rename or symlink each file, asking the user whenever its episode can't be
+    detected. The next few files are prepared in the background while the
+    user is typing, and the renames happen in the background too. Use the
+    -l and -r options unless symlinks or rename are given."""
+    from concurrent.futures import ThreadPoolExecutor
+    if symlinks is None and rename is None:
+        symlinks, rename = args.symlinks, args.rename
+    if args.episode_numbers:
+        print(
+            ">>> Episode numbers must be given in the format SEASONxEPISODE e.g. 3x6 for season 3 episode 6")
+
+    action = file_action(symlinks, rename)
+    file_queue = FileQueue(JOURNAL)
+    prefetcher = ThreadPoolExecutor(max_workers=PREFETCH_FILES)
+    prepared_files = [prefetcher.submit(prepare_file, series, filepath, style, action, symlinks)
+                      for filepath in episode_files[:PREFETCH_FILES]]
+    try:
+        for idx, filepath in enumerate(episode_files):
+            # Stop before asking about another file once a move has failed
+            if file_queue.failed():
+                break
+            if idx + PREFETCH_FILES < len(episode_files):
+                prepared_files.append(prefetcher.submit(
+                    prepare_file, series, episode_files[idx + PREFETCH_FILES], style, action, symlinks))
+            prepared = prepared_files[idx].result()
+            prepared_files[idx] = None
+            filepath = prepared['filepath']
+            filename = prepared['filename']
+            if prepared['done']:
+                print('Skipping {}, it was already done'.format(filename))
+                continue
+            print('Episode File: {}'.format(filename))
+
+            episode_ids = list()
+            guessed_ids = prepared['episode_ids']
+            confidence = prepared['confidence']
+            if guessed_ids:
+                guessed_titles = describe_episodes(series, guessed_ids)
+                if confidence >= AUTO_CONFIDENCE and len(guessed_ids) >= num_searches:
+                    print(filter_ascii('>>> Detected "{}" ({:.0%} confident)'.format(guessed_titles, confidence)))
+                    episode_ids = guessed_ids
+                else:
+                    print(filter_ascii('>>> Best guess is "{}" ({:.0%} confident)'.format(guessed_titles, confidence)))
+
+            if not episode_ids and args.episode_numbers:
+                episode_ids = ask_episode_numbers(series.numbers, num_searches)
+            elif not episode_ids:
+                episode_ids = ask_episode_titles(series.titles, num_searches)
+
+            # END SEARCH SECTION / BEGIN RETRIEVING EPISODE DATA
+
+            if episode_ids == guessed_ids:
+                new_filename = prepared['new_filename']
+            else:
+                new_filename = episode_filename(series, episode_ids, style)
+            file_extension = os.path.splitext(filename)[1]
+            print('>>> Your new filename is "{}"'.format(
+                new_filename + file_extension))
+
+            # A move may have failed while the user was typing
+            if file_queue.failed():
+                break
+            if action is None:
+                print("WARNING: No files were renamed or symlinked")
+                continue
+            target = target_path(action, filepath, new_filename + file_extension, symlinks)
+            file_queue.submit(action, filepath, target)
+    except BaseException:
+        # Files already queued were confirmed, so let them finish
+        prefetcher.shutdown(wait=False, cancel_futures=True)
+        file_queue.close()
+        raise
+    prefetcher.shutdown(wait=False, cancel_futures=True)
+    if not file_queue.close():
+        quit(1)
+
+
+def read_manifest(path):
+    """Read a batch manifest, an ini file with one section per series:
+
+        [seinfeld]
+        files = ~/downloads/seinfeld/*.mkv
+            ~/downloads/seinfeld extras/*.avi
+        symlinks = /media/library/seinfeld
+        watch = ~/downloads/seinfeld
+
+    The section name is the search term unless search = is given. Add
+    series_id = to skip choosing between search results, and rename = yes
+    to rename in place. -l and -r apply to sections that give neither.
+    watch = lists the directories used by --watch.
+    Return a list of jobs, one dict per section."""
+    manifest = configparser.ConfigParser()
+    try:
+        with open(path) as infile:
+            manifest.read_file(infile)
+    except (IOError, configparser.Error) as e:
+        sys.exit("Could not read the manifest {}: {}".format(path, e))
+
+    jobs = list()
+    for section in manifest.sections():
+        options = manifest[section]
+        episode_files = list()
+        for pattern in options.get('files', '').splitlines():
+            pattern = os.path.expanduser(pattern.strip())
+            if pattern:
+                episode_files.extend(sorted(glob(pattern)))
+        watch_dirs = [os.path.expanduser(directory.strip())
+                      for directory in options.get('watch', '').splitlines() if directory.strip()]
+        if 'symlinks' in options or 'rename' in options:
+            symlinks = options.get('symlinks')
+            rename = options.getboolean('rename', fallback=False)
+        else:
+            symlinks, rename = args.symlinks, args.rename
+        jobs.append({'search': options.get('search', section),
+                     'series_id': options.getint('series_id', fallback=None),
+                     'files': episode_files,
+                     'watch': watch_dirs,
+                     'symlinks': symlinks,
+                     'rename': rename})
+    return jobs
+
+
+def pick_series(series_list, search, series_id=None):
+    """Choose a series from search results without asking when the choice is
+    obvious: the given series id, the only exact name match, or the only
+    result. Return None when it isn't obvious."""
+    if series_id is not None:
+        matches = [series for series in series_list if series['id'] == series_id]
+    else:
+        matches = [series for series in series_list
+                   if normalize_search(series['seriesName']) == normalize_search(search)]
+        if not matches:
+            matches = series_list
+    if len(matches) == 1:
+        return matches[0]
+    return None
+
+
+def fetch_series(job, cache):
+    """Search for the series of a batch job and download its episodes when the
+    right series is obvious. Return the search results, the chosen series and
+    its episodes, the last two being None when the user must choose."""
+    series_list = search_series(job['search'], cache, args.refresh)
+    series_data = pick_series(series_list, job['search'], job['series_id'])
+    if series_data is None:
+        return series_list, None, None
+    return series_list, series_data, load_episodes(series_data['id'], cache, args.refresh)
+
+
+def resolve_jobs(jobs, cache):
+    """Download the series of every job at the same time, asking the user to
+    choose only when the right series isn't obvious. Yield each job with its
+    series and episodes as soon as they have arrived."""
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    with ThreadPoolExecutor(max_workers=SERIES_WORKERS) as executor:
+        futures = {executor.submit(fetch_series, job, cache): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                series_list, series_data, episode_list = future.result()
+            except SystemExit as e:
+                print("Skipping {}: {}".format(job['search'], e))
+                continue
+
+            print(filter_ascii('Series: {}'.format(job['search'])))
+            if series_data is None:
+                list_choices([series['seriesName'] for series in series_list])
+                series_data = select_choice(series_list)
+                if series_data is None:
+                    print("No series selected, skipping")
+                    continue
+                episode_list = load_episodes(series_data['id'], cache, args.refresh)
+
+            print(filter_ascii('You have selected "{}"'.format(series_data['seriesName'])))
+            yield job, series_data, episode_list
+
+
+def run_batch(jobs, cache, style, num_searches):
+    """Rename the files of each series in a batch as soon as its episodes have arrived"""
+    for job, series_data, episode_list in resolve_jobs(jobs, cache):
+        series = index_series(series_data, episode_list)
+        if args.sync and job['symlinks']:
+            sync_links(series, job['files'], style, num_searches, job['symlinks'])
+        else:
+            rename_interactively(series, job['files'], style, num_searches,
+                                 job['symlinks'], job['rename'])
+
+
+def file_signature(path):
+    """Return the size and modification time of a file, or None if it is gone"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def is_watchable(path):
+    """Return True for regular files that look like finished downloads"""
+    filename = os.path.basename(path)
+    if filename.startswith('.') or filename.lower().endswith(PARTIAL_SUFFIXES):
+        return False
+    return os.path.isfile(path) and not os.path.islink(path)
+
+
+class Inotify:
+    """Report new and changed files below some directories as they happen,
+    through the linux inotify api. Subdirectories created later are watched
+    too. Raise OSError where inotify isn't available."""
+
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, directories):
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on linux")
+        import ctypes
+        import ctypes.util
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            self.raise_errno('inotify_init1')
+        self.directories = directories
+        # watch descriptor -> directory
+        self.paths = dict()
+        try:
+            # Files that were there before the watch started come first
+            self.backlog = [(path, False) for directory in directories
+                            for path in self.add_tree(directory)]
+        except BaseException:
+            self.close()
+            raise
+
+    def raise_errno(self, call):
+        errno = self.ctypes.get_errno()
+        raise OSError(errno, '{}: {}'.format(call, os.strerror(errno)))
+
+    def add_tree(self, directory):
+        """Watch a directory and every directory below it. Return the files
+        already in them, listed after each watch was added so none is missed."""
+        files = list()
+        pending = [directory]
+        while pending:
+            directory = pending.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+            if wd < 0:
+                self.raise_errno('inotify_add_watch')
+            self.paths[wd] = directory
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                else:
+                    files.append(entry.path)
+        return files
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds for changes, forever when None. Return a
+        list of (path, finished) with finished True for files moved into place,
+        which are complete as they arrive."""
+        if self.backlog:
+            changes, self.backlog = self.backlog, list()
+            return changes
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        changes = list()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                # Events were lost, so look at everything again
+                changes.extend((path, False) for directory in self.directories
+                               for path in self.add_tree(directory))
+                continue
+            if mask & self.IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            directory = self.paths.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            finished = bool(mask & self.IN_MOVED_TO)
+            if not mask & self.IN_ISDIR:
+                changes.append((path, finished))
+            elif mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                changes.extend((new_path, finished) for new_path in self.add_tree(path))
+        return changes
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher:
+    """Report new and changed files below some directories by listing them
+    every interval seconds, where inotify isn't available"""
+
+    def __init__(self, directories, interval=None):
+        self.directories = directories
+        self.interval = WATCH_INTERVAL if interval is None else interval
+        # path -> signature from the last listing
+        self.seen = dict()
+        self.next_scan = 0.0
+
+    def scan(self):
+        found = dict()
+        for directory in self.directories:
+            for root, _, filenames in os.walk(directory):
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    signature = file_signature(path)
+                    if signature is not None:
+                        found[path] = signature
+        return found
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds for the next listing and return a list of
+        (path, False) for the files that are new or changed since the last one"""
+        wait = max(0.0, self.next_scan - time.monotonic())
+        if timeout is not None and timeout < wait:
+            time.sleep(timeout)
+            return []
+        time.sleep(wait)
+        self.next_scan = time.monotonic() + self.interval
+        found = self.scan()
+        changes = [(path, False) for path, signature in found.items()
+                   if self.seen.get(path) != signature]
+        self.seen = found
+        return changes
+
+    def close(self):
+        pass
+
+
+def open_watcher(directories):
+    """Watch directories with inotify, or by listing them where it isn't available"""
+    try:
+        return Inotify(directories)
+    except (OSError, AttributeError) as e:
+        print("Checking for new files every {:g} seconds ({})".format(WATCH_INTERVAL, e))
+        return PollingWatcher(directories)
+
+
+class Debouncer:
+    """Hold back files that are still being written until their size and
+    modification time have stayed the same for settle seconds. Files moved
+    into place are ready at once."""
+
+    def __init__(self, settle=None):
+        self.settle = WATCH_SETTLE if settle is None else settle
+        # path -> (time it may be ready, signature when last changed)
+        self.pending = dict()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def touch(self, path, finished=False, now=None):
+        if now is None:
+            now = time.monotonic()
+        due = now if finished else now + self.settle
+        self.pending[path] = (due, file_signature(path))
+
+    def timeout(self, now=None):
+        """Return the seconds until the next file may be ready, or None if no file is waiting"""
+        if not self.pending:
+            return None
+        if now is None:
+            now = time.monotonic()
+        return max(0.0, min(due for due, _ in self.pending.values()) - now)
+
+    def settled(self, now=None):
+        """Return the files that stopped changing, in order. Files that changed
+        since they were last seen are checked again later."""
+        if now is None:
+            now = time.monotonic()
+        ready = list()
+        for path, (due, signature) in list(self.pending.items()):
+            if due > now:
+                continue
+            current = file_signature(path)
+            if current is None:
+                del self.pending[path]
+            elif current == signature:
+                del self.pending[path]
+                ready.append(path)
+            else:
+                self.pending[path] = (now + self.settle, current)
+        return sorted(ready)
+
+
+class WatchedSeries:
+    """A series kept in memory for as long as its directories are watched. It
+    is downloaded again when a file can't be matched, at most once every
+    WATCH_REFRESH seconds, to pick up episodes added since."""
+
+    def __init__(self, series_data, episode_list, cache=None):
+        self.series_data = series_data
+        self.cache = cache
+        self.table = index_series(series_data, episode_list)
+        self.loaded = time.monotonic()
+
+    def reload(self):
+        episode_list = load_episodes(self.series_data['id'], self.cache, refresh=True)
+        self.table = index_series(self.series_data, episode_list)
+        self.loaded = time.monotonic()
+
+    def detect(self, filename, num_searches=1):
+        """Return the episode ids in a file and whether they were detected
+        confidently enough to rename it without asking"""
+        episode_ids, confidence = detect_episodes(self.table, filename)
+        sure = confidence >= AUTO_CONFIDENCE and len(episode_ids) >= num_searches
+        if not sure and time.monotonic() - self.loaded >= WATCH_REFRESH:
+            self.reload()
+            episode_ids, confidence = detect_episodes(self.table, filename)
+            sure = confidence >= AUTO_CONFIDENCE and len(episode_ids) >= num_searches
+        return episode_ids, sure
+
+
+def watch_job(job, series_data, episode_list, cache=None):
+    """Return what the watch loop needs to know about a job of a manifest or of -s"""
+    return {'search': job['search'],
+            'series': WatchedSeries(series_data, episode_list, cache),
+            'directories': [os.path.abspath(directory) for directory in job['watch']],
+            'action': file_action(job['symlinks'], job['rename']),
+            'symlinks': job['symlinks']}
+
+
+def find_job(jobs, path):
+    """Return the job watching the deepest directory that contains path"""
+    best, best_length = None, -1
+    for job in jobs:
+        for directory in job['directories']:
+            if os.path.commonpath([directory, path]) == directory and len(directory) > best_length:
+                best, best_length = job, len(directory)
+    return best
+
+
+def watch_file(job, filepath, style, num_searches):
+    """Rename or symlink a file that settled in a watched directory, when its
+    episode is detected without asking. Return True if it was moved."""
+    filename = os.path.basename(filepath)
+    if not is_watchable(filepath) or is_done(filepath, action=job['action'],
+                                              dest_dir=link_dir(job['action'], job['symlinks'])):
+        return False
+    series = job['series']
+    episode_ids, sure = series.detect(filename, num_searches)
+    if not sure:
+        print(filter_ascii('Leaving "{}" alone, its episode could not be detected'.format(filename)))
+        return False
+    new_name = episode_filename(series.table, episode_ids, style) + os.path.splitext(filename)[1]
+    target = target_path(job['action'], filepath, new_name, job['symlinks'])
+    if target == filepath:
+        return False
+    print(filter_ascii('"{}" -> "{}"'.format(filename, new_name)))
+    moved = journaled_move(JOURNAL, job['action'], filepath, target)
+    if JOURNAL is not None:
+        JOURNAL.flush()
+    return moved
+
+
+def watch(jobs, style, num_searches, watcher=None, stop=None):
+    """Rename or symlink the files in the watched directories as soon as they
+    settle, including those that were there already, until stop is set. The
+    series of every job stays in memory between files."""
+    if watcher is None:
+        watcher = open_watcher([directory for job in jobs for directory in job['directories']])
+    debouncer = Debouncer()
+    print("Watching for new files, hit ctrl-c to stop")
+    try:
+        while stop is None or not stop.is_set():
+            for path in debouncer.settled():
+                job = find_job(jobs, path)
+                if job is None:
+                    continue
+                try:
+                    with STATS.timer('watch', source=path):
+                        watch_file(job, path, style, num_searches)
+                except SystemExit as e:
+                    # The tvdb couldn't be reached, but other files may still work
+                    print("Skipping {}: {}".format(os.path.basename(path), e))
+            # Wake up once a second to notice stop
+            timeout = debouncer.timeout()
+            timeout = 1.0 if timeout is None else min(timeout, 1.0)
+            for path, finished in watcher.read(timeout):
+                debouncer.touch(path, finished)
+    finally:
+        watcher.close()
 
 
 def main():
     parser = create_parser()
     global args
     args = parser.parse_args()
+    if not (args.apply or args.manifest or args.import_dump) and (
+            args.search is None or not (args.files or args.export_dump)):
+        parser.error('SERIES_NAME and EPISODE_FILES are required unless --apply, --manifest or --import-dump is used')
+    if args.manifest and args.plan:
+        parser.error('--plan can only be used for one series at a time')
+    if args.watch and (args.plan or args.apply or args.export_dump or args.import_dump):
+        parser.error('--watch cannot be used with --plan, --apply, --export-dump or --import-dump')
+    if args.watch and not (args.symlinks or args.rename or args.manifest):
+        parser.error('--watch needs -l DEST_DIR or -r')
+    if args.sync and (args.plan or args.apply or args.watch or args.export_dump or args.import_dump):
+        parser.error('--sync cannot be used with --plan, --apply, --watch, --export-dump or --import-dump')
+    if args.sync and not (args.symlinks or args.manifest):
+        parser.error('--sync needs -l DEST_DIR')
+    if args.assign is not None:
+        if args.manifest or args.apply or args.watch or args.sync or args.export_dump or args.import_dump:
+            parser.error('--assign cannot be used with --manifest, --apply, --watch, --sync or the dump options')
+        try:
+            parse_episode_range(args.assign, args.order)
+        except ValueError as e:
+            parser.error('--assign: {}'.format(e))
     
     if not os.path.isdir(CONFIG_DIR):
         os.makedirs(CONFIG_DIR)
@@ -375,11 +3389,14 @@ def main():
         sys.exit()
     
     required_options = {'caps', 'word_delim', 'allow_chars', 'part_delim'}
-    if config_options == required_options:
-        style_attrs = config[style_name]
-    else:
+    if not required_options <= config_options:
         print("Missing required options in config")
         sys.exit()
+    try:
+        style = StyleRenderer(config[style_name])
+    except ValueError as e:
+        print(e)
+        sys.exit()
 
     # Use glob to expand file paths for compatibility with windows shells
     if os.name == 'nt':
@@ -390,24 +3407,76 @@ def main():
 
     load_token() # Creates file if it does not exist
 
-    # Decode token and check how many hours until expiration
-    #hrs_until_exp = (jwt.decode(TOKEN, verify=False)['exp'] - time.time()) / 60 / 60
-    #if hrs_until_exp < 144 and hrs_until_exp > 0:
-    #    response = request_refresh_token()
-    #    save_token(response)
-    #    load_token()
+    global FETCH_WORKERS
+    FETCH_WORKERS = max(1, config.getint('config', 'fetch_workers', fallback=FETCH_WORKERS))
+    global AUTO_CONFIDENCE
+    AUTO_CONFIDENCE = config.getfloat('config', 'auto_confidence', fallback=AUTO_CONFIDENCE)
+    global SERIES_WORKERS
+    SERIES_WORKERS = max(1, config.getint('config', 'series_workers', fallback=SERIES_WORKERS))
+    global RATE_LIMITER
+    RATE_LIMITER = RateLimiter(config.getfloat('config', 'requests_per_second', fallback=10))
+    global TIMEOUT
+    TIMEOUT = (config.getfloat('config', 'connect_timeout', fallback=TIMEOUT[0]),
+               config.getfloat('config', 'read_timeout', fallback=TIMEOUT[1]))
+    global RETRY_POLICY
+    RETRY_POLICY = RetryPolicy(config.getfloat('config', 'retry_backoff', fallback=0.5),
+                               config.getfloat('config', 'max_retry_delay', fallback=30))
+
+    global WATCH_SETTLE
+    WATCH_SETTLE = max(0.0, config.getfloat('config', 'watch_settle', fallback=WATCH_SETTLE))
+    global WATCH_INTERVAL
+    WATCH_INTERVAL = max(0.1, config.getfloat('config', 'watch_interval', fallback=WATCH_INTERVAL))
+
+    global JOURNAL
+    JOURNAL = Journal(JOURNAL_PATH)
+
+    if args.trace:
+        STATS.open_trace(args.trace)
+
+    if args.apply:
+        # Applying a plan needs neither the tvdb nor the cache
+        apply_plan(read_plan(args.apply), JOURNAL)
+        return
 
-    try:
-        response = try_query(find_series, args.search)
-    except:
-        exit_on_query_fail('the tv series')
+    if args.import_dump:
+        store = OfflineStore(OFFLINE_PATH)
+        import_dumps(args.import_dump, store)
+        store.close()
+        return
 
-    try:
-        series_list = response.json()['data']
-    except KeyError as e:
-        print("Did not receive a valid search result")
-        print(e)
-        sys.exit()
+    if args.offline:
+        global OFFLINE
+        OFFLINE = OfflineStore(OFFLINE_PATH)
+    else:
+        start_token_refresh()
+
+    if args.no_cache or args.offline:
+        cache = None
+    else:
+        cache = open_cache(config)
+
+    if not args.multiple_episodes:
+        num_searches = 1
+    else:
+        num_searches = args.multiple_episodes
+
+    if args.manifest and args.watch:
+        jobs = [job for job in read_manifest(args.manifest) if job['watch']]
+        if not jobs:
+            sys.exit("No section of the manifest has directories to watch")
+        for job in jobs:
+            if file_action(job['symlinks'], job['rename']) is None:
+                sys.exit("{} needs rename = yes or a symlinks directory that exists".format(job['search']))
+        watch([watch_job(job, series_data, episode_list, cache)
+               for job, series_data, episode_list in resolve_jobs(jobs, cache)],
+              style, num_searches)
+        return
+
+    if args.manifest:
+        run_batch(read_manifest(args.manifest), cache, style, num_searches)
+        return
+
+    series_list = search_series(args.search, cache, args.refresh)
 
     series_titles = tuple([series['seriesName'] for series in series_list])
     list_choices(series_titles)
@@ -418,142 +3487,67 @@ def main():
         sys.exit()
 
     print(filter_ascii('You have selected "{}"'.format(series_data['seriesName'])))
-    series_id = series_data['id']
-    episode_list = get_all_episodes(series_id)
-    episode_titles = tuple([episode['episodeName']
-                            for episode in episode_list])
-
-    episode_names_ids = dict()
-    for episode_data in episode_list:
-        episode_names_ids[remove_chars(
-            episode_data['episodeName'], string.punctuation).lower()] = episode_data['id']
-
-    # Collect season and episode numbers too, so that we have the
-    # option to search by number instead of title
-
-    episode_nums_ids = dict()
-    for episode_data in episode_list:
-        episode_nums_ids[str(episode_data['airedSeason']) + 'x' +
-                         str(episode_data['airedEpisodeNumber'])] = episode_data['id']
+    if args.export_dump:
+        episode_list = load_episodes(series_data['id'], cache, args.refresh)
+        pages = export_dump(args.export_dump, series_data, episode_list)
+        print("Saved {} episodes in {} pages to {}".format(len(episode_list), pages, args.export_dump))
+        return
 
-    if args.episode_numbers:
-        print(
-            ">>> Episode numbers must be given in the format SEASONxEPISODE e.g. 3x6 for season 3 episode 6")
+    if args.watch:
+        watch_dirs = [path for path in episode_files if os.path.isdir(path)]
+        if not watch_dirs:
+            sys.exit("--watch needs directories to watch as EPISODE_FILES")
+        if file_action(args.symlinks, args.rename) is None:
+            sys.exit("The --symlinks directory does not exist")
+        job = {'search': args.search, 'watch': watch_dirs,
+               'symlinks': args.symlinks, 'rename': args.rename}
+        episode_list = load_episodes(series_data['id'], cache, args.refresh)
+        watch([watch_job(job, series_data, episode_list, cache)], style, num_searches)
+        return
 
-    if not args.multiple_episodes:
-        num_searches = 1
-    else:
-        num_searches = args.multiple_episodes
+    # The first files are matched while the later pages are still arriving
+    series = stream_series(series_data, load_episode_pages(series_data['id'], cache, args.refresh))
 
     if args.symlinks and os.path.isfile(args.symlinks):
         print("WARNING: You may have accidentally passed an episode file to the --symlinks option")
 
-    for idx, filepath in enumerate(episode_files):
-        global BOOKMARK
-        BOOKMARK = idx + 1
-        if args.start_at:
-            if (idx + 1) < args.start_at:
-                continue
-        filepath = os.path.abspath(filepath)
-        filename = os.path.basename(filepath)
-        print('Episode File: {}'.format(filename))
-
-        if args.episode_numbers:
-            given_episode_numbers = list()
-            entry_count = 0
-            while True:
-                episode_number = prompt_user('Enter episode number: ')
-                if re.compile("^\d{1,2}x\d{1,2}$").match(episode_number):
-                    # Remove any leading zeroes
-                    season_and_episode = [num.lstrip(
-                        '0') for num in re.split('x', episode_number)]
-                    episode_number = 'x'.join(season_and_episode)
-                    try:
-                        episode_nums_ids[episode_number]
-                    except KeyError:
-                        print("Episode does not exist")
-                        continue
-                    given_episode_numbers.append(episode_number)
-                    entry_count += 1
-                else:
-                    print("Invalid entry, try again")
-                    continue
-
-                if entry_count >= num_searches:
-                    break
+    if args.sync:
+        if not sync_links(series, episode_files, style, num_searches, args.symlinks):
+            # Nothing is left half done, so there is nothing to resume
+            sys.exit(1)
+        return
 
-            episode_ids = [episode_nums_ids[ep_num]
-                           for ep_num in given_episode_numbers]
+    if args.assign is not None:
+        plan = assign_plan(series, episode_files, style, num_searches, args.assign, args.order)
+        if args.plan:
+            write_plan(args.plan, plan)
+        elif file_action(args.symlinks, args.rename) is None:
+            print("WARNING: No files were renamed or symlinked, use -l or -r to do so")
         else:
-            # TODO: Guess episode title
-            chosen_episode_list = list()
-            search_count = 0
-
-            while (search_count < num_searches):
-                text = prompt_user('Enter an episode title: ')
-                title_search = remove_chars(text, string.punctuation).lower()
-                chosen_episode = search_titles(episode_titles, title_search)
-
-                if chosen_episode is not None:
-                    chosen_episode_list.append(chosen_episode)
-                    search_count += 1
-                else:
-                    print("No search results found, or invalid choice. Try again")
+            apply_plan(plan, JOURNAL)
+        return
 
-            chosen_episodes = [remove_chars(ep_name, string.punctuation).lower(
-            ) for ep_name in chosen_episode_list]
-            episode_ids = [episode_names_ids[ep_name]
-                           for ep_name in chosen_episodes]
+    if args.plan:
+        plan = make_plan(series, episode_files, style, num_searches)
+        write_plan(args.plan, plan)
+        return
 
-        # END SEARCH SECTION / BEGIN RETRIEVING EPISODE DATA
+    rename_interactively(series, episode_files, style, num_searches)
 
-        episode_data_list = list()
-        for ep_id in episode_ids:
-            try:
-                response = try_query(episode_info, ep_id)
-            except:
-                exit_on_query_fail('episode info')
-            episode_data = response.json()['data']
-            episode_data_list.append(episode_data)
-
-        series_name = filter_ascii(series_data['seriesName'])
-        # Just grab the last one in memory, for now
-        season_number = str(episode_data['airedSeason'])
-        episode_names = [filter_ascii(data['episodeName']) for data in episode_data_list]
-        episode_numbers = [str(data['airedEpisodeNumber'])
-                           for data in episode_data_list]
-
-        new_filename = build_filename(
-            series_name, season_number, episode_names, episode_numbers, style_attrs)
-        file_extension = os.path.splitext(filename)[1]
-        print('>>> Your new filename is "{}"'.format(
-            new_filename + file_extension))
-
-        if args.symlinks and os.path.isdir(args.symlinks):
-            linkpath = os.path.abspath(args.symlinks)
-            try:
-                os.symlink(filepath, os.path.join(
-                    linkpath, new_filename + file_extension))
-            except NotImplementedError:
-                print("ERROR: The -l option was used, but your OS can't create symbolic links. Try renaming files with -r instead.")
-                quit(1, BOOKMARK)
-        elif args.rename:
-            filedir = os.path.dirname(filepath)
-            try:
-                os.rename(filepath, os.path.join(
-                    filedir, new_filename + file_extension))
-            except OSError as e:
-                if e.winerror and e.winerror == 123:
-                    print("ERROR: Filename contains characters usupported by your OS. Identify problem character and remove from 'allow_chars' in 'styles.ini'.")
-                else:
-                    print(e)
-                quit(1, BOOKMARK)
-        else:
-            print("WARNING: No files were renamed or symlinked")
+
+def print_stats():
+    """Print the --stats summary and close the --trace file"""
+    if args is not None and args.stats:
+        print()
+        for line in STATS.summary():
+            print(line)
+    STATS.close()
 
 
 if __name__ == "__main__":
     try:
         main()
     except KeyboardInterrupt:
-        quit(BOOKMARK)
+        quit(1)
+    finally:
+        print_stats()